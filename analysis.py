@@ -0,0 +1,194 @@
+import numpy as np
+from numpy.typing import NDArray
+from scipy.signal import detrend
+
+from history import Frame_History, Ring_Buffer
+
+
+class Noise_Map():
+    # Per-pixel mean, variance and SNR over a window of frames, built from the integer sum and sum of
+    # squares accumulated by Frame_History (exact, so no cancellation problems with the one-pass variance)
+
+    def __init__(self, shape, window=300):
+        self.shape = shape
+        self.window = window        #frames
+        self.sums = np.zeros(shape, dtype=np.int64)
+        self.sumsq = np.zeros(shape, dtype=np.int64)
+        self.frame_count = 0
+        self.scratch = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.variance = np.zeros(shape, dtype=np.float32)
+        self.snr = np.zeros(shape, dtype=np.float32)
+
+    def reset(self):
+        self.sums.fill(0)
+        self.sumsq.fill(0)
+        self.frame_count = 0
+
+    def merge(self, history: Frame_History):
+        # Add a filled history buffer, returns True when a full window is done and the maps were updated
+        if history.sumsq is None or history.frame_count == 0:
+            return False
+        if history.noise_frames != history.frame_count:
+            return False    #enabled partway through this buffer, its sums hold frames that weren't squared
+        np.add(self.sums, history.sums, out=self.sums)
+        np.add(self.sumsq, history.sumsq, out=self.sumsq, casting="unsafe")
+        self.frame_count += history.frame_count
+        if self.frame_count < max(self.window, 2):
+            return False
+
+        n = self.frame_count
+        # variance = (n * sumsq - sum^2) / (n * (n - 1))
+        np.multiply(self.sums, self.sums, out=self.scratch)
+        np.multiply(self.sumsq, n, out=self.sumsq)
+        np.subtract(self.sumsq, self.scratch, out=self.scratch)
+        np.divide(self.scratch, n * (n - 1), out=self.variance, casting="unsafe")
+        np.divide(self.sums, n, out=self.mean, casting="unsafe")
+        np.sqrt(self.variance, out=self.snr)
+        np.divide(self.mean, self.snr, out=self.snr, where=self.snr > 0)     #zero where there is no noise
+        self.reset()
+        return True
+
+
+class Frame_Timing():
+    # Measured frame rate, inter-frame jitter and inferred dropped frames from the per-frame timestamps in
+    # Frame_History, over the last window intervals. Every missing period in a gap counts as a dropped frame,
+    # the period being the median interval rather than the nominal rate, which the device may not keep
+    # (e.g. with auto exposure). Intervals that aren't positive (a replay looping, a clock that didn't
+    # advance) are counted as clock resets and left out.
+
+    def __init__(self, nominal_fps=0.0, window=1024):
+        self.nominal_fps = nominal_fps
+        self.clock = "Host"     #or "Device" when the timestamps come from the backend
+        self.intervals = Ring_Buffer(window, np.float64)
+        self.last = None        #timestamp of the last frame merged
+        self.dropped = 0
+        self.resets = 0
+
+    def merge(self, history: Frame_History):
+        stamps = history.timestamps.values()
+        if len(stamps) == 0:
+            return
+        if history.frame_count > len(stamps) or self.last is None:
+            intervals = np.diff(stamps)     #more frames than the buffer held, the gap before is unknown
+        else:
+            intervals = np.diff(stamps, prepend=self.last)
+        self.last = stamps[-1]
+
+        valid = intervals > 0
+        self.resets += len(intervals) - int(np.count_nonzero(valid))
+        intervals = intervals[valid]
+        if len(intervals) == 0:
+            return
+        self.intervals.extend(intervals)
+        period = np.median(self.intervals.valid())
+        gaps = intervals[intervals > 1.5 * period]
+        self.dropped += int(np.rint(gaps / period).sum()) - len(gaps)
+
+    def fps(self):
+        intervals = self.intervals.valid()
+        return 1 / intervals.mean() if len(intervals) > 0 else 0.0
+
+    def summary(self):
+        # Interval p50 / p95 / max and jitter (deviation from the median interval) p50 / p95 / p99, in ms
+        intervals = self.intervals.valid()
+        if len(intervals) == 0:
+            return {"Clock": self.clock}
+        p50, p95 = np.percentile(intervals, (50, 95)) * 1e3
+        jitter = np.percentile(np.abs(intervals - np.median(intervals)), (50, 95, 99)) * 1e3
+        return {"Clock": self.clock,
+                "FPS": float(1 / intervals.mean()),
+                "Nominal FPS": self.nominal_fps,
+                "Interval (ms)": f"{p50:.2f} / {p95:.2f} / {intervals.max() * 1e3:.2f}",
+                "Jitter (ms)": f"{jitter[0]:.2f} / {jitter[1]:.2f} / {jitter[2]:.2f}",
+                "Dropped": self.dropped,
+                "Clock Resets": self.resets}
+
+
+def band_rms(freqs: NDArray, psd: NDArray, low, high):
+    # RMS of the signal in [low, high) Hz from a one-sided power spectral density
+    band = (freqs >= low) & (freqs < high)
+    if len(freqs) < 2 or not band.any():
+        return 0.0
+    return float(np.sqrt(psd[band].sum() * (freqs[1] - freqs[0])))
+
+
+class Pointing_Spectrum():
+    # Incremental Welch power spectrum (px^2/Hz) of the per-frame centroid in x and y. Samples are collected
+    # into segments of nperseg with 50% overlap, each segment is transformed once when it is complete and
+    # its periodogram goes into a ring buffer, the spectrum is the mean of the last `segments` of them.
+    # Segments are put on a uniform grid at their median frame rate (see addSegment), linearly detrended
+    # (drift is for the drift history) and Hann windowed. Segments with the beam lost for more
+    # than 10% of the frames or a clock reset are skipped, a change of the frame rate starts over.
+
+    def __init__(self, nperseg=256, segments=16, bands=((0.1, 1), (1, 10), (10, 100))):
+        self.nperseg = nperseg
+        self.bands = bands      #Hz, (low, high) for the RMS summary
+        self.window = np.hanning(nperseg)
+        self.periodograms = (Ring_Buffer(segments, np.float64, nperseg // 2 + 1), Ring_Buffer(segments, np.float64, nperseg // 2 + 1))
+        self.pending = np.zeros((0, 3))     #(time, x, y) not transformed yet
+        self.fs = None
+        self.freqs = None
+        self.skipped = 0
+
+    def reset(self, fs):
+        self.fs = fs
+        self.freqs = np.fft.rfftfreq(self.nperseg, 1 / fs)
+        self.scale = 2 / (fs * (self.window ** 2).sum())    #one-sided, DC and Nyquist are not doubled
+        for ring in self.periodograms:
+            ring.clear()
+
+    def discardPending(self):
+        # Samples that can't be joined to the next ones (frames missing in between)
+        self.pending = self.pending[:0]
+
+    def merge(self, samples: NDArray):
+        # Add (time, x, y) rows, oldest first. Returns True when a new segment went into the spectrum.
+        self.pending = np.concatenate((self.pending, samples))
+        updated = False
+        while len(self.pending) >= self.nperseg:
+            updated |= self.addSegment(self.pending[:self.nperseg])
+            self.pending = self.pending[self.nperseg // 2:]
+        return updated
+
+    def addSegment(self, segment: NDArray):
+        t, x, y = segment.T
+        tracked = ~np.isnan(x)
+        if tracked.mean() < 0.9 or not np.all(np.diff(t) > 0):
+            self.skipped += 1
+            return False
+        fs = 1 / np.median(np.diff(t))
+        if self.fs is None or abs(fs / self.fs - 1) > 0.1:
+            self.reset(fs)
+        #consecutive frames are consecutive samples (no smearing from the timing jitter), a gap of n periods
+        #(dropped frames) skips n - 1 samples, those and the frames with the beam lost are interpolated
+        index = np.concatenate(([0], np.cumsum(np.maximum(np.rint(np.diff(t) * self.fs), 1))))
+        grid = np.arange(self.nperseg)
+        for values, ring in zip((x, y), self.periodograms):
+            uniform = detrend(np.interp(grid, index[tracked], values[tracked]))
+            spectrum = np.abs(np.fft.rfft(self.window * uniform)) ** 2 * self.scale
+            spectrum[0] /= 2
+            spectrum[-1] /= 2
+            ring.append(spectrum)
+        return True
+
+    def psd(self):
+        # (freqs, psd x, psd y), None before the first segment
+        if self.freqs is None or len(self.periodograms[0]) == 0:
+            return None
+        return self.freqs, self.periodograms[0].valid().mean(axis=0), self.periodograms[1].valid().mean(axis=0)
+
+    def summary(self):
+        # RMS pointing stability "x / y" in px per band, up to the Nyquist frequency for the total
+        psd = self.psd()
+        if psd is None:
+            return {"Segments Skipped": self.skipped}
+        freqs, psd_x, psd_y = psd
+        result = {}
+        for low, high in (*self.bands, (freqs[1], np.inf)):
+            name = "Total" if high == np.inf else f"{low:g}-{high:g} Hz"
+            result[name] = f"{band_rms(freqs, psd_x, low, high):.3f} / {band_rms(freqs, psd_y, low, high):.3f}"
+        result["Resolution (Hz)"] = float(freqs[1])
+        result["Segments"] = len(self.periodograms[0])
+        result["Segments Skipped"] = self.skipped
+        return result
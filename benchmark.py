@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import argparse
+from time import perf_counter_ns
+
+import numpy as np
+import cv2
+
+from sources import Synthetic_Source
+from history import Double_Buffered_History
+from fitting import beam_moments, detect_spots, FIT_ENGINES, Centroid_Tracker, Spot_Fitter
+
+SIZES = {"640x480": (640, 480), "1280x720": (1280, 720), "1920x1080": (1920, 1080), "4K": (3840, 2160)}
+BGR_BANK = 8        #frames, the synthetic source is grayscale so the conversion stage runs on BGR copies
+
+
+def summarize(times_ns):
+    # Latency percentiles in ms, fps from the mean
+    t = np.asarray(times_ns, dtype=float) / 1e6
+    mean = t.mean()
+    return {"n": len(t),
+            "mean": mean,
+            "p50": np.percentile(t, 50),
+            "p95": np.percentile(t, 95),
+            "p99": np.percentile(t, 99),
+            "max": t.max(),
+            "fps": 1000 / mean if mean > 0 else float("inf")}
+
+
+def timed(times, fn, *args):
+    t0 = perf_counter_ns()
+    result = fn(*args)
+    times.append(perf_counter_ns() - t0)
+    return result
+
+
+def bench_capture(source: Synthetic_Source, frames, noise=False, render=None):
+    # The per-frame work of USB_Camera.grabLoop, stage by stage, plus the whole loop per frame. Converts into
+    # rotating preallocated buffers and hands those to the viewer, like the capture loop.
+    stages = {k: [] for k in ("read", "convert", "track", "accumulate", "render", "pipeline")}
+    width, height = source.shape[1], source.shape[0]
+    buffers = tuple(np.zeros((height, width), dtype=np.uint8) for _ in range(3))    #USB_Camera.buffers
+    history = Double_Buffered_History((height, width))
+    history.setTrackNoise(noise)
+    tracker = Centroid_Tracker()
+    bgr = [cv2.cvtColor(source.getFrame(i % source.frame_count), cv2.COLOR_GRAY2BGR) for i in range(BGR_BANK)]
+    if render is not None:
+        render.start(buffers[0])
+
+    for i in range(frames):
+        t0 = perf_counter_ns()
+        ret, img = timed(stages["read"], source.read)
+        img = timed(stages["convert"], cv2.cvtColor, bgr[i % BGR_BANK], cv2.COLOR_BGR2GRAY, buffers[i % 3])
+        centroid = timed(stages["track"], tracker.track, img)
+        timed(stages["accumulate"], history.add, img, t0 / 1e9, (np.nan, np.nan) if centroid is None else centroid[:2])
+        if render is not None:
+            timed(stages["render"], render.updateImage, img)
+        stages["pipeline"].append(perf_counter_ns() - t0)
+        if history.active.frame_count >= 1000:
+            history.swap()      #stay within the ring buffer capacity, as the stats thread would
+    if render is None:
+        del stages["render"]
+    return {k: summarize(v) for k, v in stages.items()}, history
+
+
+def bench_stats(source: Synthetic_Source, history: Double_Buffered_History, fits, engines, render=None):
+    # Camera_Stats.updateStats: swap and mean image, moment estimate, then the fit engines (warm = refining
+    # the previous fit of a moving beam, cold = reset before each fit) and the multi-spot detection and fits
+    stages = {"swap + mean": [], "moments": []}
+    for buffer in history.buffers:
+        buffer.reset()      #the capture stage left its frames in there, a mean of those is a smeared beam
+    img_means = np.zeros(history.active.shape, dtype=float)
+    means = []
+    for i in range(fits):
+        history.add(source.read()[1])
+        filled = timed(stages["swap + mean"], history.swap)
+        np.divide(filled.sums, max(filled.frame_count, 1), out=img_means)
+        estimate = timed(stages["moments"], beam_moments, img_means)
+        means.append((img_means.copy(), estimate))
+
+    for engine in engines:
+        fitter = FIT_ENGINES[engine]()
+        stages[f"fit {engine} (warm)"] = warm = []
+        stages[f"fit {engine} (cold)"] = cold = []
+        rejected = 0
+        for img, estimate in means:
+            accepted, _ = timed(warm, fitter.fit, img, estimate)
+            rejected += not accepted
+        for img, estimate in means:
+            fitter.reset()
+            timed(cold, fitter.fit, img, estimate)
+        if rejected:
+            print(f"  {engine}: {rejected}/{len(means)} fits rejected", file=sys.stderr)
+
+    spot_fitter = Spot_Fitter()
+    stages["spots"] = []
+    stages["fit spots"] = []
+    for img, _ in means:
+        spots = timed(stages["spots"], detect_spots, img)
+        timed(stages["fit spots"], spot_fitter.fit, img, spots)
+
+    if render is not None:
+        stages["crosshair"] = []
+        for img, estimate in means:
+            if estimate is not None:
+                timed(stages["crosshair"], render.updateTarget, estimate)
+    return {k: summarize(v) for k, v in stages.items() if v}
+
+
+class Render_Bench():
+    # The viewer side: Viewer.renderImages per frame and the Crosshair update per stats update, with the
+    # events processed so the image is actually redrawn (offscreen unless there is a display)
+
+    def __init__(self):
+        if "QT_QPA_PLATFORM" not in os.environ and not os.environ.get("DISPLAY"):
+            os.environ["QT_QPA_PLATFORM"] = "offscreen"
+        from PyQt6.QtWidgets import QApplication
+        import pyqtgraph as pg
+        self.pg = pg
+        self.app = QApplication.instance() or QApplication([])
+        self.imv = None
+
+    def start(self, img):
+        from main import Crosshair     #also sets the row-major image axis order
+        if self.imv is not None:
+            self.imv.close()
+        self.imv = self.pg.ImageView()
+        self.imv.setPredefinedGradient('turbo')
+        self.imv.setImage(img)
+        self.imv.resize(800, 600)
+        self.imv.show()
+        self.crosshair = Crosshair(self.imv)
+        self.app.processEvents()
+
+    def updateImage(self, img):
+        #same calls as Viewer.renderImages, default checkbox states
+        self.imv.setImage(img, autoHistogramRange=True, autoLevels=True, autoRange=False, levelMode='mono')
+        self.imv.getImageItem().render()
+        self.app.processEvents()
+
+    def updateTarget(self, estimate):
+        self.crosshair.setTarget((estimate["Center X"], estimate["Center Y"]), (estimate["Sigma X"] * 6, estimate["Sigma Y"] * 6))
+        self.app.processEvents()
+
+
+def print_table(title, results):
+    print(f"\n{title:<26}{'n':>6}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}{'fps':>10}   (ms)")
+    for stage, r in results.items():
+        print(f"  {stage:<24}{r['n']:>6}{r['mean']:>10.3f}{r['p50']:>10.3f}{r['p95']:>10.3f}{r['p99']:>10.3f}{r['max']:>10.3f}{r['fps']:>10.1f}")
+
+
+def compare(results, baseline, tolerance):
+    # Stages whose median got slower than tolerance x the baseline
+    regressions = []
+    for size, stages in results.items():
+        for stage, r in stages.items():
+            try:
+                base = baseline[size][stage]["p50"]
+            except KeyError:
+                continue
+            if base > 0 and r["p50"] > base * tolerance:
+                regressions.append(f"{size} {stage}: p50 {r['p50']:.3f} ms vs {base:.3f} ms ({r['p50'] / base:.2f}x)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage benchmark of the acquisition, stats and display pipeline on synthetic frames, no camera needed.")
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), choices=list(SIZES), help="Frame sizes to run")
+    parser.add_argument("--frames", type=int, default=300, help="Frames per size for the capture stages")
+    parser.add_argument("--fits", type=int, default=10, help="Stats updates (fits per engine) per size")
+    parser.add_argument("--engines", nargs="*", default=list(FIT_ENGINES), choices=list(FIT_ENGINES), help="Fit engines to compare")
+    parser.add_argument("--bank", type=int, default=16, help="Synthetic frames to precompute per size")
+    parser.add_argument("--noise-map", action="store_true", help="Also accumulate the sums of squares for the per-pixel noise map")
+    parser.add_argument("--no-render", action="store_true", help="Skip the viewer stages (no Qt needed)")
+    parser.add_argument("--save", metavar="FILE", help="Write the results as JSON, e.g. as a baseline for later runs")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare against saved results, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="Allowed slowdown of a stage median against the baseline")
+    args = parser.parse_args()
+
+    render = None if args.no_render else Render_Bench()
+    results = {}
+    for size in args.sizes:
+        width, height = SIZES[size]
+        source = Synthetic_Source(width, height, frames=args.bank, trajectory="circle", realtime=False)
+        source.open()
+        capture, history = bench_capture(source, args.frames, args.noise_map, render)
+        print_table(f"{size} capture", capture)
+        stats = bench_stats(source, history, args.fits, args.engines, render)
+        print_table(f"{size} stats", stats)
+        results[size] = {**capture, **stats}
+        source.release()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r}")
+        if regressions:
+            sys.exit(1)
+        print("\nNo regressions against the baseline.")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,30 +2,68 @@ import logging
 import threading
 from os import path, makedirs
 from datetime import datetime
-from time import sleep, time
+from time import sleep, perf_counter_ns
 from ctypes import sizeof, c_float
 
 import numpy as np
 from numpy.typing import NDArray
 import cv2
-import lmfit
-from lmfit.lineshapes import gaussian2d
 from scipy.stats import skew, norm
 #import debugpy
 
-from PyQt6.QtCore import pyqtSignal, pyqtSlot, QObject, QThread, QTimer, QMutex
-from PyQt6.QtWidgets import QApplication
+from history import Double_Buffered_History, Ring_Buffer
+from analysis import Noise_Map, Frame_Timing, Pointing_Spectrum
+from recorder import Frame_Recorder
+from sources import open_source, is_virtual
+from fitting import beam_moments, in_range, detect_spots, FIT_ENGINES, Pool_Fitter, Centroid_Tracker, Spot_Fitter
+from util import Stage_Timer
+from discovery import find_devices, DEFAULT_CACHE
+
+from PyQt6.QtCore import pyqtSignal, pyqtSlot, QObject, QThread, QTimer
+
+CAPTURE_STAGES = ("Grab", "Convert", "Track", "Accumulate", "Record")
+STATS_STAGES = ("Moments", "Spots", "Fit", "Emit", "Update")
+MOMENT_FIELDS = ("Center X", "Center Y", "Sigma X", "Sigma Y", "Angle")
+FIT_FIELDS = ("Center X", "Center Y", "Sigma X", "Sigma Y")
+
+
+CAPTURE_DEFAULTS = {"fourcc": "", "width": 0, "height": 0, "fps": 0, "raw_y": False}    #empty/0 leaves the backend default
+PACKED_YUV = {"YUYV": 0, "YUY2": 0, "YVYU": 0, "UYVY": 1, "VYUY": 1}     #FOURCC: channel of the Y samples
+
+
+def fourcc_string(code):
+    code = int(code)
+    return "".join(chr((code >> (8 * i)) & 0xFF) for i in range(4)).strip("\x00 ")
+
+
+def y_plane(raw: NDArray, fourcc: str, dst: NDArray) -> NDArray:
+    # Luminance of an unconverted frame (CAP_PROP_CONVERT_RGB off) into dst, without the decode to BGR and back
+    h, w = dst.shape
+    if raw.ndim == 3 and raw.shape[2] == 3:
+        return cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY, dst=dst)     #backend converted anyway
+    if fourcc in ("MJPG", "JPEG"):
+        return cv2.imdecode(raw.reshape(-1), cv2.IMREAD_GRAYSCALE)     #the decoder skips the chroma
+    data = raw.reshape(-1)
+    if fourcc in PACKED_YUV:
+        return cv2.extractChannel(data[:h * w * 2].reshape(h, w, 2), PACKED_YUV[fourcc], dst=dst)
+    #grayscale (GREY/Y800) and planar YUV (NV12, YU12, ...) start with the full Y plane
+    np.copyto(dst, data[:h * w].reshape(h, w))
+    return dst
 
-USE_FAKE_DATA = False
 
 class Camera_Search(QObject):
     result = pyqtSignal(list)
+    devices = pyqtSignal(dict)      #{device index: name, serial, default mode, ...}
     finished = pyqtSignal()
 
-    def __init__(self, skip_idxs=[]):
+    def __init__(self, skip_idxs=[], virtual_sources=[], max_index=10, cache_path=DEFAULT_CACHE, rescan=False):
         QObject.__init__(self)
 
         self.skip_idxs = skip_idxs
+        self.virtual_sources = virtual_sources
+        self.max_index = max_index
+        self.cache_path = cache_path
+        self.rescan = rescan
 
         self.q_thread : QThread = QThread()
         self.q_thread.setObjectName(f"Cam_Search")
@@ -36,28 +74,11 @@ class Camera_Search(QObject):
         self.q_thread.started.connect(self.findCameras)
         
     def findCameras(self):
-        #https://stackoverflow.com/a/61768256
-        # checks the first 10 indexes.
         # debugpy.debug_this_thread()
-        index = 0
-        arr = []
-        i = 10
-        while i > 0:
-            if index in self.skip_idxs:
-                arr.append(index)
-            else:
-                try:
-                    cap = cv2.VideoCapture(index)
-                    if cap.read()[0]:
-                        arr.append(index)
-                        cap.release()
-                except cv2.error as e:
-                    if "Camera index out of range" in str(e):
-                        pass
-                except Exception as e:
-                    logging.warning(f"Error opening camera {index}: {type(e)} {e}")
-            index += 1
-            i -= 1
+        devices = find_devices(self.skip_idxs, self.max_index, self.cache_path, self.rescan)
+        arr = sorted(devices)
+        arr += self.virtual_sources     #replays and synthetic sources, listed after the real cameras
+        self.devices.emit(devices)
         self.result.emit(arr)
         self.finished.emit()
         
@@ -65,35 +86,51 @@ class Camera_Search(QObject):
 class USB_Camera(QObject):
     ready_sig = pyqtSignal(int, bool)
     status_sig = pyqtSignal(int, str)
-    stats_sig = pyqtSignal(int, dict)
+    stats_sig = pyqtSignal(int, dict, dict)
     finished_sig = pyqtSignal(int)
     update_image_sig = pyqtSignal(int)
+    grab_done_sig = pyqtSignal()
+    stats_thread_sig = pyqtSignal(QThread)      #the Camera_Stats thread once it is started, to be watched on shutdown
 
-    def __init__(self, camera_index:int, save_images=True, save_path="."):
+    def __init__(self, camera_index:int, save_images=False, save_path=".", fit_workers=0, source=None):
         QObject.__init__(self)
         self.camera_index = camera_index
+        self.source = camera_index if source is None else source    #device index, or virtual source spec (see sources.open_source)
+        self.realtime = True        #pace virtual sources at their frame rate, False to run them as fast as possible
         self.camera_type = ""
         self.active = False
         self.acquiring = False
-        self.last_frame_time = time()
+        self.last_frame_time = 0.0      #perf_counter time the last frame arrived
 
         self.serial = "N/A"
         self.save_images = save_images
         self.save_path = save_path
         self.save_png = False
-
-        #For testing only
-        if USE_FAKE_DATA:
-            self.fake_update = 0
-            self.fake_center_x = 0
-            self.fake_center_y = 0
-            self.fake_sig_x = 20
-            self.fake_sig_y = 0
+        self.save_format = "npy"    #see recorder.RECORD_FORMATS, save_png overrides
+        self.recorder = None
+        self.fit_engine = "2D Fit"
+        self.fit_workers = fit_workers
+        self.noise_window = 0       #frames, 0 when the per-pixel noise map is disabled
+        self.stats_interval = 500   #ms
+        self.display = True         #hand frames to the viewer through self.img, False when running headless
+        self.display_pending = False    #frame signalled to the viewer but not drawn yet, cleared by the viewer
+        self.timer = Stage_Timer(CAPTURE_STAGES)
+        self.capture_format = dict(CAPTURE_DEFAULTS)    #requested, applied when the device is opened
+        self.negotiated = {}        #what the device actually delivers
+        self.raw_y = False
+        self.track = True           #per-frame centroid tracking in the capture loop
+        self.centroid = None        #(x, y, sigma x, sigma y) on the newest frame, None while the beam is lost
+        self.spectrum_segment = 256     #frames per segment of the pointing spectrum
+        self.spectrum_bands = ((0.1, 1), (1, 10), (10, 100))    #Hz, RMS pointing stability bands
+        self.multi_spot = False     #detect and fit every spot in the frame instead of a single beam
+        self.max_spots = 8
 
         self.q_thread : QThread = QThread()
         self.q_thread.setObjectName(f"Cam_{camera_index}")
         self.moveToThread(self.q_thread)
         self.q_thread.finished.connect(self.threadFinished)
+        self.grab_done_sig.connect(self.finishAcquisition)
+        self.grab_thread = None
 
     @pyqtSlot()
     def init(self):
@@ -101,15 +138,30 @@ class USB_Camera(QObject):
         # debugpy.debug_this_thread()
         self.status_sig.emit(self.camera_index, "Starting")
 
-        self.cam = cv2.VideoCapture()
+        if is_virtual(self.source):
+            self.cam = open_source(self.source, realtime=self.realtime)
+            self.serial = self.cam.name
+            self.camera_type = self.cam.type_name
+        else:
+            self.cam = cv2.VideoCapture()
         self.cam.setExceptionMode(True)
 
         try:
-            self.cam.open(self.camera_index)
+            self.cam.open(self.source)
+            if not is_virtual(self.source):
+                self.applyCaptureFormat()
 
             self.width = int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH))
             self.height = int(self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            self.img = np.empty((self.width, self.height), dtype=np.uint8)
+            self.negotiated = {"FOURCC": fourcc_string(self.cam.get(cv2.CAP_PROP_FOURCC)) or "Gray",
+                               "Width": self.width,
+                               "Height": self.height,
+                               "FPS": self.cam.get(cv2.CAP_PROP_FPS),
+                               "Raw Y": self.raw_y}
+            logging.info(f"Camera {self.camera_index} format: {self.negotiated}")
+            self.frame_dtype = np.dtype(getattr(self.cam, "dtype", np.uint8))    #replays can be 16-bit, devices are converted to 8
+            self.img = np.zeros((self.height, self.width), dtype=self.frame_dtype)      #newest frame for the viewer
+            self.buffers = (self.img, np.zeros_like(self.img), np.zeros_like(self.img))     #converted frames, see grabLoop
 
             logging.info(f"Started camera {self.camera_index}.")
             self.active = True
@@ -118,47 +170,20 @@ class USB_Camera(QObject):
 
             if not self.acquiring:
                 self.acquiring = True
-                self.stats = Camera_Stats(self.camera_index, self.img.T)    #Note the transpose!
+                self.stats = Camera_Stats(self.camera_index, self.img, self.fit_workers, self.stats_interval)
+                self.stats.setFitEngine(self.fit_engine)
+                self.stats.setMultiSpot(self.multi_spot, self.max_spots)
+                self.stats.noise_window_sig.emit(self.noise_window)
                 self.stats.stats_sig.connect(self.stats_sig)
-                while self.active:
-                    ret, img = self.cam.read()
-                    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-                    # For testing only
-                    if USE_FAKE_DATA:
-                        # img = np.zeros_like(img)
-                        if self.fake_update % 180 == 0:
-                            self.fake_center_x += img.shape[1] / 10
-                            self.fake_center_y += img.shape[0] / 10
-                            self.fake_sig_x += 10
-                            self.fake_sig_y += 15
-
-                            x_sub = np.arange(0, img.shape[1])
-                            y_sub = np.arange(0, img.shape[0])
-                            x, y = np.meshgrid(x_sub, y_sub)
-
-                            self.fake_gauss = gaussian2d(x, y, amplitude=1, centerx=self.fake_center_x, centery=self.fake_center_y, sigmax=abs(self.fake_sig_x), sigmay=abs(self.fake_sig_y))
-                            self.fake_gauss = (self.fake_gauss / np.max(self.fake_gauss)) * 255
-                            self.fake_gauss += np.random.normal(0, 25, self.fake_gauss.shape)
-                        img = np.clip(self.fake_gauss + (img * 0.5), 0, 255).astype(np.uint8)
-                        self.fake_update += 1
-
-                    np.copyto(self.img, img.T)
-                    self.update_image_sig.emit(self.camera_index)    
-
-                    #stats - update when processing thread is ready
-                    if self.stats.mutex.tryLock():
-                        self.stats.history["Minimum"] += [np.min(img)]
-                        self.stats.history["Maximum"] += [np.max(img)]
-                        self.stats.history["Mean"] += [np.mean(img)]
-                        self.stats.history["frame_count"] = self.stats.history["frame_count"] + 1
-                        self.stats.history["sums"] += img
-                        self.stats.mutex.unlock()
-        
-                    QApplication.processEvents()
-
-                self.stats.stop()
-                self.acquiring = False
+                self.stats_thread_sig.emit(self.stats.q_thread)
+                self.stats.capture_timer = self.timer
+                self.stats.timing.nominal_fps = self.negotiated["FPS"]
+                if self.track:
+                    self.stats.spectrum = Pointing_Spectrum(self.spectrum_segment, bands=self.spectrum_bands)
+                if self.save_images:
+                    self.startRecording()
+                self.grab_thread = threading.Thread(target=self.grabLoop, name=f"Grab_Cam_{self.camera_index}")
+                self.grab_thread.start()
 
         except Exception as e:
             logging.error(f"Error starting camera {self.camera_index}: {type(e)} {e}")
@@ -169,12 +194,99 @@ class USB_Camera(QObject):
             self.status_sig.emit(self.camera_index, "Error")
             self.ready_sig.emit(self.camera_index, False)
 
+    def grabLoop(self):
+        # Runs on its own thread and blocks on the device, so the camera's Qt thread stays free for the
+        # slots. Only talks to the Qt side through signals, the stats history and the recorder queue.
+        timer = self.timer
+        raw = None      #color frame buffer, handed back to the camera to be filled again
+        back = 1
+        device_clock = None     #whether the backend timestamps the frames, decided on the first frame
+        tracker = Centroid_Tracker() if self.track else None
+        position = None
+        try:
+            while self.active:
+                t = perf_counter_ns()
+                ret, img = self.cam.read(raw)
+                if not self.active:
+                    break       #stopped while waiting for the frame
+                if not ret:
+                    raise IOError("No frame")
+                t = timer.record("Grab", t)
+                self.last_frame_time = t / 1e9
+                #frame timestamp: the device's (e.g. the V4L2 buffer time) where the backend has one, otherwise
+                #the host time the frame arrived. Virtual sources only report their nominal timing.
+                if device_clock is None:
+                    device_clock = not is_virtual(self.source) and self.cam.get(cv2.CAP_PROP_POS_MSEC) > 0
+                    self.stats.timing.clock = "Device" if device_clock else "Host"
+                stamp = self.cam.get(cv2.CAP_PROP_POS_MSEC) / 1000 if device_clock else self.last_frame_time
+                if self.raw_y:
+                    raw = img
+                    img = y_plane(raw, self.negotiated["FOURCC"], self.buffers[back])
+                    t = timer.record("Convert", t)
+                elif img.ndim == 3:
+                    raw = img
+                    img = cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY, dst=self.buffers[back])
+                    t = timer.record("Convert", t)
+                #grayscale frames are used as they are, the sources never reuse a frame they returned
+
+                if tracker is not None:
+                    self.centroid = centroid = tracker.track(img)
+                    position = (np.nan, np.nan) if centroid is None else centroid[:2]
+                    t = timer.record("Track", t)
+
+                if self.display and not self.display_pending:
+                    #hand the newest frame to the viewer. It owns that buffer until it clears display_pending and
+                    #keeps showing the one handed before until then, the frames in between go into the third buffer
+                    #and are only accumulated.
+                    shown = self.img
+                    self.img = img
+                    self.display_pending = True
+                    self.update_image_sig.emit(self.camera_index)
+                    if img is self.buffers[back]:
+                        back = next(i for i, b in enumerate(self.buffers) if b is not img and b is not shown)
+
+                #stats - the stats thread swaps out the accumulated frames on each update
+                self.stats.history.add(img, stamp, position)
+                t = timer.record("Accumulate", t)
+
+                recorder = self.recorder
+                if recorder is not None:
+                    recorder.push(img, stamp)
+                    timer.record("Record", t)
+        except Exception as e:
+            if self.active:
+                logging.error(f"Error reading camera {self.camera_index}: {type(e)} {e}")
+                self.status_sig.emit(self.camera_index, "Error")
+        finally:
+            self.grab_done_sig.emit()
+
+    @pyqtSlot()
+    def finishAcquisition(self):
+        if self.acquiring:
+            self.acquiring = False
+            self.stopRecording()
+            #the stats timers have to be stopped by the stats thread itself, wait for it before this thread goes away
+            stats_thread = self.stats.q_thread
+            self.stats.stop_sig.emit()
+            if not stats_thread.wait(5000):
+                logging.warning(f"Stats thread of camera {self.camera_index} did not stop.")
+
     @pyqtSlot()    
     def stop(self):
         self.status_sig.emit(self.camera_index, "Stopping")
         self.active = False
-        #self.acq_timer.stop()
-        self.cam.release()
+        grab_thread = getattr(self, "grab_thread", None)
+        release = True
+        if grab_thread is not None:
+            #a read returns within a frame, the device is only released once the grab thread is out of it
+            grab_thread.join(timeout=5)
+            if grab_thread.is_alive():
+                logging.warning(f"Grab thread of camera {self.camera_index} did not stop, device left open.")
+                release = False
+            self.grab_thread = None
+        self.finishAcquisition()
+        if release:
+            self.cam.release()
         logging.info(f"Stopped camera {self.camera_index}.")
         self.width = 0
         self.height = 0
@@ -197,31 +309,127 @@ class USB_Camera(QObject):
     def threadFinished(self):
         del self.q_thread
 
-    @pyqtSlot(str)
-    def setSaveOpts(self, save_path):
+    @pyqtSlot(str, bool)
+    def setSaveOpts(self, save_path, save_images):
+        restart = self.recorder is not None and save_path != self.save_path
         self.save_path = save_path
+        self.save_images = save_images
+        if self.acquiring:
+            if restart or not save_images:
+                self.stopRecording()
+            if save_images:
+                self.startRecording()
+
+    def startRecording(self):
+        if self.recorder is None:
+            fmt = "png" if self.save_png else self.save_format
+            fps = self.cam.get(cv2.CAP_PROP_FPS) or 30
+            try:
+                self.recorder = Frame_Recorder(self.camera_index, self.img.shape, self.frame_dtype, self.save_path, fmt, fps)
+            except Exception as e:
+                logging.error(f"Error starting recording for camera {self.camera_index}: {type(e)} {e}")
+            self.stats.recorder = self.recorder
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            self.recorder.stop()
+            self.recorder = None
+            self.stats.recorder = None
+
+    def applyCaptureFormat(self):
+        # Request the configured pixel format, size and frame rate, whatever the device doesn't support
+        # is left at its default (check self.negotiated)
+        fmt = self.capture_format
+        requests = []
+        if fmt["fourcc"]:
+            requests.append((cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fmt["fourcc"].ljust(4)[:4])))
+        if fmt["width"] > 0 and fmt["height"] > 0:
+            requests += [(cv2.CAP_PROP_FRAME_WIDTH, fmt["width"]), (cv2.CAP_PROP_FRAME_HEIGHT, fmt["height"])]
+        if fmt["fps"] > 0:
+            requests.append((cv2.CAP_PROP_FPS, fmt["fps"]))
+        if fmt["raw_y"]:
+            requests.append((cv2.CAP_PROP_CONVERT_RGB, 0))
+        for prop, value in requests:
+            try:
+                if not self.cam.set(prop, value):
+                    logging.warning(f"Camera {self.camera_index} did not accept property {prop} = {value}")
+            except cv2.error as e:
+                logging.warning(f"Camera {self.camera_index} could not set property {prop} = {value}: {e}")
+        self.raw_y = fmt["raw_y"] and self.cam.get(cv2.CAP_PROP_CONVERT_RGB) == 0
+
+    @pyqtSlot(str)
+    def setFitEngine(self, engine):
+        self.fit_engine = engine
+        try:
+            self.stats.setFitEngine(engine)
+        except AttributeError:
+            pass
+
+    @pyqtSlot(bool, int)
+    def setMultiSpot(self, enabled, max_spots):
+        self.multi_spot = enabled
+        self.max_spots = max_spots
+        try:
+            self.stats.setMultiSpot(enabled, max_spots)
+        except AttributeError:
+            pass
+
+    @pyqtSlot(int, int)
+    def setNoiseWindow(self, camera_index, window):
+        if camera_index == self.camera_index:
+            self.noise_window = window
+            try:
+                self.stats.noise_window_sig.emit(window)
+            except (AttributeError, RuntimeError):
+                pass
 
     def getTypeString(self):
-        return str(self.camera_index)
+        if is_virtual(self.source):
+            return self.camera_type
+        return str(self.source)
 
 
 class Camera_Stats(QObject):
     stats_sig = pyqtSignal(int, dict, dict)
+    fit_result_sig = pyqtSignal(bool, dict)
+    noise_window_sig = pyqtSignal(int)
+    stop_sig = pyqtSignal()
     
-    def __init__(self, camera_index: int, img: NDArray):
+    def __init__(self, camera_index: int, img: NDArray, fit_workers=0, interval=500):
         QObject.__init__(self)
         self.camera_index = camera_index
         self.frame_rate = 15
         self.img_shape = img.shape
-        self.mutex = QMutex()
         self.stats = {"Gaussian":{}}
         self.plots = {}
-        self.history = {}
-
-        self.fake_center_x = 0
-        self.fake_center_y = 0
-        self.fake_sig_x = -50
-        self.fake_sig_y = -50
+        self.history = Double_Buffered_History(self.img_shape)
+        self.img_means = np.zeros(self.img_shape, dtype=float)
+        self.interval = interval    #ms
+        self.refine_every = 10      #run the fit refinement every N stats updates (0 to disable)
+        self.update_count = 0
+        self.fitters = {k: fitter() for k, fitter in FIT_ENGINES.items()}
+        self.fit_engine = "2D Fit"  #or "Moments" for no refinement
+        self.multi_spot = False     #detect_spots + Spot_Fitter on every update instead of the single beam fit
+        self.max_spots = 8
+        self.spot_fitter = Spot_Fitter()
+        self.spot_count = 0         #"Spot N" entries in the stats
+        self.fit_workers = fit_workers      #>0 to run the fits in the shared process pool
+        self.pool_fitter = None
+        self.new_fit = None         #values of an accepted fit, laid over the moments with the next update
+        self.fit_result_sig.connect(self.applyFit)
+        self.noise = None       #Noise_Map while the per-pixel noise map is enabled
+        self.timing = Frame_Timing()
+        self.centroids = Ring_Buffer(4096, np.float64, 3)    #per-frame (time, x, y) of the tracked centroid, NaN while lost
+        self.spectrum = None        #Pointing_Spectrum of the centroids while tracking
+        self.recorder = None    #Frame_Recorder of the camera while recording
+        self.noise_window_sig.connect(self.setNoiseWindow)
+        self.stop_sig.connect(self.stop)
+        self.stats_timer = None
+        self.timer = Stage_Timer(STATS_STAGES)
+        self.capture_timer = None   #Stage_Timer of the camera's capture loop, published with the stats
+        self.skipped = 0            #stats updates without any new frames
+        self.fits_rejected = 0
+        self.iterations = {}        #Start (Warm/Cold/Fallback): (total nfev, fits) of the current engine
 
         self.q_thread : QThread = QThread()
         self.q_thread.setObjectName(f"Stats_Cam_{camera_index}")
@@ -235,9 +443,10 @@ class Camera_Stats(QObject):
         threading.current_thread().name = QThread.currentThread().objectName()  #fix names
         # debugpy.debug_this_thread()
         
-        self.resetStats()
+        if self.fit_workers > 0:
+            self.pool_fitter = Pool_Fitter(self.camera_index, self.img_shape, self.fit_workers)
         self.stats_timer = QTimer()
-        self.stats_timer.setInterval(500)
+        self.stats_timer.setInterval(self.interval)
         self.stats_timer.timeout.connect(self.updateStats)
         self.stats_timer.start()
         logging.info(f"Started stats for camera {self.camera_index}.")
@@ -245,75 +454,222 @@ class Camera_Stats(QObject):
     @pyqtSlot()
     def updateStats(self):
         # debugpy.debug_this_thread()
-        self.mutex.lock()
-        try:
-            self.stats["Minimum"] = np.min(self.history["Minimum"])
-            self.stats["Maximum"] = np.max(self.history["Maximum"])
-            self.stats["Mean"] = np.mean(self.history["Mean"])        #NON-GENERALIZABLE STATS WARNING: ONLY ALLOWED BECAUSE ALL SAMPLES ARE IDENTICAL IN SIZE!
-            self.stats['Frame Rate'] = self.history["frame_count"] / (self.stats_timer.interval() / 1000)
-            img_means : NDArray = np.copy(self.history["sums"] / self.history["frame_count"])
-        except ValueError:
+        start = perf_counter_ns()
+        history = self.history.swap()
+        if history.frame_count > 0:
+            self.stats["Minimum"] = history.minimum.valid().min()
+            self.stats["Maximum"] = history.maximum.valid().max()
+            self.stats["Mean"] = history.mean.valid().mean()        #NON-GENERALIZABLE STATS WARNING: ONLY ALLOWED BECAUSE ALL SAMPLES ARE IDENTICAL IN SIZE!
+            self.timing.merge(history)
+            self.updateCentroid(history)
+            self.stats['Frame Rate'] = self.timing.fps() or history.frame_count / history.elapsed()
+            np.divide(history.sums, history.frame_count, out=self.img_means)
+        else:
             # this can occur during intialization if threads are out of sync
-            img_means = np.zeros(self.img_shape, dtype=float)
-            pass
+            self.img_means.fill(0)
+            self.skipped += 1
+        self.stats["Frame Timing"] = self.timing.summary()
+        self.stats["Frames Discarded"] = self.history.discarded
+        self.stats["Stats Skipped"] = self.skipped
+        recorder = self.recorder
+        if recorder is not None:
+            self.stats["Recording"] = recorder.getStats()
+        img_means = self.img_means
+
+        noise = self.noise
+        if noise is not None and noise.merge(history):
+            self.plots["Mean"] = noise.mean.copy()
+            self.plots["Variance"] = noise.variance.copy()
+            self.plots["SNR"] = noise.snr.copy()
+
+        if history.frame_count > 0:
+            #nothing to estimate without frames, a fit of the empty image would only drop the warm start
+            if self.multi_spot:
+                self.updateSpots(img_means)
+            else:
+                self.updateBeam(img_means)
+            self.update_count += 1
+
+        #p50 / p95 / max of each stage over the last few seconds, Emit and Update show up one update later
+        timing = self.capture_timer.summary() if self.capture_timer is not None else {}
+        timing.update(self.timer.summary())
+        self.stats["Timing (us)"] = timing
+
+        t = self.timer.record("Update", start)
+        self.stats_sig.emit(self.camera_index, self.snapshot(), self.plots)
+        self.timer.record("Emit", t)
+        self.plots = {}     #maps are only sent once
+
+    def updateBeam(self, img_means: NDArray):
+        # "Gaussian" has the moment estimate of every update, with the values of the refined fit laid over it on
+        # the update a fit comes in (Method tells which). "Fit" keeps the last fit's values with its R^2/Iterations.
+        t = perf_counter_ns()
+        estimate = beam_moments(img_means)
+        t = self.timer.record("Moments", t)
+        if estimate is not None and in_range(estimate["Center X"], estimate["Center Y"], img_means.shape):
+            self.stats["Gaussian"].update({k: estimate[k] for k in MOMENT_FIELDS})
+        else:
+            estimate = None
+            self.new_fit = None
+            self.clearGaussian()
+        self.stats["Gaussian"]["Method"] = "Moments"
+
+        if self.fit_engine in self.fitters and estimate is not None and self.refine_every > 0 and self.update_count % self.refine_every == 0:
+            self.refineStats(img_means, estimate)
+            self.timer.record("Fit", t)
+        if self.new_fit is not None:
+            #pool fits arrive between updates, the others right above
+            self.stats["Gaussian"].update(self.new_fit)
+            self.stats["Gaussian"]["Method"] = self.fit_engine
+            self.new_fit = None
+
+    def updateSpots(self, img_means: NDArray):
+        # Every spot in the frame as "Spot 1".."Spot N" (brightest first), each refined with a gaussian fit
+        # of its own window unless the engine is "Moments". The windows are small, so the fits run on every
+        # update. "Gaussian" follows the brightest spot.
+        t = perf_counter_ns()
+        spots = detect_spots(img_means, max_spots=self.max_spots)
+        t = self.timer.record("Spots", t)
+        fits = self.spot_fitter.fit(img_means, spots) if self.fit_engine != "Moments" else []
+        if fits:
+            self.timer.record("Fit", t)
+
+        for n in range(len(spots), self.spot_count):
+            self.stats.pop(f"Spot {n + 1}", None)
+        self.spot_count = len(spots)
+        for n, spot in enumerate(spots):
+            stats = {k: spot[k] for k in ("Center X", "Center Y", "Sigma X", "Sigma Y", "Angle", "Amplitude", "Area")}
+            stats["Method"] = "Moments"
+            if n < len(fits):
+                accepted, results = fits[n]
+                if accepted:
+                    stats.update({k: results[k] for k in ("Center X", "Center Y", "Sigma X", "Sigma Y")})
+                    stats["Method"] = "Spot Fit"
+                else:
+                    self.fits_rejected += 1
+                stats["R^2"] = results["R^2"]
+            self.stats[f"Spot {n + 1}"] = stats
+        self.stats["Spots"] = len(spots)
+
+        if spots:
+            self.stats["Gaussian"].update({k: self.stats["Spot 1"][k] for k in ("Center X", "Center Y", "Sigma X", "Sigma Y", "Angle", "Method")})
+        else:
+            self.clearGaussian()
+        if self.fit_engine != "Moments":
+            self.stats.setdefault("Fit", {})["Fits Rejected"] = self.fits_rejected
+
+    def updateCentroid(self, history):
+        # Spread of the per-frame centroids over the interval (the pointing jitter the averaged fit can't
+        # see) and the time series for the analysis stages
+        positions = history.centroids.values()
+        if len(positions) == 0:
+            return      #not tracking
+        stamps = history.timestamps.values()
+        n = min(len(stamps), len(positions))
+        samples = np.column_stack((stamps[-n:], positions[-n:]))
+        self.centroids.extend(samples)
+        spectrum = self.spectrum
+        if spectrum is not None:
+            if history.frame_count > n:
+                spectrum.discardPending()       #more frames than the history held
+            if spectrum.merge(samples):
+                self.plots["Spectrum"] = spectrum.psd()
+            self.stats["Pointing RMS (px)"] = spectrum.summary()
+        tracked = positions[~np.isnan(positions[:, 0])]
+        centroid = self.stats.setdefault("Centroid", {})
+        centroid["Tracked (%)"] = 100 * len(tracked) / len(positions)
+        if len(tracked) > 0:
+            centroid["X"], centroid["Y"] = tracked.mean(axis=0)
+            centroid["Std X"], centroid["Std Y"] = tracked.std(axis=0)
+        else:
+            centroid.update({k: "" for k in ("X", "Y", "Std X", "Std Y")})
+
+    def refineStats(self, img_means: NDArray, estimate=None):
+        #Gaussian fit with the selected engine, slower so only run at a lower rate than the moment estimate
+        if self.pool_fitter is not None:
+            #result comes back later through fit_result_sig, a fit is dropped while the previous one is still running
+            self.pool_fitter.submit(img_means, self.fit_engine, estimate, self.fitDone)
+            self.stats.setdefault("Fit", {})["Fits Dropped"] = self.pool_fitter.dropped
+        else:
+            accepted, results = self.fitters[self.fit_engine].fit(img_means, estimate)
+            self.updateFit(accepted, results)
 
-        self.resetStats()
-        self.mutex.unlock()
-
-        subsampling = 2
-        model = lmfit.models.Gaussian2dModel()
-        x_sub = np.arange(0, img_means.shape[1], subsampling)
-        y_sub = np.arange(0, img_means.shape[0], subsampling)
-        z_sub = img_means[::subsampling,::subsampling]
-        # x_sub = np.arange(0, img_means.shape[1])
-        # y_sub = np.arange(0, img_means.shape[0])
-        # z_sub = img_means
-        x, y = np.meshgrid(x_sub, y_sub)
-
-        # For testing only
-        # self.fake_center_x += img_means.shape[0] / 10
-        # self.fake_center_y += img_means.shape[1] / 10
-        # self.fake_sig_x += 10
-        # self.fake_sig_y += 10
-        # z_sub = gaussian2d(x, y, amplitude=30, centerx=self.fake_center_x, centery=self.fake_center_y, sigmax=abs(self.fake_sig_x), sigmay=abs(self.fake_sig_y))
-
-        params = model.guess(z_sub.flatten(), x.flatten(), y.flatten())
-        result = model.fit(z_sub, x=x, y=y, calc_covar=False, params=params, max_nfev=5000)
-        
-        x_in_range = (result.params["centerx"].value > (img_means.shape[1] * -0.2)) and \
-                     (result.params["centerx"].value < (img_means.shape[1] * 1.2))
-        
-        y_in_range = (result.params["centery"].value > (img_means.shape[0] * -0.2)) and \
-                     (result.params["centery"].value < (img_means.shape[0] * 1.2))
-
-        if result.rsquared > 0.5 and x_in_range and y_in_range and result.nfev < 5000:
-            self.stats["Gaussian"]["Center X"] = result.params["centerx"].value
-            self.stats["Gaussian"]["Center Y"] = result.params["centery"].value
-            self.stats["Gaussian"]["Sigma X"] = result.params["sigmax"].value
-            self.stats["Gaussian"]["Sigma Y"] = result.params["sigmay"].value
+    def fitDone(self, accepted, results):
+        #called from the pool's result thread
+        try:
+            self.fit_result_sig.emit(bool(accepted), results)
+        except RuntimeError:
+            pass    #stats already stopped
+
+    @pyqtSlot(bool, dict)
+    def applyFit(self, accepted, results):
+        #pool fits are published with the next update, one stats_sig per interval
+        self.updateFit(accepted, results)
+
+    def updateFit(self, accepted, results):
+        fit_values = {k: results.pop(k) for k in FIT_FIELDS if k in results}     #none after an error
+        fit = self.stats.setdefault("Fit", {})
+        if accepted:
+            fit.update(fit_values)
+            self.new_fit = fit_values
         else:
-            self.stats["Gaussian"]["Center X"] = ""
-            self.stats["Gaussian"]["Center Y"] = ""
-            self.stats["Gaussian"]["Sigma X"] = ""
-            self.stats["Gaussian"]["Sigma Y"] = ""
-            
-        self.stats["Gaussian"]["R^2"] = result.rsquared
-        self.stats["Gaussian"]["Iterations"] = result.nfev
-
-        self.stats_sig.emit(self.camera_index, self.stats, self.plots)
-
-
-    def resetStats(self):
-        self.history["Minimum"] = []
-        self.history["Maximum"] = []
-        self.history["Mean"] = []
-        self.history["sums"] = np.zeros(self.img_shape, dtype=float)
-        self.history["x_sums"] = []
-        self.history["y_sums"] = []
-        self.history["frame_count"] = 0
+            self.fits_rejected += 1
+            fit.update({k: "" for k in FIT_FIELDS})     #the R^2/Iterations below belong to the rejected fit
+        fit["Fits Rejected"] = self.fits_rejected
+        fit.update(results)
+        if "Start" in results:
+            #mean nfev by start, what the warm starts save over cold fits
+            total, count = self.iterations.get(results["Start"], (0, 0))
+            total, count = self.iterations[results["Start"]] = (total + results["Iterations"], count + 1)
+            fit[f"Mean Iterations ({results['Start']})"] = total / count
+
+    def snapshot(self):
+        # Copy of the stats (and of the dicts in them) to emit, the signal hands the same objects to the other
+        # threads while this one keeps adding and removing keys
+        return {k: dict(v) if isinstance(v, dict) else v for k, v in self.stats.items()}
+
+    def setFitEngine(self, engine: str):
+        if engine != self.fit_engine:
+            self.fit_engine = engine
+            self.stats.pop("Fit", None)     #fit fields differ between engines
+            self.new_fit = None
+            self.iterations = {}
+            if engine in self.fitters:
+                self.fitters[engine].reset()
+            if self.pool_fitter is not None:
+                self.pool_fitter.reset()
+
+    def setMultiSpot(self, enabled: bool, max_spots=8):
+        self.max_spots = max_spots
+        if enabled != self.multi_spot:
+            self.multi_spot = enabled
+            self.stats.pop("Fit", None)
+            self.new_fit = None
+            if not enabled:
+                for n in range(self.spot_count):
+                    self.stats.pop(f"Spot {n + 1}", None)
+                self.stats.pop("Spots", None)
+                self.spot_count = 0
+
+    @pyqtSlot(int)
+    def setNoiseWindow(self, window):
+        #per-pixel noise map over the given number of frames, 0 to disable
+        if window > 0:
+            self.noise = Noise_Map(self.img_shape, window)
+        else:
+            self.noise = None
+        self.history.setTrackNoise(window > 0)
+
+    def clearGaussian(self):
+        for k in MOMENT_FIELDS:
+            self.stats["Gaussian"][k] = ""
 
+    @pyqtSlot()
     def stop(self):
-        self.stats_timer.stop()
+        if self.stats_timer is not None:
+            self.stats_timer.stop()
+        if self.pool_fitter is not None:
+            self.pool_fitter.close()
         logging.info(f"Stopped stats for camera {self.camera_index}.")
         self.q_thread.quit()
         self.deleteLater()
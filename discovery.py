@@ -0,0 +1,148 @@
+import re
+import json
+import logging
+import threading
+from os import path, listdir, makedirs
+from time import time, perf_counter
+
+import cv2
+
+SYSFS_VIDEO = "/sys/class/video4linux"
+DEFAULT_CACHE = path.join(path.expanduser("~"), ".cache", "LaserAlignmentCam", "cameras.json")
+
+
+def read_sysfs(*parts):
+    try:
+        with open(path.join(*parts)) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def list_video_devices():
+    # Capture nodes from sysfs (Linux), {index: {"path", "name", "serial", "usb_id"}}. Each UVC camera also
+    # has a metadata node (index file 1), only the first node of each device is a candidate.
+    devices = {}
+    try:
+        nodes = listdir(SYSFS_VIDEO)
+    except OSError:
+        return None     #not Linux, or no video4linux
+    for node in nodes:
+        m = re.fullmatch(r"video(\d+)", node)
+        if m is None or read_sysfs(SYSFS_VIDEO, node, "index") not in ("", "0"):
+            continue
+        usb = path.join(SYSFS_VIDEO, node, "device", "..")     #the USB device above the video interface
+        devices[int(m.group(1))] = {"path": f"/dev/{node}",
+                                    "name": read_sysfs(SYSFS_VIDEO, node, "name"),
+                                    "serial": read_sysfs(usb, "serial"),
+                                    "usb_id": ":".join(filter(None, (read_sysfs(usb, "idVendor"), read_sysfs(usb, "idProduct"))))}
+    return devices
+
+
+IDENTITY = ("name", "serial", "usb_id")
+
+
+def device_key(index, info):
+    # Cache key, identifies the physical device where sysfs tells us what it is. None without any identity
+    # (not Linux): an index alone doesn't say whether the same camera is still there, those are always probed.
+    if not any(info.get(k) for k in IDENTITY):
+        return None
+    return "|".join((str(index), *(info.get(k, "") for k in IDENTITY)))
+
+
+def probe_device(index):
+    # Open the device and grab a frame, returns its default mode or None if it can't deliver frames
+    cap = cv2.VideoCapture(index)
+    try:
+        if not cap.isOpened() or not cap.read()[0]:
+            return None
+        code = int(cap.get(cv2.CAP_PROP_FOURCC))
+        return {"width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                "fps": cap.get(cv2.CAP_PROP_FPS),
+                "fourcc": "".join(chr((code >> (8 * i)) & 0xFF) for i in range(4)).strip("\x00 ")}
+    except cv2.error:
+        return None
+    finally:
+        cap.release()
+
+
+def probe_devices(indices, timeout=3.0):
+    # Probe all devices at once, each on its own daemon thread so a device that hangs in open/read is
+    # simply left behind after the timeout, {index: mode or None}
+    results = {}
+
+    def probe(index):
+        try:
+            results[index] = probe_device(index)
+        except Exception as e:
+            logging.warning(f"Error opening camera {index}: {type(e)} {e}")
+            results[index] = None
+
+    threads = [threading.Thread(target=probe, args=(index,), name=f"Probe_Cam_{index}", daemon=True) for index in indices]
+    for thread in threads:
+        thread.start()
+    deadline = perf_counter() + timeout
+    for index, thread in zip(indices, threads):
+        thread.join(max(deadline - perf_counter(), 0))
+        if thread.is_alive():
+            logging.warning(f"Camera {index} did not respond within {timeout:g} s, skipped.")
+    return {index: results.get(index) for index in indices}
+
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache_path, cache):
+    try:
+        makedirs(path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(cache, f, indent=1)
+    except OSError as e:
+        logging.warning(f"Could not save camera cache {cache_path}: {e}")
+
+
+def find_devices(skip_idxs=[], max_index=10, cache_path=DEFAULT_CACHE, rescan=False, timeout=3.0):
+    # Cameras that deliver frames, {index: info}. Candidates are the capture nodes in sysfs on Linux (any
+    # index), otherwise indices below max_index. Devices found before are taken from the cache without
+    # being opened again (only while sysfs still shows the same device at that index), the rest are probed
+    # concurrently. Entries of devices that are gone or no longer open are dropped from the cache. rescan
+    # probes everything again.
+    start = perf_counter()
+    candidates = list_video_devices()
+    if candidates is None:
+        candidates = {index: {} for index in range(max_index)}
+    keys = {index: device_key(index, info) for index, info in candidates.items()}
+    cache = {} if rescan or not cache_path else load_cache(cache_path)
+    cache = {key: mode for key, mode in cache.items() if key in keys.values()}     #unplugged or replaced
+
+    found = {}
+    to_probe = []
+    for index, info in sorted(candidates.items()):
+        key = keys[index]
+        if index in skip_idxs:
+            found[index] = dict(info, **cache.get(key, {}), in_use=True)
+        elif key in cache:
+            found[index] = dict(info, **cache[key])
+        else:
+            to_probe.append(index)
+
+    for index, mode in probe_devices(to_probe, timeout).items():
+        info = candidates[index]
+        key = keys[index]
+        if mode is None:
+            cache.pop(key, None)
+        else:
+            found[index] = dict(info, **mode)
+            if key is not None:
+                cache[key] = dict(mode, time=time())
+
+    if cache_path:
+        save_cache(cache_path, cache)
+    logging.info(f"Found {len(found)} camera(s) in {perf_counter() - start:.2f} s ({len(to_probe)} probed, {len(candidates) - len(to_probe)} known).")
+    return found
@@ -0,0 +1,666 @@
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from numpy.typing import NDArray
+import cv2
+import lmfit
+from scipy.optimize import least_squares
+
+
+def beam_moments(img: NDArray, threshold=0.05):
+    # Background-subtracted first/second image moments of the beam spot.
+    # Background and noise are taken from the frame border, pixels below the threshold (fraction of the
+    # peak above background, or 5 sigma of the border noise, whichever is higher) are excluded.
+    h, w = img.shape
+    border = np.concatenate((img[0, :], img[-1, :], img[1:-1, 0], img[1:-1, -1]))
+    background = np.median(border)
+    noise = np.std(border)
+    peak = np.max(img)
+    if not peak > background:
+        return None
+
+    level = max(background + 5 * noise, background + threshold * (peak - background))
+    weights = np.where(img > level, img - background, 0.0)
+
+    col = weights.sum(axis=0)
+    row = weights.sum(axis=1)
+    total = col.sum()
+    if not total > 0:
+        return None
+
+    x = np.arange(w, dtype=float)
+    y = np.arange(h, dtype=float)
+    cx = (col @ x) / total
+    cy = (row @ y) / total
+    dx = x - cx
+    dy = y - cy
+    var_x = (col @ (dx * dx)) / total
+    var_y = (row @ (dy * dy)) / total
+    cov_xy = (dy @ weights @ dx) / total
+
+    #Excluding everything below the threshold level truncates the gaussian, scale the variances back up
+    #(for a 2D gaussian cut at fraction f of the peak the second moments shrink by 1 + f*ln(f)/(1-f))
+    f = (level - background) / (peak - background)
+    truncation = 1 + f * np.log(f) / (1 - f)
+    var_x /= truncation
+    var_y /= truncation
+    cov_xy /= truncation
+
+    return {"Center X": cx,
+            "Center Y": cy,
+            "Sigma X": np.sqrt(var_x),
+            "Sigma Y": np.sqrt(var_y),
+            "Angle": np.degrees(0.5 * np.arctan2(2 * cov_xy, var_x - var_y)),
+            "Amplitude": peak - background,
+            "Background": background}
+
+
+def in_range(center_x, center_y, shape):
+    # Allow centers slightly outside of the frame, anything further away is considered a failed estimate
+    x_in_range = (center_x > (shape[1] * -0.2)) and (center_x < (shape[1] * 1.2))
+    y_in_range = (center_y > (shape[0] * -0.2)) and (center_y < (shape[0] * 1.2))
+    return x_in_range and y_in_range
+
+
+def detect_spots(img: NDArray, threshold=0.2, min_area=9, max_spots=8):
+    # All beam spots in the frame, as a list of beam_moments style estimates (plus "Area") brightest first.
+    # Pixels above the level (threshold of the peak above the border background, at least 5 sigma of the
+    # border noise) are split into connected components, then the background-subtracted moments of every
+    # component are accumulated at once over just the thresholded pixels. Large frames are searched on an
+    # area-averaged copy (at most ~640 wide) and scaled back. Components smaller than min_area pixels are
+    # noise, each spot is corrected for the truncation at its own fraction of the level.
+    h, w = img.shape
+    border = np.concatenate((img[0, :], img[-1, :], img[1:-1, 0], img[1:-1, -1]))
+    background = np.median(border)
+    noise = np.std(border)
+    peak = np.max(img)
+    if not peak > background:
+        return []
+
+    s = max(w // 640, 1)
+    if s > 1:
+        img = cv2.resize(img, (w // s, h // s), interpolation=cv2.INTER_AREA)
+        w = img.shape[1]
+    level = max(background + 5 * noise / s, background + threshold * (np.max(img) - background))
+    count, labels, areas, _ = cv2.connectedComponentsWithStats((img > level).astype(np.uint8), connectivity=8)
+    if count <= 1:
+        return []
+    pixels = np.flatnonzero(labels)
+    label = labels.ravel()[pixels]
+    weights = img.ravel()[pixels] - background
+    y, x = np.divmod(pixels, w)
+    m00 = np.bincount(label, weights, count)
+    m10 = np.bincount(label, weights * x, count)
+    m01 = np.bincount(label, weights * y, count)
+    m20 = np.bincount(label, weights * x * x, count)
+    m02 = np.bincount(label, weights * y * y, count)
+    m11 = np.bincount(label, weights * x * y, count)
+    peaks = np.zeros(count)
+    np.maximum.at(peaks, label, weights)
+
+    spots = []
+    for i in sorted(range(1, count), key=lambda i: -m00[i]):
+        area = areas[i, cv2.CC_STAT_AREA] * s * s
+        if area < min_area or not m00[i] > 0:
+            continue
+        cx = m10[i] / m00[i]
+        cy = m01[i] / m00[i]
+        f = min((level - background) / peaks[i], 0.8)    #see beam_moments
+        truncation = 1 + f * np.log(f) / (1 - f)
+        var_x = (m20[i] / m00[i] - cx * cx) / truncation
+        var_y = (m02[i] / m00[i] - cy * cy) / truncation
+        cov_xy = (m11[i] / m00[i] - cx * cy) / truncation
+        #back to full resolution, averaging over s x s pixels widened the spot by s^2 / 12
+        var_x = max(var_x * s * s - (s * s - 1) / 12, 0.25)
+        var_y = max(var_y * s * s - (s * s - 1) / 12, 0.25)
+        spots.append({"Center X": (cx + 0.5) * s - 0.5,
+                      "Center Y": (cy + 0.5) * s - 0.5,
+                      "Sigma X": np.sqrt(var_x),
+                      "Sigma Y": np.sqrt(var_y),
+                      "Angle": np.degrees(0.5 * np.arctan2(2 * cov_xy * s * s, var_x - var_y)),
+                      "Amplitude": peaks[i],
+                      "Background": background,
+                      "Area": int(area)})
+        if len(spots) == max_spots:
+            break
+    return spots
+
+
+def level_truncation(f):
+    # Weighting by the height above a cut at fraction f of the peak shrinks the second moments of a 2D gaussian
+    # by (1 - f - f*L - f*L^2/2) / (1 - f - f*L), L = -ln(f). beam_moments weights by the height above the
+    # background instead, which shrinks them by 1 + f*ln(f)/(1-f).
+    f = min(max(f, 0.01), 0.9)
+    L = -np.log(f)
+    return (1 - f - f * L - f * L * L / 2) / (1 - f - f * L)
+
+
+class Centroid_Tracker():
+    # Per-frame beam centroid for the capture loop. Thresholded cv2.moments over a window of window_sigmas
+    # around the last position, so the cost doesn't depend on the frame size. When the beam is lost it is
+    # found again on a subsampled copy of the whole frame (every subsampling-th pixel, at least every
+    # w/640-th). The threshold level (fraction of the peak above the window minimum) is subtracted and
+    # everything below it cut, the widths are corrected for the cut relative to the background at the
+    # window border (the minimum sits a few noise sigma below it).
+
+    def __init__(self, threshold=0.2, min_contrast=8, window_sigmas=4, window_min=16, subsampling=4):
+        self.threshold = threshold
+        self.min_contrast = min_contrast        #counts, peak above the minimum for there to be a beam
+        self.window_sigmas = window_sigmas
+        self.window_min = window_min            #pixels, half width
+        self.subsampling = subsampling
+        self.center = None      #(x, y) on the last frame, None while the beam is lost
+        self.sigma = (0.0, 0.0)
+
+    def reset(self):
+        self.center = None
+
+    def measure(self, img: NDArray):
+        lo, hi, _, _ = cv2.minMaxLoc(img)
+        if hi - lo < self.min_contrast:
+            return None
+        level = lo + self.threshold * (hi - lo)
+        m = cv2.moments(cv2.subtract(img, level))
+        if not m["m00"] > 0:
+            return None
+        background = (img[0].mean() + img[-1].mean() + img[:, 0].mean() + img[:, -1].mean()) / 4
+        truncation = level_truncation((level - background) / max(hi - background, 1))
+        return (m["m10"] / m["m00"],
+                m["m01"] / m["m00"],
+                np.sqrt(m["mu20"] / m["m00"] / truncation),
+                np.sqrt(m["mu02"] / m["m00"] / truncation))
+
+    def track(self, img: NDArray):
+        # (x, y, sigma x, sigma y) in pixels, or None when there is no beam
+        h, w = img.shape
+        if self.center is None:
+            s = max(self.subsampling, w // 640)     #keep the search cheap on large frames
+            found = self.measure(cv2.resize(img, (w // s, h // s), interpolation=cv2.INTER_NEAREST))
+            if found is None:
+                return None
+            x, y, sx, sy = found
+            self.center = ((x + 0.5) * s - 0.5, (y + 0.5) * s - 0.5)
+            self.sigma = (sx * s, sy * s)
+
+        cx, cy = self.center
+        half_x = max(self.window_sigmas * self.sigma[0], self.window_min)
+        half_y = max(self.window_sigmas * self.sigma[1], self.window_min)
+        x0, x1 = max(int(cx - half_x), 0), min(int(cx + half_x) + 1, w)
+        y0, y1 = max(int(cy - half_y), 0), min(int(cy + half_y) + 1, h)
+        found = self.measure(img[y0:y1, x0:x1]) if x1 > x0 and y1 > y0 else None
+        if found is None:
+            self.center = None
+            return None
+        x, y, sx, sy = found
+        self.center = (x + x0, y + y0)
+        self.sigma = (sx, sy)
+        return self.center[0], self.center[1], sx, sy
+
+
+class Gaussian_Fitter():
+    # Persistent lmfit 2D gaussian fitter, keeps the model and coordinate grids between calls and
+    # warm starts each fit from the last accepted parameters, moved to the center of the moment estimate
+    # when one is given (after a rejected fit it starts over from the moment estimate, guess() otherwise).
+    # While locked on to the beam only a window of roi_sigmas around that center is fit at full
+    # resolution, after a rejected fit it drops back to the (subsampled) full frame. A warm start that
+    # hasn't converged within warm_nfev is abandoned for a cold fit of the same frame ("Fallback", its
+    # Iterations include the abandoned warm start).
+
+    def __init__(self, subsampling=2, max_nfev=5000, min_rsquared=0.5, use_roi=True, roi_sigmas=4, roi_min=16, warm_nfev=200):
+        self.subsampling = subsampling
+        self.max_nfev = max_nfev
+        self.warm_nfev = warm_nfev
+        self.min_rsquared = min_rsquared
+        self.use_roi = use_roi
+        self.roi_sigmas = roi_sigmas
+        self.roi_min = roi_min
+        self.gaussian = lmfit.models.Gaussian2dModel()
+        self.model = self.gaussian + lmfit.models.ConstantModel()     #camera dark level offset
+        self.grids = {}
+        self.params = None
+
+    def getGrid(self, shape, step):
+        #Local pixel coordinates for a (sub-sampled) block of the given shape
+        try:
+            return self.grids[(shape, step)]
+        except KeyError:
+            if len(self.grids) > 16:
+                self.grids.clear()      #window sizes change with the beam, don't keep stale ones around
+            x, y = np.meshgrid(np.arange(shape[1], dtype=float) * step, np.arange(shape[0], dtype=float) * step)
+            self.grids[(shape, step)] = (x, y)
+            return x, y
+
+    def getWindow(self, shape, center_x, center_y):
+        #(y0, y1, x0, x1) around the center with the last accepted widths, None when a full frame fit is needed
+        if not self.use_roi or self.params is None:
+            return None
+        half_x = 8 * np.ceil(max(self.roi_sigmas * abs(self.params["sigmax"].value), self.roi_min) / 8)     #steps of 8 keep the grid cache small
+        half_y = 8 * np.ceil(max(self.roi_sigmas * abs(self.params["sigmay"].value), self.roi_min) / 8)
+        x0 = int(max(center_x - half_x, 0))
+        x1 = int(min(center_x + half_x + 1, shape[1]))
+        y0 = int(max(center_y - half_y, 0))
+        y1 = int(min(center_y + half_y + 1, shape[0]))
+        if (x1 - x0) < self.roi_min or (y1 - y0) < self.roi_min:
+            return None
+        return y0, y1, x0, x1
+
+    def reset(self):
+        self.params = None
+
+    def fit(self, img: NDArray, estimate=None):
+        warm = self.params is not None
+        if warm and estimate is not None:
+            center_x, center_y = estimate["Center X"], estimate["Center Y"]    #the beam may have moved since
+        elif warm:
+            center_x, center_y = self.params["centerx"].value, self.params["centery"].value
+        window = self.getWindow(img.shape, center_x, center_y) if warm else None
+        if window is None:
+            step = self.subsampling
+            x0, y0 = 0, 0
+            z = img[::step, ::step]
+        else:
+            step = 1
+            y0, y1, x0, x1 = window
+            z = img[y0:y1, x0:x1]
+        x, y = self.getGrid(z.shape, step)
+
+        if warm:
+            params = self.params.copy()
+            params["centerx"].value = center_x - x0
+            params["centery"].value = center_y - y0
+        elif estimate is not None:
+            #Cold start from the moment estimate, much closer than guess() for small beams on large sensors
+            params = self.model.make_params(amplitude=estimate["Amplitude"] * 2 * np.pi * estimate["Sigma X"] * estimate["Sigma Y"],
+                                            centerx=estimate["Center X"], centery=estimate["Center Y"],
+                                            sigmax=estimate["Sigma X"], sigmay=estimate["Sigma Y"],
+                                            c=estimate["Background"])
+        else:
+            params = self.model.make_params(c=np.median(z))
+            params.update(self.gaussian.guess(z.ravel(), x.ravel(), y.ravel()))
+        max_nfev = self.warm_nfev if warm else self.max_nfev
+        result = self.model.fit(z, x=x, y=y, calc_covar=False, params=params, max_nfev=max_nfev)
+        converged = result.nfev < max_nfev
+        if warm and not converged:
+            self.params = None
+            accepted, results = self.fit(img, estimate)
+            results["Iterations"] += result.nfev
+            results["Start"] = "Fallback"
+            return accepted, results
+
+        #Back to sensor coordinates
+        result.params["centerx"].value += x0
+        result.params["centery"].value += y0
+        center_x = result.params["centerx"].value
+        center_y = result.params["centery"].value
+        accepted = result.rsquared > self.min_rsquared and converged and in_range(center_x, center_y, img.shape)
+
+        results = {"Center X": center_x,
+                   "Center Y": center_y,
+                   "Sigma X": result.params["sigmax"].value,
+                   "Sigma Y": result.params["sigmay"].value,
+                   "R^2": result.rsquared,
+                   "Iterations": result.nfev,
+                   "Start": "Warm" if warm else "Cold",
+                   "Window": "Full" if window is None else f"{z.shape[1]}x{z.shape[0]}"}
+
+        self.params = result.params if accepted else None
+        return accepted, results
+
+
+def gaussian_1d(p: NDArray, x: NDArray):
+    amplitude, center, sigma, offset = p
+    return amplitude * np.exp(-0.5 * ((x - center) / sigma) ** 2) + offset
+
+
+def gaussian_1d_jac(p: NDArray, x: NDArray):
+    # Analytic jacobian of gaussian_1d w.r.t. (amplitude, center, sigma, offset)
+    amplitude, center, sigma, offset = p
+    u = (x - center) / sigma
+    e = np.exp(-0.5 * u * u)
+    jac = np.empty((x.size, 4))
+    jac[:, 0] = e
+    jac[:, 1] = amplitude * e * u / sigma
+    jac[:, 2] = amplitude * e * u * u / sigma
+    jac[:, 3] = 1
+    return jac
+
+
+class Separable_Fitter():
+    # Fits 1D gaussian + offset models to the column and row sums of the image, O(W+H) per iteration
+    # instead of O(W*H). Same interface and results as Gaussian_Fitter, minus the angle information.
+
+    def __init__(self, max_nfev=500, min_rsquared=0.5):
+        self.max_nfev = max_nfev
+        self.min_rsquared = min_rsquared
+        self.grids = {}
+        self.params = None
+
+    def getGrid(self, size):
+        try:
+            return self.grids[size]
+        except KeyError:
+            self.grids[size] = np.arange(size, dtype=float)
+            return self.grids[size]
+
+    def reset(self):
+        self.params = None
+
+    def fitProfile(self, profile: NDArray, p0):
+        x = self.getGrid(profile.size)
+        residual = lambda p: gaussian_1d(p, x) - profile
+        jac = lambda p: gaussian_1d_jac(p, x)
+        result = least_squares(residual, p0, jac=jac, method="lm", max_nfev=self.max_nfev)
+        ss_res = np.sum(result.fun ** 2)
+        ss_tot = np.sum((profile - np.mean(profile)) ** 2)
+        rsquared = 1 - ss_res / ss_tot if ss_tot > 0 else 0.0
+        return result, rsquared
+
+    def startParams(self, profile: NDArray, center=None, sigma=None):
+        offset = np.median(np.concatenate((profile[:profile.size // 10 + 1], profile[-(profile.size // 10 + 1):])))
+        if center is None:
+            center = np.argmax(profile)
+        if sigma is None:
+            above = np.count_nonzero(profile > (offset + np.max(profile)) / 2)     #FWHM in pixels
+            sigma = max(above, 1) / 2.355
+        return np.array([np.max(profile) - offset, center, sigma, offset])
+
+    def fit(self, img: NDArray, estimate=None):
+        profile_x = img.sum(axis=0)
+        profile_y = img.sum(axis=1)
+
+        warm = self.params is not None
+        if warm:
+            p0_x, p0_y = (p.copy() for p in self.params)
+            if estimate is not None:
+                p0_x[1], p0_y[1] = estimate["Center X"], estimate["Center Y"]     #the beam may have moved since
+        elif estimate is not None:
+            p0_x = self.startParams(profile_x, estimate["Center X"], estimate["Sigma X"])
+            p0_y = self.startParams(profile_y, estimate["Center Y"], estimate["Sigma Y"])
+        else:
+            p0_x = self.startParams(profile_x)
+            p0_y = self.startParams(profile_y)
+
+        result_x, rsquared_x = self.fitProfile(profile_x, p0_x)
+        result_y, rsquared_y = self.fitProfile(profile_y, p0_y)
+
+        center_x, center_y = result_x.x[1], result_y.x[1]
+        nfev = result_x.nfev + result_y.nfev
+        rsquared = min(rsquared_x, rsquared_y)
+        accepted = result_x.success and result_y.success and rsquared > self.min_rsquared and in_range(center_x, center_y, img.shape)
+
+        results = {"Center X": center_x,
+                   "Center Y": center_y,
+                   "Sigma X": abs(result_x.x[2]),
+                   "Sigma Y": abs(result_y.x[2]),
+                   "R^2": rsquared,
+                   "Iterations": nfev,
+                   "Start": "Warm" if warm else "Cold",
+                   "Window": "Profiles"}
+
+        self.params = (result_x.x, result_y.x) if accepted else None
+        return accepted, results
+
+
+class Spot_Fitter():
+    # 2D gaussian + offset fits of several spots (from detect_spots) at once, each in a window of roi_sigmas
+    # around its moment estimate. A batched Levenberg-Marquardt: every iteration evaluates the model and the
+    # analytic jacobian for the pixels of all windows in one vectorised pass, then solves the 6x6 normal
+    # equations of all spots together, each spot with its own damping and acceptance. Windows are sampled
+    # at every step-th pixel, about samples_per_sigma per sigma, so a large spot costs no more than a small
+    # one. No warm start, the moment estimate of each spot is already close and spots may come and go
+    # between updates.
+
+    PARAMS = 6      #amplitude, center x, center y, sigma x, sigma y, offset
+
+    def __init__(self, max_iterations=50, min_rsquared=0.5, roi_sigmas=4, roi_min=8, samples_per_sigma=4, tolerance=1e-6):
+        self.max_iterations = max_iterations
+        self.min_rsquared = min_rsquared
+        self.roi_sigmas = roi_sigmas
+        self.roi_min = roi_min
+        self.samples_per_sigma = samples_per_sigma
+        self.tolerance = tolerance      #relative cost change at which a spot has converged
+
+    def getWindow(self, spot, shape):
+        half_x = max(self.roi_sigmas * spot["Sigma X"], self.roi_min)
+        half_y = max(self.roi_sigmas * spot["Sigma Y"], self.roi_min)
+        x0 = int(max(spot["Center X"] - half_x, 0))
+        x1 = int(min(spot["Center X"] + half_x + 1, shape[1]))
+        y0 = int(max(spot["Center Y"] - half_y, 0))
+        y1 = int(min(spot["Center Y"] + half_y + 1, shape[0]))
+        return y0, y1, x0, x1
+
+    def evaluate(self, p, owner, x, y, z):
+        # residuals and jacobian rows (pixels x 6) of every pixel under its own spot's parameters
+        amplitude, center_x, center_y, sigma_x, sigma_y, offset = p[owner].T
+        u = (x - center_x) / sigma_x
+        v = (y - center_y) / sigma_y
+        e = np.exp(-0.5 * (u * u + v * v))
+        ae = amplitude * e
+        J = np.column_stack((e, ae * u / sigma_x, ae * v / sigma_y, ae * u * u / sigma_x, ae * v * v / sigma_y, np.ones_like(e)))
+        return ae + offset - z, J
+
+    def fit(self, img: NDArray, spots):
+        # [(accepted, results)] in the order of spots
+        if len(spots) == 0:
+            return []
+        xs, ys, zs, windows, p0 = [], [], [], [], []
+        for spot in spots:
+            y0, y1, x0, x1 = window = self.getWindow(spot, img.shape)
+            step = max(int(min(spot["Sigma X"], spot["Sigma Y"]) / self.samples_per_sigma), 1)
+            y, x = np.mgrid[y0:y1:step, x0:x1:step]
+            xs.append(x.ravel())
+            ys.append(y.ravel())
+            zs.append(img[y0:y1:step, x0:x1:step].ravel())
+            windows.append(window)
+            p0.append([spot["Amplitude"], spot["Center X"], spot["Center Y"], spot["Sigma X"], spot["Sigma Y"], spot["Background"]])
+        sizes = np.array([len(z) for z in zs])
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))     #windows are contiguous, sums per spot with reduceat
+        x = np.concatenate(xs).astype(float)
+        y = np.concatenate(ys).astype(float)
+        z = np.concatenate(zs).astype(float)
+        owner = np.repeat(np.arange(len(spots)), sizes)
+
+        p = np.array(p0, dtype=float)
+        r, J = self.evaluate(p, owner, x, y, z)
+        cost = np.add.reduceat(r * r, starts)
+        damping = np.full(len(spots), 1e-3)
+        active = np.ones(len(spots), dtype=bool)
+        iterations = 0
+        while active.any() and iterations < self.max_iterations:
+            iterations += 1
+            JTJ = np.add.reduceat(J[:, :, None] * J[:, None, :], starts)
+            JTr = np.add.reduceat(J * r[:, None], starts)
+            diagonal = np.einsum("kii->ki", JTJ)
+            A = JTJ + (damping[:, None] * np.maximum(diagonal, 1e-12))[:, :, None] * np.eye(self.PARAMS)
+            try:
+                delta = np.linalg.solve(A, -JTr[:, :, None])[:, :, 0]
+            except np.linalg.LinAlgError:
+                break
+            trial = np.where(active[:, None], p + delta, p)
+            trial_r, trial_J = self.evaluate(trial, owner, x, y, z)
+            trial_cost = np.add.reduceat(trial_r * trial_r, starts)
+            better = active & (trial_cost < cost)
+            converged = better & ((cost - trial_cost) <= self.tolerance * cost)
+            p[better] = trial[better]
+            pixels = better[owner]
+            r[pixels] = trial_r[pixels]
+            J[pixels] = trial_J[pixels]
+            cost = np.where(better, trial_cost, cost)
+            damping = np.where(better, damping / 3, damping * 2)
+            active &= ~converged & (damping < 1e10)
+
+        ss_tot = np.add.reduceat((z - (np.add.reduceat(z, starts) / sizes)[owner]) ** 2, starts)
+        fits = []
+        for k, (_, center_x, center_y, sigma_x, sigma_y, _) in enumerate(p):
+            rsquared = 1 - cost[k] / ss_tot[k] if ss_tot[k] > 0 else 0.0
+            y0, y1, x0, x1 = windows[k]
+            accepted = rsquared > self.min_rsquared and in_range(center_x, center_y, img.shape)
+            fits.append((accepted, {"Center X": center_x,
+                                    "Center Y": center_y,
+                                    "Sigma X": abs(sigma_x),
+                                    "Sigma Y": abs(sigma_y),
+                                    "R^2": rsquared,
+                                    "Iterations": iterations,
+                                    "Window": f"{x1 - x0}x{y1 - y0}"}))
+        return fits
+
+
+FIT_ENGINES = {"2D Fit": Gaussian_Fitter, "Separable Fit": Separable_Fitter}
+_worker_fitters = {}
+
+
+def _fit_worker(shm_name, shape, dtype, key, engine, estimate, state):
+    # Runs in the pool processes, each keeps a fitter per camera and engine for its cached grids. The warm
+    # start comes with the job (state, see Pool_Fitter) and goes back with the result, so consecutive fits
+    # of a camera continue from each other whichever process runs them.
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        img = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        try:
+            fitter = _worker_fitters[(key, engine)]
+        except KeyError:
+            fitter = _worker_fitters[(key, engine)] = FIT_ENGINES[engine]()
+        fitter.params = state
+        try:
+            accepted, results = fitter.fit(img, estimate)
+        except Exception:
+            del _worker_fitters[(key, engine)]
+            raise
+        del img
+        return accepted, results, fitter.params
+    finally:
+        shm.close()
+
+
+class Fit_Pool():
+    # Process pool shared by all cameras so the fits don't hold the GIL in the acquisition/GUI process
+
+    instance = None
+    lock = threading.Lock()     #the stats threads of several cameras start together
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    @classmethod
+    def get(cls, max_workers=None):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = Fit_Pool(max_workers)
+            return cls.instance
+
+    @classmethod
+    def restart(cls, broken):
+        # Replace a pool that lost a worker (every submit to it raises BrokenProcessPool), once for all cameras
+        with cls.lock:
+            if cls.instance is broken:
+                logging.warning("Fit pool worker died, restarting the pool.")
+                broken.executor.shutdown(wait=False, cancel_futures=True)
+                cls.instance = Fit_Pool(broken.max_workers)
+            return cls.instance
+
+    @classmethod
+    def shutdown(cls):
+        with cls.lock:
+            if cls.instance is not None:
+                cls.instance.executor.shutdown(wait=False, cancel_futures=True)
+                cls.instance = None
+
+
+class Pool_Fitter():
+    # Per camera client of the Fit_Pool. Frames are handed over through a fixed set of shared memory
+    # slots, one per fit allowed in flight, when all are busy the new fit is dropped instead of queued.
+    # Keeps the warm start state of each engine and sends it with every fit. A fit that raises in the
+    # worker is logged and reported as rejected.
+
+    def __init__(self, key, shape, max_workers=None, max_in_flight=1):
+        self.key = key
+        self.shape = shape
+        self.pool = Fit_Pool.get(max_workers)
+        self.slots = [shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(float).itemsize) for _ in range(max_in_flight)]
+        self.free = list(range(max_in_flight))
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.states = {}        #engine: warm start params of the last fit
+        self.generation = 0     #results of fits submitted before a reset don't restore their state
+        self.futures = set()    #fits in flight, the workers read their slot until they are done
+        self.closed = False
+
+    def reset(self):
+        with self.lock:
+            self.states.clear()
+            self.generation += 1
+
+    def inFlight(self):
+        return len(self.slots) - len(self.free)
+
+    def submit(self, img: NDArray, engine, estimate, callback):
+        # callback(accepted, results) is called from a pool management thread
+        with self.lock:
+            if len(self.free) == 0:
+                self.dropped += 1
+                return False
+            slot = self.free.pop()
+            state = self.states.get(engine)
+            generation = self.generation
+        shm = self.slots[slot]
+        np.copyto(np.ndarray(self.shape, dtype=float, buffer=shm.buf), img)
+
+        def done(future):
+            #the callback is called under the lock, so it can't run any more once close() has returned
+            with self.lock:
+                self.free.append(slot)
+                self.futures.discard(future)
+                if self.closed or future.cancelled():
+                    return
+                error = future.exception()
+                if error is not None:
+                    logging.error(f"Error fitting camera {self.key} ({engine}): {type(error)} {error}")
+                    self.states.pop(engine, None)
+                    callback(False, {})
+                    return
+                accepted, results, state = future.result()
+                if generation == self.generation:
+                    self.states[engine] = state
+                callback(accepted, results)
+
+        try:
+            future = self.pool.executor.submit(_fit_worker, shm.name, self.shape, float, self.key, engine, estimate, state)
+        except BrokenProcessPool:
+            #a worker died, the fits submitted after it would all fail, the next one goes to a new pool
+            self.pool = Fit_Pool.restart(self.pool)
+            with self.lock:
+                self.free.append(slot)
+                self.dropped += 1
+            return False
+        except RuntimeError:
+            #pool already shut down
+            with self.lock:
+                self.free.append(slot)
+                self.dropped += 1
+            return False
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(done)
+        return True
+
+    def close(self, timeout=10.0):
+        # Only unlink the slots once no worker can still open them
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.cancel()
+        _, running = wait(futures, timeout=timeout)
+        if running:
+            logging.warning(f"Fits of camera {self.key} still running after {timeout} s, closing anyway.")
+        with self.lock:
+            self.closed = True      #a future is done before its callbacks run, wait for those too
+        for shm in self.slots:
+            shm.close()
+            shm.unlink()
+        self.slots = []
@@ -0,0 +1,154 @@
+import sys
+import json
+import signal
+import logging
+from time import time
+
+import numpy as np
+
+from PyQt6.QtCore import QCoreApplication, QObject, QTimer, pyqtSignal, pyqtSlot
+
+from camera import USB_Camera, Camera_Search
+from fitting import Fit_Pool
+from util import RunningThreads, Sig
+
+
+def json_default(value):
+    # numpy scalars/arrays in the stats dicts
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+class Headless_Runner(QObject):
+    # Runs USB_Camera/Camera_Stats for the selected cameras without any widgets and writes every stats
+    # update as a JSON line: {"time": ..., "camera": idx, "source": ..., "stats": {...}}
+    closing_sig = pyqtSignal()
+
+    def __init__(self, args, virtual_sources=[], capture_format=None):
+        QObject.__init__(self)
+        self.args = args
+        self.virtual_sources = virtual_sources
+        self.capture_format = capture_format    #see camera.CAPTURE_DEFAULTS
+        self.running_threads = RunningThreads()
+        self.active_cams = {}
+        self.ready_count = 0
+        self.closing = False
+        self.done = False
+        self.lines = 0
+
+        if args.output == "-":
+            self.output = sys.stdout
+        else:
+            self.output = open(args.output, "a")
+
+    def start(self):
+        signal.signal(signal.SIGINT, lambda *_: self.stop())
+        #Python only runs the signal handler when it gets control back from the Qt event loop
+        self.signal_timer = QTimer()
+        self.signal_timer.timeout.connect(lambda: None)
+        self.signal_timer.start(200)
+        if self.args.duration > 0:
+            QTimer.singleShot(int(self.args.duration * 1000), self.stop)
+
+        if self.args.cameras:
+            self.initCams([int(c) if c.isdigit() else c for c in self.args.cameras])
+        else:
+            logging.info("Searching for cameras...")
+            self.cam_search = Camera_Search([], self.virtual_sources, self.args.max_index, self.args.camera_cache, self.args.rescan)
+            self.cam_search.result.connect(self.initCams)
+            self.cam_search.q_thread.start()
+
+    @pyqtSlot(list)
+    def initCams(self, cam_list):
+        if len(cam_list) == 0:
+            logging.error("No cameras found.")
+            self.quit()
+            return
+        for idx, cam in enumerate(cam_list):
+            self.initCam(idx, cam)
+
+    def initCam(self, idx, cam):
+        logging.info(f"Starting camera #{cam}...")
+        active_cam = USB_Camera(camera_index=idx, save_images=self.args.record, save_path=self.args.save_path, fit_workers=self.args.fit_workers, source=cam)
+        active_cam.realtime = not self.args.replay_fast
+        active_cam.save_format = self.args.record_format
+        active_cam.fit_engine = self.args.fit_engine
+        active_cam.stats_interval = self.args.stats_interval
+        active_cam.display = False
+        active_cam.track = not self.args.no_tracking
+        active_cam.spectrum_segment = self.args.spectrum_segment
+        active_cam.spectrum_bands = tuple(self.args.spectrum_bands)
+        active_cam.multi_spot = self.args.multi_spot
+        active_cam.max_spots = self.args.max_spots
+        if self.capture_format is not None:
+            active_cam.capture_format = dict(self.capture_format)
+        self.running_threads.watchThread(active_cam.q_thread)
+        active_cam.stats_thread_sig.connect(self.running_threads.watchThread)     #stats threads have to be done before quitting too
+        active_cam.q_thread.start()
+
+        active_cam.ready_sig.connect(self.camReady)
+        active_cam.stats_sig.connect(self.writeStats)
+        self.closing_sig.connect(active_cam.shutdown)
+
+        start_sig = Sig("start")
+        start_sig.connect(active_cam.init)
+        self.active_cams[idx] = {"name": cam, "cam": active_cam, "start_sig": start_sig}
+        start_sig.emit(0)
+
+    @pyqtSlot(int, bool)
+    def camReady(self, cam_idx, ready):
+        if ready:
+            self.ready_count += 1
+            active_cam : USB_Camera = self.active_cams[cam_idx]["cam"]
+            logging.info(f"Camera {cam_idx} running: {active_cam.getTypeString()} #{active_cam.serial} {active_cam.negotiated}")
+        else:
+            logging.warning(f"Could not start camera {cam_idx}.")
+            self.active_cams[cam_idx]["failed"] = True
+            if all("failed" in c for c in self.active_cams.values()):
+                self.stop()
+
+    @pyqtSlot(int, dict, dict)
+    def writeStats(self, cam_idx : int, stats : dict, plots : dict):
+        if self.done:
+            return
+        #stats is the snapshot Camera_Stats emitted, not the dict its thread keeps updating
+        line = {"time": time(), "camera": cam_idx, "source": str(self.active_cams[cam_idx]["name"]), "stats": stats}
+        self.output.write(json.dumps(line, default=json_default) + "\n")
+        self.output.flush()
+        self.lines += 1
+
+    def stop(self):
+        if self.closing:
+            return
+        self.closing = True
+        logging.info("Shutting down...")
+        if len(self.running_threads) == 0:
+            self.quit()
+            return
+        self.running_threads.allDone.connect(self.quit)
+        self.closing_sig.emit()
+        QTimer.singleShot(10000, self.forceQuit)
+
+    @pyqtSlot()
+    def forceQuit(self):
+        bad_threads = [i.objectName() for i in self.running_threads.active_threads]
+        logging.warning("%s thread(s) unresponsive. Force terminating." % bad_threads)
+        for i in self.running_threads.active_threads:
+            i.terminate()
+        self.quit()
+
+    @pyqtSlot()
+    def quit(self):
+        if self.done:
+            return
+        self.done = True
+        for thread in list(self.running_threads.active_threads):
+            thread.wait(1000)       #only left over after forceQuit
+        logging.info(f"Done, {self.lines} stats updates written.")
+        Fit_Pool.shutdown()
+        if self.output is not sys.stdout:
+            self.output.close()
+        QCoreApplication.quit()
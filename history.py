@@ -0,0 +1,226 @@
+import warnings
+import threading
+from time import perf_counter
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+class Ring_Buffer():
+    # Fixed capacity numpy ring buffer, the oldest values are overwritten once it is full
+
+    def __init__(self, capacity: int, dtype=float, width=None):
+        self.capacity = capacity
+        self.data = np.zeros((capacity,) if width is None else (capacity, width), dtype=dtype)
+        self.count = 0      #total number of values appended since the last clear
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, value):
+        self.data[self.count % self.capacity] = value
+        self.count += 1
+
+    def extend(self, values: NDArray):
+        # Append an array of values at once, only the last capacity of them are kept
+        n = len(values)
+        values = values[-self.capacity:]
+        i = (self.count + n - len(values)) % self.capacity
+        first = min(len(values), self.capacity - i)
+        self.data[i:i + first] = values[:first]
+        self.data[:len(values) - first] = values[first:]
+        self.count += n
+
+    def clear(self):
+        self.count = 0
+
+    def valid(self) -> NDArray:
+        # Unordered view of the stored values, fine for aggregates (min/max/mean)
+        return self.data[:len(self)]
+
+    def values(self) -> NDArray:
+        # Stored values oldest to newest (a copy once the buffer has wrapped)
+        if self.count <= self.capacity:
+            return self.data[:self.count]
+        i = self.count % self.capacity
+        return np.concatenate((self.data[i:], self.data[:i]))
+
+
+class Frame_History():
+    # Per camera frame history for one stats interval, preallocated and reused between intervals:
+    # per-frame scalars go into ring buffers and the frames are summed into an integer accumulator.
+
+    def __init__(self, shape, capacity=1024):
+        self.shape = shape
+        self.minimum = Ring_Buffer(capacity, np.float32)
+        self.maximum = Ring_Buffer(capacity, np.float32)
+        self.mean = Ring_Buffer(capacity, np.float32)
+        self.timestamps = Ring_Buffer(capacity, np.float64)     #seconds, capture time of each frame
+        self.centroids = Ring_Buffer(capacity, np.float64, 2)   #per-frame beam centroid (x, y), NaN while lost
+        self.sums = np.zeros(shape, dtype=np.uint32)    #room for 16M 8-bit frames
+        self.sumsq = None       #sum of squares for the noise map, only allocated when enabled
+        self.square = None
+        self.frame_count = 0
+        self.noise_frames = 0   #frames in sumsq, fewer than frame_count if the noise map was enabled mid-interval
+        self.start_time = perf_counter()
+        self.end_time = self.start_time
+
+    def elapsed(self):
+        return self.end_time - self.start_time
+
+    def setTrackNoise(self, enabled):
+        if enabled and self.sumsq is None:
+            self.sumsq = np.zeros(self.shape, dtype=np.uint64)
+            self.square = np.zeros(self.shape, dtype=np.uint16)
+            self.noise_frames = 0
+        elif not enabled:
+            self.sumsq = None
+            self.square = None
+
+    def add(self, img: NDArray, timestamp=None, centroid=None):
+        if timestamp is not None:
+            self.timestamps.append(timestamp)
+        if centroid is not None:
+            self.centroids.append(centroid)
+        self.minimum.append(img.min())
+        self.maximum.append(img.max())
+        self.mean.append(img.mean())
+        np.add(self.sums, img, out=self.sums)
+        if self.sumsq is not None:
+            np.multiply(img, img, out=self.square, dtype=np.uint16)
+            np.add(self.sumsq, self.square, out=self.sumsq)
+            self.noise_frames += 1
+        self.frame_count += 1
+
+    def reset(self):
+        self.minimum.clear()
+        self.maximum.clear()
+        self.mean.clear()
+        self.timestamps.clear()
+        self.centroids.clear()
+        self.sums.fill(0)
+        if self.sumsq is not None:
+            self.sumsq.fill(0)
+        self.frame_count = 0
+        self.noise_frames = 0
+
+
+class Double_Buffered_History():
+    # Two Frame_History buffers shared between the capture and stats threads. The capture thread always
+    # adds to the active buffer, the stats thread swaps in the spare one and then owns the filled buffer
+    # until its next swap. The lock only ever guards a single add or the buffer exchange, so frames are
+    # never skipped because the stats thread is busy.
+
+    def __init__(self, shape, capacity=1024):
+        self.buffers = (Frame_History(shape, capacity), Frame_History(shape, capacity))
+        self.active = self.buffers[0]
+        self.lock = threading.Lock()
+        self.discarded = 0      #frames that could not be accumulated (e.g. size changed)
+
+    def add(self, img: NDArray, timestamp=None, centroid=None):
+        with self.lock:
+            if img.shape != self.active.shape:
+                self.discarded += 1
+                return False
+            self.active.add(img, timestamp, centroid)
+        return True
+
+    def setTrackNoise(self, enabled):
+        with self.lock:
+            for buffer in self.buffers:
+                buffer.setTrackNoise(enabled)
+
+    def swap(self) -> Frame_History:
+        spare = self.buffers[1] if self.active is self.buffers[0] else self.buffers[0]
+        spare.reset()       #returned by the previous swap, done with it by now
+        with self.lock:
+            filled = self.active
+            self.active = spare
+            filled.end_time = spare.start_time = perf_counter()
+        return filled
+
+
+class Drift_History():
+    # Long-term history of the fit fields for the drift plot, in a fixed size array: each row has the time and
+    # the mean/min/max of every field over `stride` samples. When the array is full adjacent rows are merged
+    # (halving the time resolution and doubling the stride), so memory stays at capacity rows however long
+    # the session runs and the extremes are never lost. NaN where there was no fit.
+
+    def __init__(self, fields=("Center X", "Center Y", "Sigma X", "Sigma Y"), capacity=4096):
+        self.fields = list(fields)
+        self.capacity = capacity - capacity % 2
+        self.times = np.zeros(self.capacity)
+        self.mean = np.zeros((self.capacity, len(self.fields)))
+        self.minimum = np.zeros((self.capacity, len(self.fields)))
+        self.maximum = np.zeros((self.capacity, len(self.fields)))
+        self.count = 0      #rows in use
+        self.stride = 1     #samples per row
+        self.pending = []   #(time, values) of the samples for the next row
+
+    def nbytes(self):
+        return self.times.nbytes + self.mean.nbytes + self.minimum.nbytes + self.maximum.nbytes
+
+    def add(self, timestamp, values: dict):
+        # values: {field: number or "" when there is no fit}
+        if self.count == self.capacity:
+            #before the next row is collected, so it holds as many samples as the merged ones
+            self.compact()
+        self.pending.append((timestamp, [v if isinstance(v, (int, float, np.number)) else np.nan for v in (values.get(f) for f in self.fields)]))
+        if len(self.pending) < self.stride:
+            return
+        times, rows = zip(*self.pending)
+        rows = np.array(rows, dtype=float)
+        self.pending = []
+        i = self.count
+        self.times[i] = np.mean(times)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)     #all NaN
+            self.mean[i] = np.nanmean(rows, axis=0)
+        self.minimum[i] = np.fmin.reduce(rows, axis=0)
+        self.maximum[i] = np.fmax.reduce(rows, axis=0)
+        self.count += 1
+
+    def compact(self):
+        # Merge pairs of rows, frees the second half
+        half = self.count // 2
+        self.times[:half] = self.times[:2 * half].reshape(half, 2).mean(axis=1)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            self.mean[:half] = np.nanmean(self.mean[:2 * half].reshape(half, 2, -1), axis=1)
+        self.minimum[:half] = np.fmin(self.minimum[:2 * half:2], self.minimum[1:2 * half:2])
+        self.maximum[:half] = np.fmax(self.maximum[:2 * half:2], self.maximum[1:2 * half:2])
+        self.count = half
+        self.stride *= 2
+
+    def display(self, field, points=1000):
+        # Min/max decimation for plotting: (times, values) with the min and the max of each of at most `points`
+        # buckets, so spikes stay visible however many rows are drawn as one pixel
+        j = self.fields.index(field)
+        n = self.count
+        if n == 0:
+            return np.zeros(0), np.zeros(0)
+        k = -(-n // points)     #rows per bucket
+        pad = -n % k
+        times = np.concatenate((self.times[:n], np.full(pad, self.times[n - 1]))).reshape(-1, k)
+        low = np.concatenate((self.minimum[:n, j], np.full(pad, np.nan))).reshape(-1, k)
+        high = np.concatenate((self.maximum[:n, j], np.full(pad, np.nan))).reshape(-1, k)
+        return (np.repeat(times.mean(axis=1), 2),
+                np.column_stack((np.fmin.reduce(low, axis=1), np.fmax.reduce(high, axis=1))).reshape(-1))
+
+    def columns(self):
+        # {"Time": ..., "<field> Mean": ..., "<field> Min": ..., "<field> Max": ...} of the rows in use
+        n = self.count
+        result = {"Time": self.times[:n]}
+        for j, field in enumerate(self.fields):
+            result[f"{field} Mean"] = self.mean[:n, j]
+            result[f"{field} Min"] = self.minimum[:n, j]
+            result[f"{field} Max"] = self.maximum[:n, j]
+        return result
+
+    def export(self, file_name):
+        # CSV or NPZ by extension
+        columns = self.columns()
+        if file_name.lower().endswith(".npz"):
+            np.savez(file_name, stride=self.stride, **{k.replace(" ", "_"): v for k, v in columns.items()})
+        else:
+            np.savetxt(file_name, np.column_stack(list(columns.values())), delimiter=",", header=",".join(columns), comments="", fmt="%.6f")
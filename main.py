@@ -3,6 +3,9 @@ import logging
 import argparse
 import warnings
 from datetime import datetime
+from time import time
+from os import path
+from math import ceil, sqrt
 
 from PyQt6 import QtCore
 from PyQt6.QtWidgets import *
@@ -16,14 +19,24 @@ import pyqtgraph as pg
 from pyqtgraph.dockarea import Dock, DockArea
 
 from camera import USB_Camera, Camera_Search
+from discovery import DEFAULT_CACHE
+from fitting import Fit_Pool, FIT_ENGINES
+from analysis import band_rms
+from history import Drift_History
+from recorder import RECORD_FORMATS
+from sources import SYNTHETIC_PREFIX
 from util import *
 
+pg.setConfigOptions(imageAxisOrder='row-major')     #frames are (height, width) arrays end to end, no transposes
+
+FIT_ENGINE_NAMES = [*FIT_ENGINES, "Moments"]
+
 class Crosshair(pg.GraphicsObject):
     def __init__(self, image_view: pg.ImageView):
         super().__init__()
         self.image_view = image_view
-        self.img_shape = self.image_view.getImageItem().image.shape
-        self.origin = (self.img_shape[0]/2, self.img_shape[1]/2)
+        self.img_shape = self.image_view.getImageItem().image.shape     #(height, width), images are row-major
+        self.origin = (self.img_shape[1]/2, self.img_shape[0]/2)
         pen_dashed_white = pg.mkPen(color='w', width=2, style=Qt.PenStyle.DashLine)
 
         # Global crosshair
@@ -50,6 +63,11 @@ class Crosshair(pg.GraphicsObject):
         self.target_size = self.roi.size()
         self.image_view.addItem(self.roi)
 
+        # Markers of the spots in multi-spot mode, circles of 6 sigma and their numbers
+        self.spots = pg.ScatterPlotItem(pxMode=False, pen=pg.mkPen(color='m', width=2), brush=None)
+        self.image_view.addItem(self.spots)
+        self.spot_labels = []
+
         self.vert_plot = pg.PlotWidget(image_view.parentWidget(), labels={'right': 'Y-Axis Crossection Intensity'}, pen='b')
         self.vert_plot.hideAxis('bottom')
         self.vert_plot.hideAxis('left')
@@ -86,27 +104,29 @@ class Crosshair(pg.GraphicsObject):
         self.updatePlots(reset=True)
 
     def updatePlots(self, reset=False):
+        if not reset and not self.hor_plot.isVisible():
+            return      #profile plots turned off, or the camera's dock is hidden
         try:
             assert reset == False
             roi_size = self.roi.size()
             self.target_center = self.roi.pos()
             
-            y_range_vert = (int(max(self.target_center[1] - 0.5 * roi_size[1], 0)), int(min(self.target_center[1] + 0.5 * roi_size[1], self.img_shape[1])))
+            y_range_vert = (int(max(self.target_center[1] - 0.5 * roi_size[1], 0)), int(min(self.target_center[1] + 0.5 * roi_size[1], self.img_shape[0])))
             y_values_vert = np.array(range(*y_range_vert))
             vert_mu = self.target_center[1]
             vert_sigma = roi_size[1] / 6
 
-            x_range_hor = (int(max(self.target_center[0] - 0.5 * roi_size[0], 0)), int(min(self.target_center[0] + 0.5 * roi_size[0], self.img_shape[0])))
+            x_range_hor = (int(max(self.target_center[0] - 0.5 * roi_size[0], 0)), int(min(self.target_center[0] + 0.5 * roi_size[0], self.img_shape[1])))
             x_values_hor = np.array(range(*x_range_hor))
             hor_mu = self.target_center[0]
             hor_sigma = roi_size[0] / 6
 
-            vert_image_curve = self.image_view.image[int(hor_mu), y_range_vert[0]:y_range_vert[1]]
+            vert_image_curve = self.image_view.image[y_range_vert[0]:y_range_vert[1], int(hor_mu)]
             vert_gauss = stats.norm(vert_mu, vert_sigma).pdf(y_values_vert)
             vert_gaussian_curve = vert_image_curve.min() + ((vert_gauss / np.max(vert_gauss)) * vert_image_curve.max())
             x_range_vert = (vert_image_curve.min(), vert_image_curve.max())
         
-            hor_image_curve = self.image_view.image[x_range_hor[0]:x_range_hor[1], int(vert_mu)]
+            hor_image_curve = self.image_view.image[int(vert_mu), x_range_hor[0]:x_range_hor[1]]
             hor_gauss = stats.norm(hor_mu, hor_sigma).pdf(x_values_hor)
             hor_gaussian_curve = hor_image_curve.min() + ((hor_gauss / np.max(hor_gauss)) * hor_image_curve.max())
             y_range_hor = (hor_image_curve.max(), hor_image_curve.min())
@@ -164,7 +184,7 @@ class Crosshair(pg.GraphicsObject):
         self.circ_image.setRect(-(1/sigma_ratio)/2, -sigma_ratio/2, 1/sigma_ratio, sigma_ratio)
 
     def setTarget(self, pos, widths):
-        if 0 <= pos[0] < self.img_shape[0] and 0 <= pos[1] < self.img_shape[1]:
+        if 0 <= pos[0] < self.img_shape[1] and 0 <= pos[1] < self.img_shape[0]:
             if (self.origin[0] - 5 < pos[0] < self.origin[0] + 5) and (self.origin[1] - 5 < pos[1] < self.origin[1] + 5):
                 self.roi.setPen(self.pen_dot_green)
             else:
@@ -181,14 +201,121 @@ class Crosshair(pg.GraphicsObject):
         self.roi.setVisible(False)
         self.updatePlots(reset=True)
 
+    def setSpots(self, spots):
+        # spots: stats dicts with Center X/Y and Sigma X/Y, numbered in order
+        self.spots.setData(x=[s["Center X"] for s in spots], y=[s["Center Y"] for s in spots], size=[3 * (s["Sigma X"] + s["Sigma Y"]) for s in spots])
+        while len(self.spot_labels) < len(spots):
+            label = pg.TextItem(str(len(self.spot_labels) + 1), color='m', anchor=(0, 1))
+            self.image_view.addItem(label)
+            self.spot_labels.append(label)
+        for n, label in enumerate(self.spot_labels):
+            if n < len(spots):
+                label.setPos(spots[n]["Center X"] + 2 * spots[n]["Sigma X"], spots[n]["Center Y"] - 2 * spots[n]["Sigma Y"])
+            label.setVisible(n < len(spots))
+
+    def setPlotsVisible(self, visible):
+        for plot in (self.vert_plot, self.hor_plot, self.circ_widg):
+            plot.setVisible(visible)
+        if visible:
+            self.updatePlots(reset=not self.roi.isVisible())
+
+
+
+class Display_Scheduler(QObject):
+    # Redraws the camera views at a fixed rate instead of once per captured frame. Cameras are marked dirty
+    # when they have a new frame, each tick hands all dirty cameras to render in one pass, which draws the
+    # newest frame of each once, so the GUI does a bounded amount of work however fast the cameras capture.
+    
+    def __init__(self, render, rate=30):
+        super().__init__()
+        self.render = render
+        self.dirty = set()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.tick)
+        self.setRate(rate)
+        self.timer.start()
+
+    def setRate(self, rate):
+        self.timer.setInterval(max(int(1000 / rate), 1))
+
+    def markDirty(self, cam_idx):
+        self.dirty.add(cam_idx)
+
+    @pyqtSlot()
+    def tick(self):
+        dirty = self.dirty
+        self.dirty = set()
+        if dirty:
+            self.render(dirty)
+
+
+def parse_band(text):
+    try:
+        low, high = (float(v) for v in text.split("-"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected LOW-HIGH in Hz, got {text}")
+    return low, high
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Utility for acquiring images from a USB camera for laser alignment.")
+    parser.add_argument("--save-path", default="./", help="Folder for recorded frames")
+    parser.add_argument("--record-format", choices=RECORD_FORMATS, default="npy", help="Chunked NPY stacks, lossless FFV1 video or a PNG sequence")
+    parser.add_argument("--replay", nargs="+", default=[], metavar="PATH", help="Recordings (folders, NPY/raw stacks, image sequences or video files) to add as virtual cameras")
+    parser.add_argument("--synthetic", nargs="+", default=[], metavar="SPEC", help="Simulated beams to add as virtual cameras, e.g. synthetic:1920x1080@60,trajectory=jitter,noise=8 (options: frames, trajectory=static|circle|drift|jitter, sigma_x, sigma_y, angle, amplitude, background, noise, x0, y0, radius, dx, dy, seed, bank_mb)")
+    parser.add_argument("--replay-fast", action="store_true", help="Play recordings and synthetic sources back as fast as possible instead of at their original timing")
+    parser.add_argument("--max-index", type=int, default=10, help="Device indices to try when the devices can't be listed (non-Linux)")
+    parser.add_argument("--camera-cache", default=DEFAULT_CACHE, help="File the camera search caches the devices it found in (empty to disable)")
+    parser.add_argument("--rescan", action="store_true", help="Probe every camera again instead of using the cache")
+    parser.add_argument("--fourcc", default="", help="Requested pixel format, e.g. YUYV, GREY or MJPG (default: backend default)")
+    parser.add_argument("--resolution", default="", metavar="WxH", help="Requested capture size, e.g. 1280x720")
+    parser.add_argument("--fps", type=int, default=0, help="Requested capture frame rate")
+    parser.add_argument("--raw-y", action="store_true", help="Disable the backend's RGB conversion and take the Y plane of the raw frames")
+    parser.add_argument("--no-tracking", action="store_true", help="Don't track the beam centroid on every frame in the capture loop")
+    parser.add_argument("--spectrum-segment", type=int, default=256, help="Frames per segment of the pointing spectrum, the frequency resolution is the frame rate / segment")
+    parser.add_argument("--spectrum-bands", nargs="+", type=parse_band, default=[(0.1, 1), (1, 10), (10, 100)], metavar="LOW-HIGH", help="Frequency bands in Hz for the RMS pointing stability, e.g. 1-10 45-65")
+    parser.add_argument("--drift-points", type=int, default=4096, help="Rows kept per camera in the drift history, older rows are merged when it is full (104 bytes per row)")
+    parser.add_argument("--noise-window", type=int, default=300, help="Number of frames per update of the per-pixel noise (Variance/SNR) views")
+    parser.add_argument("--fit-workers", type=int, default=0, help="Run the gaussian fits in a pool of N worker processes shared by all cameras (default: fit in each camera's stats thread)")
+    parser.add_argument("--multi-spot", action="store_true", help="Detect and fit every spot in the frame (several beams, back-reflections) instead of a single beam")
+    parser.add_argument("--max-spots", type=int, default=8, help="Most spots reported per camera in multi-spot mode, brightest first")
+    parser.add_argument("--fit-engine", choices=FIT_ENGINE_NAMES, default="2D Fit", help="Gaussian fit used to refine the moment estimate")
+    parser.add_argument("--display-rate", type=float, default=30, help="Viewer refresh rate in Hz, independent of the camera frame rates")
+    parser.add_argument("--stats-interval", type=int, default=500, help="Milliseconds between stats updates")
+    parser.add_argument("--record", action="store_true", help="Start recording frames as soon as each camera starts")
+    parser.add_argument("--headless", action="store_true", help="Run without the viewer and write each stats update as a JSON line")
+    parser.add_argument("--cameras", nargs="+", default=None, metavar="CAMERA", help="Headless: device indices or virtual source specs to run (default: every camera found)")
+    parser.add_argument("--output", default="-", help="Headless: file to write the JSON lines to (default: stdout)")
+    parser.add_argument("--duration", type=float, default=0, help="Headless: stop after this many seconds (default: run until interrupted)")
+    return parser
+
+
+def parse_resolution(text):
+    try:
+        width, height = (int(v) for v in text.lower().split("x"))
+        return width, height
+    except (ValueError, AttributeError):
+        return 0, 0     #backend default
+
+
+def capture_format(args):
+    width, height = parse_resolution(args.resolution)
+    return {"fourcc": args.fourcc.upper(), "width": width, "height": height, "fps": args.fps, "raw_y": args.raw_y}
+
+
+def virtual_sources(args):
+    return list(args.replay) + [s if s.startswith(SYNTHETIC_PREFIX) else f"{SYNTHETIC_PREFIX}:{s}" for s in args.synthetic]
 
 
 class Viewer(QMainWindow):
-    save_opts = pyqtSignal(str)
+    save_opts = pyqtSignal(str, bool)
+    fit_opts = pyqtSignal(str)
+    spot_opts = pyqtSignal(bool, int)
+    noise_opts = pyqtSignal(int, int)
     logging_sig = pyqtSignal(str)
     closing_sig = pyqtSignal()
 
-    def __init__(self):
+    def __init__(self, args=None):
         super().__init__()
         self.running_threads = RunningThreads()
         self.closing_sig.connect(self.finished)
@@ -198,9 +325,16 @@ class Viewer(QMainWindow):
 
         self.active_cams = {}
 
-        parser = argparse.ArgumentParser(description="Utility for acquiring images from a USB camera for laser alignment.")      
-        self.args = parser.parse_args()
+        self.args = create_parser().parse_args() if args is None else args
+        self.save_path = self.args.save_path
+        self.virtual_sources = virtual_sources(self.args)
+        self.default_capture_format = capture_format(self.args)
+        self.capture_formats = {}   #per camera index, overrides the default
+        self.device_info = {}       #per device index, from the camera search
+        self.spectra = {}           #latest pointing spectrum (freqs, psd x, psd y) per camera
+        self.drifts = {}            #Drift_History per camera, kept after the camera stops for export
 
+        self.display_scheduler = Display_Scheduler(self.renderImages, self.args.display_rate)
         self.widgets = self.initUI()
 
     def initUI(self):
@@ -213,6 +347,8 @@ class Viewer(QMainWindow):
         self.dock_config = Dock("Configuration", size=(300, 450))
         self.dock_stats = Dock("Statistics", size=(300, 250))
         self.dock_console = Dock("Console", size=(800,100))
+        self.dock_spectrum = Dock("Pointing Spectrum", size=(800,100))
+        self.dock_drift = Dock("Drift", size=(800,100))
         self.dock_cam_placeholder = Dock("Cameras", size=(900,700)) #placeholder
 
         #Configuration
@@ -232,14 +368,26 @@ class Viewer(QMainWindow):
         self.createConsole()
         self.dock_console.addWidget(self.console_widget)
 
+        #Pointing spectrum
+        self.createSpectrum()
+        self.dock_spectrum.addWidget(self.spectrum_widget)
+
+        #Drift history
+        self.createDrift()
+        self.dock_drift.addWidget(self.drift_widget)
+
         self.dock_area.addDock(self.dock_config, 'left')
         self.dock_area.addDock(self.dock_stats, 'bottom', self.dock_config)
         self.dock_area.addDock(self.dock_console, 'right')
+        self.dock_area.addDock(self.dock_spectrum, 'above', self.dock_console)
+        self.dock_area.addDock(self.dock_drift, 'above', self.dock_console)
+        self.dock_console.raiseDock()
         self.dock_area.addDock(self.dock_cam_placeholder, 'top', self.dock_console)
 
         #Callbacks
         self.btn_search_for_cams.clicked.connect(self.searchForCams)
         self.btn_shutdown_all.clicked.connect(self.camShutdownAll)
+        self.btn_add_replay.clicked.connect(self.addReplay)
         #Finally, init cams
         self.searchForCams()
 
@@ -267,7 +415,7 @@ class Viewer(QMainWindow):
         self.camera_table.setSizePolicy(QSizePolicy.Policy.Fixed, QSizePolicy.Policy.Fixed)
         self.camera_table.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
         self.camera_table.setSelectionMode(QTableWidget.SelectionMode.SingleSelection)
-        self.camera_table.setColumnCount(4)
+        self.camera_table.setColumnCount(5)
         self.camera_table.horizontalHeader().setDefaultSectionSize(50)
         self.camera_table.horizontalHeader().setStretchLastSection(True)
         #self.camera_table.selectionModel().selectionChanged.connect(self.cameraSelChanged)
@@ -288,6 +436,12 @@ class Viewer(QMainWindow):
         item3 = QTableWidgetItem()
         item3.setText("Size") 
         self.camera_table.setHorizontalHeaderItem(3, item3)
+        self.camera_table.setColumnWidth(3, 70)
+
+        item4 = QTableWidgetItem()
+        item4.setText("Format")
+        self.camera_table.setHorizontalHeaderItem(4, item4)
+        self.camera_table.itemSelectionChanged.connect(self.loadCaptureFormat)
 
         self.layout_cameras.addWidget(self.camera_table)
 
@@ -310,9 +464,59 @@ class Viewer(QMainWindow):
         self.btn_search_for_cams.setFixedSize(QSize(111,24))
         self.camera_btn_layout.addWidget(self.btn_search_for_cams, 0, 0, Qt.AlignmentFlag.AlignCenter)
 
+        self.btn_add_replay = QPushButton(self.camera_buttons)
+        self.btn_add_replay.setObjectName(u"btn_add_replay")
+        self.btn_add_replay.setText("Add Replay...")
+        self.btn_add_replay.setFixedSize(QSize(111,24))
+        self.camera_btn_layout.addWidget(self.btn_add_replay, 1, 0, Qt.AlignmentFlag.AlignCenter)
+
         self.layout_cameras.addWidget(self.camera_buttons)
         self.verticalLayout.addWidget(self.groupBox_cameras)
 
+        #Capture Format
+        self.gb_capture = QGroupBox(self.config_widget)
+        self.gb_capture.setObjectName(u"gb_capture")
+        self.gb_capture.setTitle("Capture Format")
+        self.gb_capture.setToolTip("Requested format of the selected camera (all cameras when none is selected), applied when it is next started")
+        self.gb_capture.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
+
+        self.capture_layout = QGridLayout(self.gb_capture)
+        self.capture_layout.setObjectName(u"capture_layout")
+
+        self.capture_layout.addWidget(QLabel("Pixel Format"), 0, 0, Qt.AlignmentFlag.AlignLeft)
+        self.combo_fourcc = QComboBox(self.gb_capture)
+        self.combo_fourcc.setObjectName(u"combo_fourcc")
+        self.combo_fourcc.setEditable(True)
+        self.combo_fourcc.addItems(["Default", "YUYV", "GREY", "MJPG", "NV12"])
+        self.capture_layout.addWidget(self.combo_fourcc, 0, 1, Qt.AlignmentFlag.AlignLeft)
+
+        self.capture_layout.addWidget(QLabel("Resolution"), 1, 0, Qt.AlignmentFlag.AlignLeft)
+        self.combo_resolution = QComboBox(self.gb_capture)
+        self.combo_resolution.setObjectName(u"combo_resolution")
+        self.combo_resolution.setEditable(True)
+        self.combo_resolution.addItems(["Default", "640x480", "1280x720", "1920x1080", "3840x2160"])
+        self.capture_layout.addWidget(self.combo_resolution, 1, 1, Qt.AlignmentFlag.AlignLeft)
+
+        self.capture_layout.addWidget(QLabel("Frame Rate"), 2, 0, Qt.AlignmentFlag.AlignLeft)
+        self.spin_capture_fps = QSpinBox(self.gb_capture)
+        self.spin_capture_fps.setObjectName(u"spin_capture_fps")
+        self.spin_capture_fps.setRange(0, 1000)
+        self.spin_capture_fps.setSpecialValueText("Default")
+        self.capture_layout.addWidget(self.spin_capture_fps, 2, 1, Qt.AlignmentFlag.AlignLeft)
+
+        self.cb_raw_y = QCheckBox(self.gb_capture)
+        self.cb_raw_y.setObjectName(u"cb_raw_y")
+        self.cb_raw_y.setText("Raw Y (no RGB conversion)")
+        self.cb_raw_y.setToolTip("Take the luminance plane of the raw frames instead of having the backend decode to BGR")
+        self.capture_layout.addWidget(self.cb_raw_y, 3, 0, 1, 2, Qt.AlignmentFlag.AlignLeft)
+
+        self.showCaptureFormat(self.default_capture_format)
+        self.combo_fourcc.currentTextChanged.connect(self.storeCaptureFormat)
+        self.combo_resolution.currentTextChanged.connect(self.storeCaptureFormat)
+        self.spin_capture_fps.valueChanged.connect(self.storeCaptureFormat)
+        self.cb_raw_y.toggled.connect(self.storeCaptureFormat)
+        self.verticalLayout.addWidget(self.gb_capture)
+
         #Acqusition
         self.gb_acqusition = QGroupBox(self.config_widget)
         self.gb_acqusition.setObjectName(u"gb_acqusition")
@@ -328,24 +532,85 @@ class Viewer(QMainWindow):
         self.cb_auto_range.setChecked(False)
         self.acq_layout.addWidget(self.cb_auto_range, 0, 0, Qt.AlignmentFlag.AlignLeft)
 
+        self.cb_profile_plots = QCheckBox(self.gb_acqusition)
+        self.cb_profile_plots.setObjectName(u"cb_profile_plots")
+        self.cb_profile_plots.setText("Profile Plots")
+        self.cb_profile_plots.setChecked(True)
+        self.cb_profile_plots.setToolTip("Cross-section plots next to each camera view, turn off for more room when tiling many cameras")
+        self.cb_profile_plots.toggled.connect(self.setProfilePlots)
+        self.acq_layout.addWidget(self.cb_profile_plots, 0, 1, Qt.AlignmentFlag.AlignLeft)
+
         self.cb_auto_levels = QCheckBox(self.gb_acqusition)
         self.cb_auto_levels.setObjectName(u"cb_auto_levels")
         self.cb_auto_levels.setText("Auto Levels")
         self.cb_auto_levels.setChecked(True)
         self.acq_layout.addWidget(self.cb_auto_levels, 1, 0, Qt.AlignmentFlag.AlignLeft)
 
+        self.cb_track_crosshair = QCheckBox(self.gb_acqusition)
+        self.cb_track_crosshair.setObjectName(u"cb_track_crosshair")
+        self.cb_track_crosshair.setText("Track Crosshair")
+        self.cb_track_crosshair.setChecked(False)
+        self.cb_track_crosshair.setEnabled(not self.args.no_tracking)
+        self.cb_track_crosshair.setToolTip("Move the crosshair with the per-frame centroid at the display rate instead of with the fit of each stats update")
+        self.acq_layout.addWidget(self.cb_track_crosshair, 1, 1, Qt.AlignmentFlag.AlignLeft)
+
         self.cb_auto_hist = QCheckBox(self.gb_acqusition)
         self.cb_auto_hist.setObjectName(u"cb_auto_hist")
         self.cb_auto_hist.setText("Auto Histogram Range")
         self.cb_auto_hist.setChecked(True)
         self.acq_layout.addWidget(self.cb_auto_hist, 2, 0, Qt.AlignmentFlag.AlignLeft)
 
+        self.cb_multi_spot = QCheckBox(self.gb_acqusition)
+        self.cb_multi_spot.setObjectName(u"cb_multi_spot")
+        self.cb_multi_spot.setText("Multi-Spot")
+        self.cb_multi_spot.setChecked(self.args.multi_spot)
+        self.cb_multi_spot.setToolTip(f"Detect and fit up to {self.args.max_spots} spots (beams, back-reflections) per camera instead of a single beam")
+        self.cb_multi_spot.toggled.connect(lambda checked: self.spot_opts.emit(checked, self.args.max_spots))
+        self.acq_layout.addWidget(self.cb_multi_spot, 2, 1, Qt.AlignmentFlag.AlignLeft)
+
+        self.fit_engine_label = QLabel(self.gb_acqusition)
+        self.fit_engine_label.setText("Fit Engine")
+        self.acq_layout.addWidget(self.fit_engine_label, 3, 0, Qt.AlignmentFlag.AlignLeft)
+
+        self.combo_fit_engine = QComboBox(self.gb_acqusition)
+        self.combo_fit_engine.setObjectName(u"combo_fit_engine")
+        self.combo_fit_engine.addItems(FIT_ENGINE_NAMES)
+        self.combo_fit_engine.setCurrentText(self.args.fit_engine)
+        self.combo_fit_engine.currentTextChanged.connect(self.fit_opts)
+        self.acq_layout.addWidget(self.combo_fit_engine, 3, 1, Qt.AlignmentFlag.AlignLeft)
+
+        self.display_rate_label = QLabel(self.gb_acqusition)
+        self.display_rate_label.setText("Display Rate (Hz)")
+        self.acq_layout.addWidget(self.display_rate_label, 4, 0, Qt.AlignmentFlag.AlignLeft)
+
+        self.spin_display_rate = QSpinBox(self.gb_acqusition)
+        self.spin_display_rate.setObjectName(u"spin_display_rate")
+        self.spin_display_rate.setRange(1, 240)
+        self.spin_display_rate.setValue(int(self.args.display_rate))
+        self.spin_display_rate.setToolTip("Camera views are redrawn at most this often, capture and stats always run at the full frame rate")
+        self.spin_display_rate.valueChanged.connect(self.display_scheduler.setRate)
+        self.acq_layout.addWidget(self.spin_display_rate, 4, 1, Qt.AlignmentFlag.AlignLeft)
+
+        self.cb_record = QCheckBox(self.gb_acqusition)
+        self.cb_record.setObjectName(u"cb_record")
+        self.cb_record.setText("Record Frames")
+        self.cb_record.setChecked(self.args.record)
+        self.cb_record.setToolTip(f"Record to {self.save_path}")
+        self.cb_record.toggled.connect(self.emitSaveOpts)
+        self.acq_layout.addWidget(self.cb_record, 5, 0, Qt.AlignmentFlag.AlignLeft)
+
+        self.btn_save_path = QPushButton(self.gb_acqusition)
+        self.btn_save_path.setObjectName(u"btn_save_path")
+        self.btn_save_path.setText("Save Path...")
+        self.btn_save_path.clicked.connect(self.selectSavePath)
+        self.acq_layout.addWidget(self.btn_save_path, 5, 1, Qt.AlignmentFlag.AlignLeft)
+
         self.btn_screenshot = QPushButton(self.camera_buttons)
         self.btn_screenshot.setObjectName(u"btn_screenshot")
         self.btn_screenshot.setText("Save Screenshot") 
         self.btn_screenshot.setFixedSize(QSize(111,24))
         self.btn_screenshot.clicked.connect(self.saveScreenshot)
-        self.acq_layout.addWidget(self.btn_screenshot, 3, 0, Qt.AlignmentFlag.AlignCenter)
+        self.acq_layout.addWidget(self.btn_screenshot, 6, 0, 1, 2, Qt.AlignmentFlag.AlignCenter)
 
         self.verticalLayout.addWidget(self.gb_acqusition)
 
@@ -365,6 +630,123 @@ class Viewer(QMainWindow):
 
         return self.console_widget
     
+    def createSpectrum(self):
+        self.spectrum_widget = QWidget()
+        layout = QGridLayout(self.spectrum_widget)
+
+        self.combo_spectrum_cam = QComboBox(self.spectrum_widget)
+        self.combo_spectrum_cam.setObjectName(u"combo_spectrum_cam")
+        self.combo_spectrum_cam.setToolTip("Camera to show the centroid spectrum of")
+        self.combo_spectrum_cam.currentIndexChanged.connect(self.showSpectrum)
+        layout.addWidget(self.combo_spectrum_cam, 0, 0, Qt.AlignmentFlag.AlignLeft)
+
+        self.spectrum_label = QLabel(self.spectrum_widget)
+        self.spectrum_label.setToolTip("RMS pointing stability in the selected band, drag the band in the plot to change it")
+        layout.addWidget(self.spectrum_label, 0, 1, Qt.AlignmentFlag.AlignLeft)
+        layout.setColumnStretch(1, 1)
+
+        self.spectrum_plot = pg.PlotWidget(self.spectrum_widget, labels={'bottom': 'Frequency (Hz)', 'left': 'PSD (px²/Hz)'})
+        self.spectrum_plot.setLogMode(x=True, y=True)
+        self.spectrum_plot.showGrid(True, True)
+        self.spectrum_plot.addLegend()
+        self.spectrum_x = self.spectrum_plot.plot(pen='b', name='X')
+        self.spectrum_y = self.spectrum_plot.plot(pen='r', name='Y')
+        low, high = self.args.spectrum_bands[0]
+        self.spectrum_band = pg.LinearRegionItem(values=(np.log10(max(low, 1e-3)), np.log10(high)))    #log axis
+        self.spectrum_band.sigRegionChanged.connect(self.updateSpectrumBand)
+        self.spectrum_plot.addItem(self.spectrum_band)
+        layout.addWidget(self.spectrum_plot, 1, 0, 1, 2)
+
+        self.updateSpectrumBand()
+        return self.spectrum_widget
+
+    @pyqtSlot()
+    def showSpectrum(self):
+        spectrum = self.spectra.get(self.combo_spectrum_cam.currentData())
+        if spectrum is None:
+            self.spectrum_x.clear()
+            self.spectrum_y.clear()
+        else:
+            freqs, psd_x, psd_y = spectrum
+            self.spectrum_x.setData(freqs[1:], np.maximum(psd_x[1:], 1e-12))      #no DC on the log axis
+            self.spectrum_y.setData(freqs[1:], np.maximum(psd_y[1:], 1e-12))
+        self.updateSpectrumBand()
+
+    @pyqtSlot()
+    def updateSpectrumBand(self):
+        low, high = 10 ** np.array(self.spectrum_band.getRegion())
+        spectrum = self.spectra.get(self.combo_spectrum_cam.currentData())
+        if spectrum is None:
+            self.spectrum_label.setText(f"{low:.3g}-{high:.3g} Hz: no spectrum yet")
+        else:
+            freqs, psd_x, psd_y = spectrum
+            self.spectrum_label.setText(f"{low:.3g}-{high:.3g} Hz RMS: X {band_rms(freqs, psd_x, low, high):.3f} px, Y {band_rms(freqs, psd_y, low, high):.3f} px")
+
+    def createDrift(self):
+        self.drift_widget = QWidget()
+        layout = QGridLayout(self.drift_widget)
+
+        self.combo_drift_cam = QComboBox(self.drift_widget)
+        self.combo_drift_cam.setObjectName(u"combo_drift_cam")
+        self.combo_drift_cam.setToolTip("Camera to show the drift history of")
+        self.combo_drift_cam.currentIndexChanged.connect(self.showDrift)
+        layout.addWidget(self.combo_drift_cam, 0, 0, Qt.AlignmentFlag.AlignLeft)
+
+        self.drift_label = QLabel(self.drift_widget)
+        layout.addWidget(self.drift_label, 0, 1, Qt.AlignmentFlag.AlignLeft)
+        layout.setColumnStretch(1, 1)
+
+        self.btn_export_drift = QPushButton(self.drift_widget)
+        self.btn_export_drift.setObjectName(u"btn_export_drift")
+        self.btn_export_drift.setText("Export...")
+        self.btn_export_drift.clicked.connect(self.exportDrift)
+        layout.addWidget(self.btn_export_drift, 0, 2, Qt.AlignmentFlag.AlignRight)
+
+        self.drift_plots = pg.GraphicsLayoutWidget(self.drift_widget)
+        center_plot = self.drift_plots.addPlot(row=0, col=0, axisItems={'bottom': pg.DateAxisItem()}, labels={'left': 'Center (px)'})
+        sigma_plot = self.drift_plots.addPlot(row=1, col=0, axisItems={'bottom': pg.DateAxisItem()}, labels={'left': 'Sigma (px)'})
+        sigma_plot.setXLink(center_plot)
+        for plot in (center_plot, sigma_plot):
+            plot.showGrid(True, True)
+            plot.addLegend()
+        #same order as Drift_History.fields
+        self.drift_curves = [center_plot.plot(pen='b', name='X'), center_plot.plot(pen='r', name='Y'),
+                             sigma_plot.plot(pen='b', name='X'), sigma_plot.plot(pen='r', name='Y')]
+        layout.addWidget(self.drift_plots, 1, 0, 1, 3)
+
+        return self.drift_widget
+
+    @pyqtSlot()
+    def showDrift(self):
+        drift : Drift_History = self.drifts.get(self.combo_drift_cam.currentData())
+        if drift is None:
+            for curve in self.drift_curves:
+                curve.clear()
+            self.drift_label.setText("")
+            return
+        for curve, field in zip(self.drift_curves, drift.fields):
+            curve.setData(*drift.display(field), connect='finite')     #min/max of each bucket, gaps where there was no fit
+        span = (drift.times[drift.count - 1] - drift.times[0]) / 60 if drift.count > 0 else 0
+        self.drift_label.setText(f"{span:.1f} min, {self.args.stats_interval * drift.stride / 1000:g} s per point, {drift.nbytes() / 1024:.0f} kB")
+
+    @pyqtSlot()
+    def exportDrift(self):
+        cam_idx = self.combo_drift_cam.currentData()
+        drift : Drift_History = self.drifts.get(cam_idx)
+        if drift is None:
+            return
+        current_date_time = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        fname_default = path.join(self.save_path, f'Drift_{cam_idx}_{current_date_time}.csv')
+        filename, file_filter = QFileDialog.getSaveFileName(None, "Export Drift History", fname_default, "CSV Files (*.csv);;NumPy Archives (*.npz)")
+        if filename:
+            if "npz" in file_filter and not filename.lower().endswith(".npz"):
+                filename += ".npz"
+            try:
+                drift.export(filename)
+                logging.info(f"Drift history of camera {cam_idx} saved as {filename}")
+            except OSError as e:
+                logging.warning(f"Failed to save drift history as {filename}: {e}")
+
     @pyqtSlot()
     def saveScreenshot(self):
         current_date_time = datetime.now().strftime("%Y-%m-%d_%H%M%S")
@@ -378,12 +760,35 @@ class Viewer(QMainWindow):
             else:
                 logging.warning(f"Failed to save screenshot as {filename}")
 
+    @pyqtSlot()
+    def selectSavePath(self):
+        save_path = QFileDialog.getExistingDirectory(None, "Recording Folder", self.save_path)
+        if save_path:
+            self.save_path = save_path
+            self.cb_record.setToolTip(f"Record to {self.save_path}")
+            self.emitSaveOpts()
+
+    @pyqtSlot()
+    def emitSaveOpts(self):
+        self.save_opts.emit(self.save_path, self.cb_record.isChecked())
+
+    @pyqtSlot()
+    def addReplay(self):
+        filename, _ = QFileDialog.getOpenFileName(None, "Replay Recording", self.save_path, "Recordings (*.npy *.raw *.mkv *.avi *.mp4 *.png *.tif *.tiff);;All Files (*)")
+        if filename:
+            if filename.lower().endswith((".png", ".tif", ".tiff")):
+                filename = path.dirname(filename)   #image sequence, replay the whole folder
+            self.virtual_sources.append(filename)
+            self.searchForCams()
+
     @pyqtSlot()
     def searchForCams(self):
         if not self.searching:
             logging.info("Searching for cameras...")
             self.searching = True
-            self.cam_search = Camera_Search(list(self.active_cams.keys()))
+            in_use = [c["name"] for c in self.active_cams.values() if "cam" in c]     #open, can't be probed
+            self.cam_search = Camera_Search(in_use, self.virtual_sources, self.args.max_index, self.args.camera_cache, self.args.rescan)
+            self.cam_search.devices.connect(self.device_info.update)
             self.cam_search.result.connect(self.initCams)
             self.cam_search.q_thread.start()
 
@@ -411,6 +816,10 @@ class Viewer(QMainWindow):
             self.active_cams[idx]["enabled_cb"] = cam_cb
 
             cam_serial_widget = QTableWidgetItem(f"#{cam}")  #Used as reference for removal
+            name = self.device_info.get(cam, {}).get("name")
+            if name:
+                cam_serial_widget.setText(f"#{cam} {name}")
+                cam_serial_widget.setToolTip(", ".join(f"{k}: {v}" for k, v in self.device_info[cam].items() if k != "time"))
             self.active_cams[idx]["table_widget"] = cam_serial_widget
             self.camera_table.setItem(idx, 1, cam_serial_widget)
             self.camera_table.setItem(idx, 2, QTableWidgetItem("Standby"))
@@ -419,9 +828,20 @@ class Viewer(QMainWindow):
     def initCam(self, idx, cam):
         cam_str = f"#{cam}"
         logging.info(f"Starting camera {cam_str}...")
-        active_cam = USB_Camera(camera_index=idx, save_path="./")
+        active_cam = USB_Camera(camera_index=idx, save_images=self.cb_record.isChecked(), save_path=self.save_path, fit_workers=self.args.fit_workers, source=cam)
+        active_cam.realtime = not self.args.replay_fast
+        active_cam.save_format = self.args.record_format
+        active_cam.fit_engine = self.combo_fit_engine.currentText()
+        active_cam.stats_interval = self.args.stats_interval
+        active_cam.capture_format = dict(self.capture_formats.get(idx, self.default_capture_format))
+        active_cam.track = not self.args.no_tracking
+        active_cam.spectrum_segment = self.args.spectrum_segment
+        active_cam.spectrum_bands = tuple(self.args.spectrum_bands)
+        active_cam.multi_spot = self.cb_multi_spot.isChecked()
+        active_cam.max_spots = self.args.max_spots
         if active_cam:
             self.running_threads.watchThread(active_cam.q_thread)
+            active_cam.stats_thread_sig.connect(self.running_threads.watchThread)
             active_cam.q_thread.start()
             self.active_cams[idx].update({"cam": active_cam})
             
@@ -433,6 +853,9 @@ class Viewer(QMainWindow):
             active_cam.update_image_sig.connect(self.updateImage)
 
             self.save_opts.connect(active_cam.setSaveOpts)
+            self.fit_opts.connect(active_cam.setFitEngine)
+            self.spot_opts.connect(active_cam.setMultiSpot)
+            self.noise_opts.connect(active_cam.setNoiseWindow)
             self.closing_sig.connect(active_cam.shutdown)
 
             start_sig = Sig("start")
@@ -451,13 +874,21 @@ class Viewer(QMainWindow):
         imv.setImage(img)
         return imv
     
-    def createWidget(self, imv: pg.ImageView, crosshair: Crosshair):
+    def createViewSelect(self, cam_idx):
+        view_select = QComboBox()
+        view_select.addItems(["Image", "Mean", "Variance", "SNR"])     #the last three are the per-pixel noise maps
+        view_select.setToolTip(f"Per-pixel maps are updated every {self.args.noise_window} frames")
+        view_select.currentTextChanged.connect(lambda view, cam_idx=cam_idx: self.setView(cam_idx, view))
+        return view_select
+
+    def createWidget(self, imv: pg.ImageView, crosshair: Crosshair, view_select: QComboBox):
         widget = QWidget()
         layout = QGridLayout()
         layout.addWidget(imv, 0, 0)
         layout.addWidget(crosshair.vert_plot, 0, 1)
         layout.addWidget(crosshair.hor_plot, 1, 0)
         layout.addWidget(crosshair.circ_widg, 1, 1)
+        layout.addWidget(view_select, 2, 0, Qt.AlignmentFlag.AlignLeft)
 
         widget.setLayout(layout)
         return widget
@@ -478,6 +909,10 @@ class Viewer(QMainWindow):
                     self.active_cams[cam_idx]["table_widget"] = cam_serial_widget
                     self.camera_table.setItem(cam_idx, 1, cam_serial_widget)
                     self.camera_table.setItem(cam_idx, 3, QTableWidgetItem(f"{active_cam.width}x{active_cam.height}"))
+                    negotiated = active_cam.negotiated
+                    format_widget = QTableWidgetItem(f"{negotiated['FOURCC']} {negotiated['FPS']:g}")
+                    format_widget.setToolTip(", ".join(f"{k}: {v}" for k, v in negotiated.items()))
+                    self.camera_table.setItem(cam_idx, 4, format_widget)
 
                     stats_root = QTreeWidgetItem([cam_str_ser,""])
                     self.active_cams[cam_idx]["stats_root"] = stats_root
@@ -489,29 +924,30 @@ class Viewer(QMainWindow):
 
                     imv = self.createImageView(active_cam.img)
                     crosshair = Crosshair(imv)
-                    widget = self.createWidget(imv, crosshair)
+                    crosshair.setPlotsVisible(self.cb_profile_plots.isChecked())
+                    view_select = self.createViewSelect(cam_idx)
+                    widget = self.createWidget(imv, crosshair, view_select)
                     self.active_cams[cam_idx]["imv"] = imv
                     self.active_cams[cam_idx]["crosshair"] = crosshair
+                    self.active_cams[cam_idx]["view"] = "Image"
                     self.active_cams[cam_idx]["widget"] = widget
+                    self.combo_spectrum_cam.addItem(cam_str_ser, cam_idx)
+                    self.drifts[cam_idx] = Drift_History(capacity=self.args.drift_points)
+                    if self.combo_drift_cam.findData(cam_idx) >= 0:
+                        self.combo_drift_cam.setItemText(self.combo_drift_cam.findData(cam_idx), cam_str_ser)
+                    else:
+                        self.combo_drift_cam.addItem(cam_str_ser, cam_idx)
 
                     try:
                         self.dock_cam_placeholder.close()
                     except Exception:
                         pass
                     cam_dock = Dock(cam_str_ser, size=(800,800))
-                    dock_count, active_docks = self.getDockCount()
-                    if dock_count == 0:
-                        self.dock_area.addDock(cam_dock, 'top', self.dock_console)
-                    elif dock_count == 1:
-                        self.dock_area.addDock(cam_dock, 'right', self.active_cams[active_docks[-1]]['dock'])
-                    elif dock_count == 2:
-                        self.dock_area.addDock(cam_dock, 'bottom', self.active_cams[active_docks[-2]]['dock'])
-                    elif dock_count == 3:
-                        self.dock_area.addDock(cam_dock, 'bottom', self.active_cams[active_docks[-2]]['dock'])
-                    #Max 4 right now
+                    self.dock_area.addDock(cam_dock, 'top', self.dock_console)
                     cam_dock.setTitle(cam_str_ser)
                     cam_dock.addWidget(self.active_cams[cam_idx]["widget"])
                     self.active_cams[cam_idx].update({"dock": cam_dock})
+                    self.tileCamDocks()
 
                     self.active_cams[cam_idx]["ui_ready"] = True
 
@@ -523,6 +959,29 @@ class Viewer(QMainWindow):
         except KeyError as e:
             logging.warning(f"Error with cam init: {type(e)} {str(e)}")
 
+    def tileCamDocks(self):
+        # Lay the camera docks out in a grid above the console, as square as possible (2x2 for 4 cameras,
+        # 4x3 for 12), in camera order. The first dock of each row is stacked first, the rest of a row is then
+        # added to the right of it, which nests each row in its own horizontal container.
+        docks = [self.active_cams[i]["dock"] for i in sorted(self.active_cams) if "dock" in self.active_cams[i]]
+        if len(docks) == 0:
+            return
+        cols = ceil(sqrt(len(docks)))
+        for i in range(0, len(docks), cols):
+            if i == 0:
+                self.dock_area.moveDock(docks[i], 'top', self.dock_console)
+            else:
+                self.dock_area.moveDock(docks[i], 'bottom', docks[i - cols])
+        for i, dock in enumerate(docks):
+            if i % cols:
+                self.dock_area.moveDock(dock, 'right', docks[i - 1])
+
+    @pyqtSlot(bool)
+    def setProfilePlots(self, visible):
+        for cam in self.active_cams.values():
+            if "crosshair" in cam:
+                cam["crosshair"].setPlotsVisible(visible)
+
     @pyqtSlot()
     def camShutdownAll(self):
         for cam in self.active_cams.values():
@@ -544,6 +1003,29 @@ class Viewer(QMainWindow):
                 pass
 
 
+    def showCaptureFormat(self, fmt):
+        with SBlock(self.combo_fourcc), SBlock(self.combo_resolution), SBlock(self.spin_capture_fps), SBlock(self.cb_raw_y):
+            self.combo_fourcc.setCurrentText(fmt["fourcc"] or "Default")
+            self.combo_resolution.setCurrentText(f"{fmt['width']}x{fmt['height']}" if fmt["width"] > 0 else "Default")
+            self.spin_capture_fps.setValue(fmt["fps"])
+            self.cb_raw_y.setChecked(fmt["raw_y"])
+
+    @pyqtSlot()
+    def loadCaptureFormat(self):
+        idx = self.getSelectedCam()
+        self.showCaptureFormat(self.capture_formats.get(idx, self.default_capture_format))
+
+    @pyqtSlot()
+    def storeCaptureFormat(self):
+        fourcc = self.combo_fourcc.currentText().strip().upper()
+        width, height = parse_resolution(self.combo_resolution.currentText())
+        fmt = {"fourcc": "" if fourcc == "DEFAULT" else fourcc, "width": width, "height": height, "fps": self.spin_capture_fps.value(), "raw_y": self.cb_raw_y.isChecked()}
+        idx = self.getSelectedCam()
+        if idx < 0:
+            self.default_capture_format = fmt
+        else:
+            self.capture_formats[idx] = fmt
+
     def getSelectedCam(self) -> int:
         if len(self.camera_table.selectionModel().selectedRows()) > 0:
             return self.camera_table.selectionModel().selectedRows()[0].row()
@@ -553,14 +1035,23 @@ class Viewer(QMainWindow):
     def updateCamStatus(self, cam_idx : int, status_str : str):
         self.camera_table.setItem(cam_idx, 2, QTableWidgetItem(status_str))
 
-    @pyqtSlot(int, dict)
-    def updateStats(self, cam_idx : int, stats : dict):
+    @pyqtSlot(int, dict, dict)
+    def updateStats(self, cam_idx : int, stats : dict, plots : dict):
+        items = self.active_cams[cam_idx]["stats"]
+        stats_root : QTreeWidgetItem = self.active_cams[cam_idx]["stats_root"]
+        for k in [k for k, i in items.items() if i.parent() is stats_root and k not in stats]:
+            stats_root.removeChild(items.pop(k))       #e.g. spots that went away
+            for k_x in [k_x for k_x in items if k_x.startswith(k + "_")]:
+                del items[k_x]
         for k, x in stats.items():
             try:
                 i : QTreeWidgetItem = self.active_cams[cam_idx]["stats"][k] 
             except KeyError:
                 self.active_cams[cam_idx]["stats"][k] = QTreeWidgetItem(self.active_cams[cam_idx]["stats_root"], [k, ""])
                 i : QTreeWidgetItem = self.active_cams[cam_idx]["stats"][k]
+            children = x if type(x) is dict else {}
+            for k_x in [k_x for k_x, j in items.items() if j.parent() is i and k_x[len(k) + 1:] not in children]:
+                i.removeChild(items.pop(k_x))       #e.g. the fit values after switching to another engine
             if type(x) is dict:
                 for k_x, y in x.items():
                     try:
@@ -579,7 +1070,26 @@ class Viewer(QMainWindow):
                 else:
                     i.setText(1, f"{x:.2f}")
 
+        drift : Drift_History = self.drifts.get(cam_idx)
+        if drift is not None and "Gaussian" in stats:
+            drift.add(time(), stats["Gaussian"])
+            if self.combo_drift_cam.currentData() == cam_idx and not self.drift_widget.visibleRegion().isEmpty():
+                self.showDrift()
+
+        if "Spectrum" in plots:
+            self.spectra[cam_idx] = plots["Spectrum"]
+            if self.combo_spectrum_cam.currentData() == cam_idx:
+                self.showSpectrum()
+
+        view = self.active_cams[cam_idx]["view"]
+        if view in plots:
+            imv: pg.ImageView = self.active_cams[cam_idx]["imv"]
+            imv.setImage(plots[view], autoHistogramRange=self.cb_auto_hist.isChecked(), autoLevels=self.cb_auto_levels.isChecked(), autoRange=self.cb_auto_range.isChecked(), levelMode='mono')
+
         crosshair: Crosshair = self.active_cams[cam_idx]["crosshair"]
+        crosshair.setSpots([stats[f"Spot {n + 1}"] for n in range(stats.get("Spots", 0))])
+        if self.cb_track_crosshair.isChecked():
+            return      #follows the centroid, see renderImages
         try:
             target_x = stats["Gaussian"]["Center X"]
             target_y = stats["Gaussian"]["Center Y"]
@@ -589,12 +1099,45 @@ class Viewer(QMainWindow):
         except (KeyError, TypeError):
             crosshair.clearTarget()
 
+    def setView(self, cam_idx : int, view : str):
+        #Image shows the live frames, the others the per-pixel noise maps from the stats thread
+        self.active_cams[cam_idx]["view"] = view
+        self.noise_opts.emit(cam_idx, 0 if view == "Image" else self.args.noise_window)
+        if view == "Image":
+            active_cam : USB_Camera = self.active_cams[cam_idx]["cam"]
+            self.active_cams[cam_idx]["imv"].setImage(active_cam.img)
+
+    @pyqtSlot(int)
     def updateImage(self, cam_idx : int):
-        try:
-            imv: pg.ImageView = self.active_cams[cam_idx]["imv"]
-            imv.setImage(imv.image, autoHistogramRange=self.cb_auto_hist.isChecked(), autoLevels=self.cb_auto_levels.isChecked(), autoRange=self.cb_auto_range.isChecked(), levelMode='mono')
-        except KeyError:
-            pass
+        self.display_scheduler.markDirty(cam_idx)
+
+    def renderImages(self, cam_idxs):
+        # One display tick: draw the newest frame of each camera whose view can be seen. Views in a hidden
+        # dock (closed, behind another tab) or a minimised window are skipped, their frames are just released.
+        opts = {"autoHistogramRange": self.cb_auto_hist.isChecked(), "autoLevels": self.cb_auto_levels.isChecked(), "autoRange": self.cb_auto_range.isChecked(), "levelMode": 'mono'}
+        track = self.cb_track_crosshair.isChecked()
+        for cam_idx in cam_idxs:
+            try:
+                active_cam : USB_Camera = self.active_cams[cam_idx]["cam"]
+            except KeyError:
+                continue
+            try:
+                imv: pg.ImageView = self.active_cams[cam_idx]["imv"]
+                if self.active_cams[cam_idx]["view"] == "Image" and not imv.visibleRegion().isEmpty() and not imv.window().isMinimized():
+                    imv.setImage(active_cam.img, **opts)
+                    if track:
+                        self.trackCrosshair(cam_idx, active_cam.centroid)
+            except KeyError:
+                pass    #UI not ready yet
+            active_cam.display_pending = False      #release the frame, newer frames signal again from here on
+
+    def trackCrosshair(self, cam_idx : int, centroid):
+        crosshair: Crosshair = self.active_cams[cam_idx]["crosshair"]
+        if centroid is not None:
+            x, y, sigma_x, sigma_y = centroid
+            crosshair.setTarget((x, y), (sigma_x * 6, sigma_y * 6))
+        elif crosshair.roi.isVisible():
+            crosshair.clearTarget()
 
     @pyqtSlot(int)
     def removeCam(self, idx):
@@ -619,9 +1162,14 @@ class Viewer(QMainWindow):
                 del self.active_cams[idx]["ui_ready"]
             except KeyError:
                 pass
+            self.spectra.pop(idx, None)
+            if self.combo_spectrum_cam.findData(idx) >= 0:
+                self.combo_spectrum_cam.removeItem(self.combo_spectrum_cam.findData(idx))
 
             if self.getDockCount()[0] == 0:
                 self.dock_area.addDock(self.dock_cam_placeholder, 'top', self.dock_console)
+            else:
+                self.tileCamDocks()
         except Exception as e:
             logging.warning(f"Error removing cam {idx}: {str(e)}")
 
@@ -687,6 +1235,7 @@ class Viewer(QMainWindow):
             
     def quit(self):
         logging.info("Done.")
+        Fit_Pool.shutdown()
         try:
             self.shut_timer.stop()
         except AttributeError:
@@ -699,9 +1248,16 @@ if __name__ == '__main__':
     warnings.filterwarnings("ignore", message=".*sipPyTypeDict\\(\\) is deprecated.*")
     logging.basicConfig(level=logging.INFO, format='[%(levelname)-10s] (%(threadName)-10s), %(asctime)s, %(message)s')
 
-    app = QApplication([])
-    viewer = Viewer()
-    viewer.show()
+    args = create_parser().parse_args()
+    if args.headless:
+        from headless import Headless_Runner
+        app = QtCore.QCoreApplication([])
+        runner = Headless_Runner(args, virtual_sources(args), capture_format(args))
+        runner.start()
+    else:
+        app = QApplication([])
+        viewer = Viewer(args)
+        viewer.show()
 
     sys.exit(app.exec())
 
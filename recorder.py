@@ -0,0 +1,180 @@
+import logging
+import queue
+import threading
+from os import path, makedirs
+from datetime import datetime
+
+import numpy as np
+from numpy.typing import NDArray
+import cv2
+
+RECORD_FORMATS = ("npy", "video", "png")
+
+
+def session_folder(save_path, camera_index):
+    # Cam<N>_<date>_<time>_<ms>, with a counter if a recording of the same camera started in the same ms
+    name = f"Cam{camera_index}_{datetime.now().strftime('%Y-%m-%d_%H%M%S_%f')[:-3]}"
+    folder = path.join(save_path, name)
+    n = 1
+    while path.exists(folder):
+        folder = path.join(save_path, f"{name}_{n}")
+        n += 1
+    return folder
+
+
+def npy_header(shape, dtype, size=128):
+    # NPY v1.0 header padded to a fixed size, so it can be rewritten in place once the frame count is known
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": tuple(shape)})
+    header_len = size - 10
+    return b"\x93NUMPY\x01\x00" + np.uint16(header_len).tobytes() + header.ljust(header_len - 1).encode("latin1") + b"\n"
+
+
+class Npy_Writer():
+    # Chunked NPY stacks (frames_0000.npy, ...) plus a matching timestamps_0000.npy, all memory-mappable
+
+    def __init__(self, folder, shape, dtype, fps, chunk_frames=1800):
+        self.folder = folder
+        self.shape = shape
+        self.dtype = dtype
+        self.chunk_frames = chunk_frames
+        self.chunk = 0
+        self.file = None
+        self.timestamps = np.zeros(chunk_frames, dtype=float)
+        self.count = 0
+
+    def openChunk(self):
+        self.file = open(path.join(self.folder, f"frames_{self.chunk:04d}.npy"), "wb")
+        self.file.write(npy_header((self.chunk_frames, *self.shape), self.dtype))
+        self.count = 0
+
+    def closeChunk(self):
+        self.file.seek(0)
+        self.file.write(npy_header((self.count, *self.shape), self.dtype))
+        self.file.close()
+        self.file = None
+        np.save(path.join(self.folder, f"timestamps_{self.chunk:04d}.npy"), self.timestamps[:self.count])
+        self.chunk += 1
+
+    def write(self, img: NDArray, timestamp):
+        if self.file is None:
+            self.openChunk()
+        self.file.write(img.data)
+        self.timestamps[self.count] = timestamp
+        self.count += 1
+        if self.count == self.chunk_frames:
+            self.closeChunk()
+
+    def close(self):
+        if self.file is not None:
+            self.closeChunk()
+
+
+class Video_Writer():
+    # Lossless FFV1 video (grayscale, 8 or 16 bit) plus timestamps.npy
+
+    def __init__(self, folder, shape, dtype, fps, chunk_frames=None):
+        self.folder = folder
+        depth = cv2.CV_16U if np.dtype(dtype) == np.uint16 else cv2.CV_8U
+        self.video = cv2.VideoWriter(path.join(folder, "frames.mkv"), cv2.CAP_FFMPEG, cv2.VideoWriter_fourcc(*"FFV1"), fps, (shape[1], shape[0]),
+                                     [cv2.VIDEOWRITER_PROP_IS_COLOR, 0, cv2.VIDEOWRITER_PROP_DEPTH, depth])
+        if not self.video.isOpened():
+            raise IOError("FFV1 video writer not available")
+        self.timestamps = []
+
+    def write(self, img: NDArray, timestamp):
+        self.video.write(img)
+        self.timestamps.append(timestamp)
+
+    def close(self):
+        self.video.release()
+        np.save(path.join(self.folder, "timestamps.npy"), np.array(self.timestamps))
+
+
+class Png_Writer():
+    # One PNG per frame, named by frame number and timestamp
+
+    def __init__(self, folder, shape, dtype, fps, chunk_frames=None):
+        self.folder = folder
+        self.count = 0
+
+    def write(self, img: NDArray, timestamp):
+        cv2.imwrite(path.join(self.folder, f"frame_{self.count:06d}_{timestamp:.6f}.png"), img)
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+WRITERS = {"npy": Npy_Writer, "video": Video_Writer, "png": Png_Writer}
+
+
+class Frame_Recorder():
+    # Records frames from the acquisition loop on a dedicated writer thread. push() copies the frame into
+    # one of a fixed set of preallocated buffers and queues it, if none are free (the disk can't keep up)
+    # the frame is dropped instead, so the acquisition loop never waits on disk I/O.
+
+    def __init__(self, camera_index, shape, dtype=np.uint8, save_path=".", fmt="npy", fps=30, queue_size=120):
+        self.camera_index = camera_index
+        self.fmt = fmt
+        self.folder = session_folder(save_path, camera_index)
+        makedirs(self.folder)
+        self.writer = WRITERS[fmt](self.folder, shape, dtype, fps)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        self.free = queue.SimpleQueue()
+        for _ in range(queue_size):
+            self.free.put(np.empty(shape, dtype=dtype))
+        self.pending = queue.SimpleQueue()
+        self.written = 0
+        self.dropped = 0
+        self.mismatched = False     #frames of another format were pushed (and dropped)
+
+        self.thread = threading.Thread(target=self.run, name=f"Rec_Cam_{camera_index}")
+        self.thread.start()
+        logging.info(f"Recording camera {camera_index} to {self.folder} ({fmt}).")
+
+    def push(self, img: NDArray, timestamp):
+        if img.shape != self.shape or img.dtype != self.dtype:
+            #copying would silently convert (e.g. truncate 16 bits to 8), drop the frames instead
+            if not self.mismatched:
+                logging.error(f"Camera {self.camera_index} frames are {img.dtype} {img.shape}, recording {self.dtype} {self.shape}, dropping them.")
+            self.mismatched = True
+            self.dropped += 1
+            return False
+        try:
+            buffer = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        np.copyto(buffer, img, casting="no")
+        self.pending.put((buffer, timestamp))
+        return True
+
+    def queueDepth(self):
+        return self.pending.qsize()
+
+    def run(self):
+        try:
+            while True:
+                item = self.pending.get()
+                if item is None:
+                    break
+                buffer, timestamp = item
+                self.writer.write(buffer, timestamp)
+                self.written += 1
+                self.free.put(buffer)
+        except Exception as e:
+            logging.error(f"Error recording camera {self.camera_index}: {type(e)} {e}")
+        finally:
+            self.writer.close()
+            logging.info(f"Stopped recording camera {self.camera_index}, {self.written} frames written, {self.dropped} dropped.")
+
+    def stop(self, wait=False):
+        # Queued frames are still written out, only wait for that if asked to
+        self.pending.put(None)
+        if wait:
+            self.thread.join()
+
+    def getStats(self):
+        return {"Queue Depth": self.queueDepth(), "Frames Written": self.written, "Frames Dropped": self.dropped}
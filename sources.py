@@ -0,0 +1,346 @@
+import re
+import json
+from os import path, listdir
+from glob import glob
+from time import sleep, perf_counter
+
+import numpy as np
+from numpy.typing import NDArray
+import cv2
+
+IMAGE_EXTENSIONS = (".png", ".tif", ".tiff", ".bmp", ".jpg", ".jpeg")
+SYNTHETIC_PREFIX = "synthetic"
+TRAJECTORIES = ("static", "circle", "drift", "jitter")
+SYNTHETIC_OPTION_TYPES = {"frames": int, "seed": int, "trajectory": str}    #all other options are floats
+
+
+class Frame_Source():
+    # Virtual camera with the same interface as cv2.VideoCapture (open/isOpened/read/get/set/release), so
+    # USB_Camera can use it in place of a device. Subclasses provide the frames through getFrame() and
+    # their timing through frameTime(), the base class paces them and loops back to the start.
+
+    type_name = "Virtual"
+
+    def __init__(self, realtime=True, loop=True, fps=30):
+        self.realtime = realtime
+        self.loop = loop
+        self.fps = fps
+        self.opened = False
+        self.name = ""
+        self.frame_count = 0
+        self.position = 0
+        self.shape = None
+        self.dtype = np.dtype(np.uint8)     #of the frames read() returns
+        self.start_time = None
+
+    def setExceptionMode(self, enable):
+        pass
+
+    def isOpened(self):
+        return self.opened
+
+    def frameTime(self, position):
+        return position / self.fps
+
+    def getFrame(self, position) -> NDArray:
+        raise NotImplementedError
+
+    def rewind(self):
+        self.position = 0
+        self.start_time = None
+
+    def read(self, image=None):
+        if self.position >= self.frame_count:
+            if not self.loop:
+                return False, None
+            self.rewind()
+
+        if self.realtime:
+            if self.start_time is None:
+                self.start_time = perf_counter()
+            delay = self.start_time + self.frameTime(self.position) - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+        frame = self.getFrame(self.position)
+        self.position += 1
+        return frame is not None, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.shape[1]
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.shape[0]
+        elif prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        elif prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.frame_count
+        elif prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.position
+        elif prop == cv2.CAP_PROP_POS_MSEC:
+            return self.frameTime(max(self.position - 1, 0)) * 1000
+        return 0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        self.opened = False
+
+
+class Replay_Source(Frame_Source):
+    # Plays frames from disk back as a virtual camera. Reads recording folders / NPY stacks (memory-mapped), raw
+    # stacks with a .json sidecar ({"shape": [n, h, w], "dtype": "uint8"}), image sequences and video files.
+    # Frames are paced by their original timestamps (or fps when there are none), with realtime=False they
+    # are returned as fast as possible.
+
+    type_name = "Replay"
+
+    def __init__(self, source_path: str, realtime=True, loop=True, fps=30):
+        Frame_Source.__init__(self, realtime, loop, fps)
+        self.source_path = source_path
+        self.name = path.basename(path.normpath(source_path))
+
+        self.stacks = []        #memory-mapped arrays of frames
+        self.images = []        #image file names
+        self.video = None
+        self.timestamps = None  #seconds, one per frame
+
+    def open(self, *args):
+        source = self.source_path
+        if re.fullmatch(r"frames_\d{4}\.npy", path.basename(source)):
+            source = path.dirname(source)       #chunk of a recording, play the whole recording
+
+        if path.isdir(source):
+            chunks = sorted(glob(path.join(source, "frames_*.npy")))
+            if chunks:
+                self.loadStacks(chunks)
+            elif path.exists(path.join(source, "frames.mkv")):
+                self.loadVideo(path.join(source, "frames.mkv"))
+            else:
+                self.loadImages(sorted(path.join(source, f) for f in listdir(source) if f.lower().endswith(IMAGE_EXTENSIONS)))
+        elif source.endswith(".npy"):
+            self.loadStacks([source])
+        elif source.endswith(".raw"):
+            with open(source[:-4] + ".json") as f:
+                meta = json.load(f)
+            self.stacks = [np.memmap(source, dtype=meta["dtype"], mode="r", shape=tuple(meta["shape"]))]
+        elif any(c in source for c in "*?["):
+            self.loadImages(sorted(glob(source)))
+        else:
+            self.loadVideo(source)
+
+        if self.stacks:
+            self.frame_count = sum(len(s) for s in self.stacks)
+            self.shape = self.stacks[0].shape[1:]
+            self.dtype = self.stacks[0].dtype
+        elif self.images:
+            self.frame_count = len(self.images)
+            first = cv2.imread(self.images[0], cv2.IMREAD_UNCHANGED)
+            self.shape = first.shape
+            self.dtype = first.dtype
+        if self.frame_count == 0:
+            raise IOError(f"No frames found in {self.source_path}")
+        if self.timestamps is not None and len(self.timestamps) != self.frame_count:
+            self.timestamps = None
+        if self.timestamps is not None and self.frame_count > 1:
+            self.fps = (self.frame_count - 1) / max(self.timestamps[-1] - self.timestamps[0], 1e-6)
+
+        self.opened = True
+        return True
+
+    def loadStacks(self, files):
+        self.stacks = [np.load(f, mmap_mode="r") for f in files]
+        timestamp_files = [path.join(path.dirname(f), path.basename(f).replace("frames_", "timestamps_")) for f in files]
+        if all(path.exists(f) and f not in files for f in timestamp_files):
+            self.timestamps = np.concatenate([np.load(f) for f in timestamp_files])
+
+    def loadImages(self, files):
+        self.images = files
+        #PNG recordings are named frame_<number>_<timestamp>.png
+        stamps = [re.search(r"_(\d+\.\d+)\.\w+$", f) for f in files]
+        if files and all(stamps):
+            self.timestamps = np.array([float(m.group(1)) for m in stamps])
+
+    def loadVideo(self, file):
+        self.video = cv2.VideoCapture(file)
+        if not self.video.isOpened():
+            raise IOError(f"Could not open {file}")
+        self.frame_count = int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+        if self.frame_count <= 0:
+            self.frame_count = np.iinfo(np.int64).max     #unknown length, runs until the read fails
+        self.fps = self.video.get(cv2.CAP_PROP_FPS) or self.fps
+        self.shape = (int(self.video.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(self.video.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        timestamp_file = path.join(path.dirname(file), "timestamps.npy")
+        if path.exists(timestamp_file):
+            self.timestamps = np.load(timestamp_file)
+
+    def frameTime(self, position):
+        if self.timestamps is not None:
+            return self.timestamps[position] - self.timestamps[0]
+        return position / self.fps
+
+    def getFrame(self, position) -> NDArray:
+        if self.stacks:
+            for stack in self.stacks:
+                if position < len(stack):
+                    return stack[position]      #view into the memory map, no copy
+                position -= len(stack)
+        elif self.images:
+            return cv2.imread(self.images[position], cv2.IMREAD_UNCHANGED)
+        else:
+            ret, frame = self.video.read()
+            return frame if ret else None
+
+    def rewind(self):
+        Frame_Source.rewind(self)
+        if self.video is not None:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def read(self, image=None):
+        ret, frame = Frame_Source.read(self, image)
+        if not ret and self.video is not None and self.loop and self.position > 1:
+            self.position = self.frame_count        #end of a video of unknown length
+            return Frame_Source.read(self, image)
+        return ret, frame
+
+    def release(self):
+        Frame_Source.release(self)
+        if self.video is not None:
+            self.video.release()
+        self.stacks = []
+
+
+class Synthetic_Source(Frame_Source):
+    # Simulated beam for running without hardware (load tests, CI, pointing scenarios). A bank of noisy
+    # gaussian beam frames along the chosen centre trajectory is computed once in open(), read() then
+    # cycles through it returning views into the bank, so nothing is allocated per frame. The bank is
+    # limited to bank_mb, with more frames than fit the trajectory keeps its period but the beam moves in
+    # coarser steps (each bank frame is shown for several frames).
+    #   static - beam fixed at the centre (x0, y0, fractions of the frame size)
+    #   circle - one turn of radius `radius` (fraction of the frame height) per bank
+    #   drift  - linear drift by (dx, dy) (fractions of the frame size) per bank and back again
+    #   jitter - random walk with a step of `radius` pixels, pulled back towards the centre
+
+    type_name = "Synthetic"
+
+    def __init__(self, width=640, height=480, fps=30, frames=60, trajectory="circle", sigma_x=20.0, sigma_y=None,
+                 angle=0.0, amplitude=200.0, background=10.0, noise=4.0, x0=0.5, y0=0.5, radius=0.1, dx=0.2, dy=0.1,
+                 seed=0, bank_mb=128, realtime=True, loop=True):
+        Frame_Source.__init__(self, realtime, loop, fps)
+        if trajectory not in TRAJECTORIES:
+            raise ValueError(f"Unknown trajectory {trajectory}, expected one of {TRAJECTORIES}")
+        self.shape = (int(height), int(width))
+        self.frames = int(frames)
+        self.trajectory = trajectory
+        self.sigma_x = float(sigma_x)
+        self.sigma_y = float(sigma_x if sigma_y is None else sigma_y)
+        self.angle = float(angle)       #degrees, of the sigma_x axis
+        self.amplitude = float(amplitude)
+        self.background = float(background)
+        self.noise = float(noise)       #std of the additive gaussian noise, counts
+        self.x0 = float(x0)
+        self.y0 = float(y0)
+        self.radius = float(radius)
+        self.dx = float(dx)
+        self.dy = float(dy)
+        self.seed = seed
+        self.bank_mb = float(bank_mb)
+        self.name = f"Synthetic {width}x{height}@{fps:g}"
+
+        self.bank = None
+        self.index = None       #bank frame of each frame
+        self.centers = None     #true beam centre (x, y) of each frame
+
+    @classmethod
+    def fromSpec(cls, spec: str, realtime=True):
+        # "synthetic[:WxH][@FPS][,key=value...]", e.g. "synthetic:1920x1080@60,trajectory=jitter,noise=8"
+        m = re.fullmatch(SYNTHETIC_PREFIX + r"(?::(\d+)x(\d+))?(?:@([\d.]+))?((?:,\w+=[^,]+)*)", spec.strip())
+        if m is None:
+            raise ValueError(f"Invalid synthetic source {spec}")
+        kwargs = {}
+        if m.group(1):
+            kwargs["width"], kwargs["height"] = int(m.group(1)), int(m.group(2))
+        if m.group(3):
+            kwargs["fps"] = float(m.group(3))
+        for option in m.group(4).split(",")[1:]:
+            key, value = option.split("=", 1)
+            kwargs[key] = SYNTHETIC_OPTION_TYPES.get(key, float)(value)
+        return cls(realtime=realtime, **kwargs)
+
+    def trajectoryCenters(self) -> NDArray:
+        height, width = self.shape
+        phase = np.arange(self.frames) / self.frames
+        centers = np.empty((self.frames, 2))
+        centers[:, 0] = self.x0 * width
+        centers[:, 1] = self.y0 * height
+        if self.trajectory == "circle":
+            centers[:, 0] += self.radius * height * np.cos(2 * np.pi * phase)
+            centers[:, 1] += self.radius * height * np.sin(2 * np.pi * phase)
+        elif self.trajectory == "drift":
+            ramp = 1 - np.abs(2 * phase - 1)        #there and back, so the bank loops without a jump
+            centers[:, 0] += self.dx * width * ramp
+            centers[:, 1] += self.dy * height * ramp
+        elif self.trajectory == "jitter":
+            rng = np.random.default_rng(self.seed)
+            offset = np.zeros(2)
+            for i in range(self.frames):
+                offset = 0.9 * offset + rng.normal(0, self.radius, 2)
+                centers[i] += offset
+        return centers
+
+    def open(self, *args):
+        height, width = self.shape
+        bank_frames = int(min(self.frames, max(self.bank_mb * 2 ** 20 // (height * width), 1)))
+        self.index = np.arange(self.frames) * bank_frames // self.frames
+        #each bank frame is rendered at the first position it is shown for
+        centers = self.trajectoryCenters()[(np.arange(bank_frames) * self.frames + bank_frames - 1) // bank_frames]
+        self.centers = centers[self.index]
+        self.bank = np.empty((bank_frames, height, width), dtype=np.uint8)
+        x = np.arange(width, dtype=np.float32)
+        y = np.arange(height, dtype=np.float32)[:, None]
+        theta = -np.radians(self.angle)     #image rows run downwards, same sign as the Angle stat
+        a = float(np.cos(theta) ** 2 / (2 * self.sigma_x ** 2) + np.sin(theta) ** 2 / (2 * self.sigma_y ** 2))
+        b = float(np.sin(2 * theta) * (1 / (2 * self.sigma_y ** 2) - 1 / (2 * self.sigma_x ** 2)) / 2)
+        c = float(np.sin(theta) ** 2 / (2 * self.sigma_x ** 2) + np.cos(theta) ** 2 / (2 * self.sigma_y ** 2))
+        rng = np.random.default_rng(self.seed)
+        frame = np.empty((height, width), dtype=np.float32)
+        noise = np.empty((height, width), dtype=np.float32)
+        for i, (cx, cy) in enumerate(centers):
+            dx = x - np.float32(cx)
+            dy = y - np.float32(cy)
+            if b == 0:
+                #separable, two 1D profiles instead of a full exponential per pixel
+                np.multiply(np.exp(-c * dy ** 2), np.exp(-a * dx ** 2) * self.amplitude, out=frame)
+            else:
+                np.exp(-(a * dx ** 2 + 2 * b * dx * dy + c * dy ** 2), out=frame)
+                frame *= self.amplitude
+            frame += self.background
+            if self.noise > 0:
+                rng.standard_normal(dtype=np.float32, out=noise)
+                noise *= self.noise
+                frame += noise
+            np.clip(frame, 0, 255, out=frame)
+            np.rint(frame, out=frame)
+            self.bank[i] = frame
+        self.frame_count = self.frames
+        self.opened = True
+        return True
+
+    def getFrame(self, position) -> NDArray:
+        return self.bank[self.index[position]]
+
+    def release(self):
+        Frame_Source.release(self)
+        self.bank = None
+
+
+def is_virtual(source):
+    return isinstance(source, str)
+
+
+def open_source(source: str, realtime=True) -> Frame_Source:
+    # Virtual camera for a source spec, a synthetic beam ("synthetic:...") or a recording to replay (path)
+    if source.startswith(SYNTHETIC_PREFIX):
+        return Synthetic_Source.fromSpec(source, realtime)
+    return Replay_Source(source, realtime=realtime)
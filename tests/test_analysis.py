@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from history import Frame_History
+from analysis import Frame_Timing, Noise_Map, Pointing_Spectrum, band_rms
+
+
+def noisy_frames(count, mean=100.0, sigma=5.0, shape=(16, 24), seed=1):
+    rng = np.random.default_rng(seed)
+    return np.clip(np.rint(rng.normal(mean, sigma, (count,) + shape)), 0, 255).astype(np.uint8)
+
+
+def test_noise_map_known_variance():
+    frames = noisy_frames(300)
+    history = Frame_History(frames.shape[1:])
+    history.setTrackNoise(True)
+    noise = Noise_Map(frames.shape[1:], window=300)
+    for chunk in np.array_split(frames, 3):
+        for img in chunk:
+            history.add(img)
+        done = noise.merge(history)
+        history.reset()
+    assert done
+    assert noise.mean.mean() == pytest.approx(100, abs=0.1)
+    assert noise.variance.mean() == pytest.approx(25, rel=0.03)
+    np.testing.assert_allclose(noise.variance, frames.var(axis=0, ddof=1), rtol=1e-4)
+    assert noise.snr.mean() == pytest.approx(20, rel=0.03)
+
+
+def test_noise_map_enabled_mid_interval():
+    frames = noisy_frames(200)
+    history = Frame_History(frames.shape[1:])
+    noise = Noise_Map(frames.shape[1:], window=100)
+    for img in frames[:50]:
+        history.add(img)
+    history.setTrackNoise(True)
+    for img in frames[50:100]:
+        history.add(img)
+    #the sums hold frames that were never squared, the buffer is left out
+    assert not noise.merge(history)
+    assert noise.frame_count == 0
+    history.reset()
+    for img in frames[100:]:
+        history.add(img)
+    with np.errstate(invalid="raise"):
+        assert noise.merge(history)
+    assert (noise.variance >= 0).all()
+    assert noise.variance.mean() == pytest.approx(25, rel=0.1)
+
+
+def test_frame_timing_counts_dropped_frames():
+    rng = np.random.default_rng(2)
+    stamps = np.arange(300)/30 + rng.normal(0, 0.001, 300)
+    missing = [50, 120, 150, 180, 200, 201, 202]
+    stamps = np.delete(stamps, missing)
+    img = np.zeros((4, 4), np.uint8)
+    history = Frame_History(img.shape)
+    timing = Frame_Timing(nominal_fps=30)
+    #frame 150 is missing right at the interval boundary, the first interval of the next merge still sees the gap
+    for chunk in (stamps[stamps < 5], stamps[stamps >= 5]):
+        for t in chunk:
+            history.add(img, t)
+        timing.merge(history)
+        history.reset()
+    assert timing.dropped == len(missing)
+    assert timing.resets == 0
+    assert timing.summary()["Dropped"] == len(missing)
+    assert timing.fps() == pytest.approx(30*len(stamps)/300, rel=0.02)
+
+
+def test_frame_timing_clock_reset():
+    img = np.zeros((4, 4), np.uint8)
+    history = Frame_History(img.shape)
+    timing = Frame_Timing(nominal_fps=30)
+    for t in np.concatenate((np.arange(60)/30 + 100, np.arange(60)/30)):
+        history.add(img, t)
+    timing.merge(history)
+    #the step back is a reset, not 3000 dropped frames
+    assert timing.resets == 1
+    assert timing.dropped == 0
+    assert timing.fps() == pytest.approx(30, rel=1e-6)
+
+
+def test_pointing_spectrum_sinusoid():
+    fs, amplitude = 100.0, 2.0
+    t = np.arange(16*128 + 128)/fs
+    x = 100 + amplitude*np.sin(2*np.pi*5*t)
+    y = np.full(len(t), 50.0)
+    spectrum = Pointing_Spectrum(nperseg=256)
+    #samples come in as the stats thread collects them, in uneven chunks
+    for chunk in np.array_split(np.column_stack((t, x, y)), 7):
+        spectrum.merge(chunk)
+    freqs, psd_x, psd_y = spectrum.psd()
+    assert freqs[np.argmax(psd_x)] == pytest.approx(5, abs=fs/256)
+    assert band_rms(freqs, psd_x, 1, 10) == pytest.approx(amplitude/np.sqrt(2), rel=0.02)
+    assert band_rms(freqs, psd_x, 10, 100) < 0.01
+    assert band_rms(freqs, psd_y, 0.1, 100) < 1e-6
+    summary = spectrum.summary()
+    assert summary["Segments"] == 16
+    assert float(summary["1-10 Hz"].split(" / ")[0]) == pytest.approx(amplitude/np.sqrt(2), rel=0.02)
@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+import discovery
+from discovery import device_key, find_devices
+
+MODE = {"width": 640, "height": 480, "fps": 30.0, "fourcc": "YUYV"}
+CAM_A = {"path": "/dev/video0", "name": "Cam A", "serial": "123", "usb_id": "046d:0825"}
+CAM_B = {"path": "/dev/video0", "name": "Cam B", "serial": "456", "usb_id": "046d:0826"}
+
+
+@pytest.fixture
+def devices(monkeypatch):
+    # Fake sysfs listing (None = not Linux) and probe results, records which indices were probed
+    state = {"listed": {}, "modes": {}, "probed": []}
+    monkeypatch.setattr(discovery, "list_video_devices", lambda: state["listed"])
+
+    def probe_devices(indices, timeout=3.0):
+        state["probed"] += indices
+        return {index: state["modes"].get(index) for index in indices}
+    monkeypatch.setattr(discovery, "probe_devices", probe_devices)
+    return state
+
+
+def test_device_key():
+    assert device_key(0, CAM_A) == "0|Cam A|123|046d:0825"
+    assert device_key(0, CAM_A) != device_key(1, CAM_A)
+    assert device_key(0, CAM_A) != device_key(0, CAM_B)
+    assert device_key(0, {}) is None
+    assert device_key(0, {"name": "", "serial": "", "usb_id": ""}) is None
+
+
+def test_known_device_not_probed_again(devices, tmp_path):
+    cache = str(tmp_path / "cameras.json")
+    devices["listed"] = {0: CAM_A}
+    devices["modes"] = {0: MODE}
+    assert find_devices(cache_path=cache)[0]["width"] == 640
+    assert devices["probed"] == [0]
+    assert find_devices(cache_path=cache)[0]["name"] == "Cam A"
+    assert devices["probed"] == [0]
+    find_devices(cache_path=cache, rescan=True)
+    assert devices["probed"] == [0, 0]
+
+
+def test_replaced_device_probed_and_evicted(devices, tmp_path):
+    cache = str(tmp_path / "cameras.json")
+    devices["listed"] = {0: CAM_A}
+    devices["modes"] = {0: MODE}
+    find_devices(cache_path=cache)
+    devices["listed"] = {0: CAM_B}
+    find_devices(cache_path=cache)
+    assert devices["probed"] == [0, 0]
+    with open(cache) as f:
+        assert list(json.load(f)) == [device_key(0, CAM_B)]
+
+
+def test_unplugged_device_evicted(devices, tmp_path):
+    cache = str(tmp_path / "cameras.json")
+    devices["listed"] = {0: CAM_A, 2: dict(CAM_B, path="/dev/video2")}
+    devices["modes"] = {0: MODE, 2: MODE}
+    assert sorted(find_devices(cache_path=cache)) == [0, 2]
+    devices["listed"] = {0: CAM_A}
+    assert list(find_devices(cache_path=cache)) == [0]
+    with open(cache) as f:
+        assert list(json.load(f)) == [device_key(0, CAM_A)]
+
+
+def test_device_that_no_longer_opens_evicted(devices, tmp_path):
+    cache = str(tmp_path / "cameras.json")
+    devices["listed"] = {0: CAM_A}
+    devices["modes"] = {0: MODE}
+    find_devices(cache_path=cache)
+    devices["modes"] = {}
+    assert find_devices(cache_path=cache, rescan=True) == {}
+    with open(cache) as f:
+        assert json.load(f) == {}
+
+
+def test_without_identity_always_probed(devices, tmp_path):
+    # Not Linux: nothing tells whether the same camera is still at an index, so the cache is not used
+    cache = str(tmp_path / "cameras.json")
+    devices["listed"] = None
+    devices["modes"] = {1: MODE}
+    assert list(find_devices(max_index=3, cache_path=cache)) == [1]
+    devices["modes"] = {}
+    assert find_devices(max_index=3, cache_path=cache) == {}
+    assert devices["probed"] == [0, 1, 2, 0, 1, 2]
+    with open(cache) as f:
+        assert json.load(f) == {}
+
+
+def test_in_use_device_listed_without_probing(devices, tmp_path):
+    devices["listed"] = {0: CAM_A}
+    found = find_devices(skip_idxs=[0], cache_path=str(tmp_path / "cameras.json"))
+    assert found[0]["in_use"]
+    assert devices["probed"] == []
@@ -0,0 +1,196 @@
+import numpy as np
+import pytest
+
+from sources import Synthetic_Source
+from fitting import Centroid_Tracker, Gaussian_Fitter, Separable_Fitter, Spot_Fitter, beam_moments, detect_spots
+
+
+def synthetic_frames(width=640, height=480, **kwargs):
+    source = Synthetic_Source(width, height, realtime=False, **kwargs)
+    source.open()
+    return source
+
+
+def spots_frame(width, height, spots, background=10, noise=4):
+    # round gaussian spots (center x, center y, sigma, amplitude) on a noisy background
+    y, x = np.mgrid[0:height, 0:width].astype(float)
+    img = np.full((height, width), float(background))
+    for cx, cy, sigma, amplitude in spots:
+        img += amplitude * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * sigma ** 2))
+    img += np.random.default_rng(0).normal(0, noise, img.shape)
+    return np.clip(np.rint(img), 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("sigma_x, sigma_y, angle", [(20, 20, 0), (30, 12, 30), (5, 4, 0)])
+@pytest.mark.parametrize("noise", [0, 4])
+def test_beam_moments(sigma_x, sigma_y, angle, noise):
+    source = synthetic_frames(frames=4, trajectory="static", sigma_x=sigma_x, sigma_y=sigma_y, angle=angle, noise=noise)
+    moments = [beam_moments(source.getFrame(i)) for i in range(4)]
+    mean = {k: np.mean([m[k] for m in moments]) for k in moments[0]}
+    #Sigma X/Y are the widths projected on the image axes
+    a = np.radians(angle)
+    assert mean["Center X"] == pytest.approx(320, abs=0.1)
+    assert mean["Center Y"] == pytest.approx(240, abs=0.1)
+    assert mean["Sigma X"] == pytest.approx(np.hypot(sigma_x * np.cos(a), sigma_y * np.sin(a)), rel=0.02)
+    assert mean["Sigma Y"] == pytest.approx(np.hypot(sigma_x * np.sin(a), sigma_y * np.cos(a)), rel=0.02)
+    assert mean["Background"] == pytest.approx(10, abs=0.5)
+    if sigma_x != sigma_y:
+        assert mean["Angle"] == pytest.approx(angle, abs=1)
+
+
+def test_beam_moments_flat_frame():
+    assert beam_moments(np.full((480, 640), 10, dtype=np.uint8)) is None
+
+
+@pytest.mark.parametrize("sigma_x, sigma_y", [(20, 20), (30, 12), (5, 4)])
+@pytest.mark.parametrize("noise", [0, 4])
+def test_tracker_sigma(sigma_x, sigma_y, noise):
+    source = synthetic_frames(frames=4, trajectory="static", sigma_x=sigma_x, sigma_y=sigma_y, noise=noise)
+    tracker = Centroid_Tracker()
+    x, y, sx, sy = np.mean([tracker.track(source.getFrame(i)) for i in range(4)], axis=0)
+    assert x == pytest.approx(320, abs=0.1)
+    assert y == pytest.approx(240, abs=0.1)
+    assert sx == pytest.approx(sigma_x, rel=0.03)
+    assert sy == pytest.approx(sigma_y, rel=0.03)
+
+
+def test_tracker_follows_beam():
+    source = synthetic_frames(frames=32, trajectory="circle", noise=4)
+    tracker = Centroid_Tracker()
+    for i in range(32):
+        x, y, _, _ = tracker.track(source.getFrame(i))
+        assert (x, y) == pytest.approx(tuple(source.centers[i]), abs=0.2)
+
+
+def test_tracker_lost_and_reacquired():
+    source = synthetic_frames(1920, 1080, frames=2, trajectory="static", x0=0.2, y0=0.7, noise=4)
+    tracker = Centroid_Tracker()
+    assert tracker.track(np.full((1080, 1920), 10, dtype=np.uint8)) is None
+    assert tracker.center is None
+    x, y, _, _ = tracker.track(source.getFrame(0))
+    assert (x, y) == pytest.approx((384, 756), abs=0.2)
+
+
+
+def test_gaussian_fitter_warm_start():
+    source = synthetic_frames(frames=4, trajectory="circle", noise=4, radius=0.1)
+    fitter = Gaussian_Fitter()
+    for i in range(4):
+        img = source.getFrame(i).astype(float)
+        accepted, results = fitter.fit(img, beam_moments(img))
+        assert accepted
+        assert results["Start"] == ("Cold" if i == 0 else "Warm")
+        assert (results["Window"] == "Full") == (i == 0)      #warm fits only fit a window around the beam
+        assert (results["Center X"], results["Center Y"]) == pytest.approx(tuple(source.centers[i]), abs=0.1)
+        assert results["Sigma X"] == pytest.approx(20, rel=0.01)
+
+
+def test_gaussian_fitter_cold_fallback():
+    source = synthetic_frames(frames=2, trajectory="circle", noise=4, radius=0.1)
+    fitter = Gaussian_Fitter(warm_nfev=3)
+    img = source.getFrame(0).astype(float)
+    _, cold = fitter.fit(img, beam_moments(img))
+    img = source.getFrame(1).astype(float)
+    accepted, results = fitter.fit(img, beam_moments(img))
+    #the warm start can't converge within 3 evaluations, the same frame is fit again from scratch
+    assert accepted
+    assert results["Start"] == "Fallback"
+    assert results["Window"] == "Full"
+    assert results["Iterations"] > 3
+    assert (results["Center X"], results["Center Y"]) == pytest.approx(tuple(source.centers[1]), abs=0.1)
+
+
+
+def test_separable_fitter():
+    source = synthetic_frames(frames=4, trajectory="circle", noise=4, radius=0.1, sigma_x=25, sigma_y=12)
+    fitter = Separable_Fitter()
+    for i in range(4):
+        img = source.getFrame(i).astype(float)
+        accepted, results = fitter.fit(img, beam_moments(img))
+        assert accepted
+        assert results["Start"] == ("Cold" if i == 0 else "Warm")
+        assert (results["Center X"], results["Center Y"]) == pytest.approx(tuple(source.centers[i]), abs=0.15)
+        assert results["Sigma X"] == pytest.approx(25, rel=0.01)
+        assert results["Sigma Y"] == pytest.approx(12, rel=0.01)
+
+
+
+@pytest.mark.parametrize("width, height", [(640, 480), (1920, 1080)])
+def test_detect_and_fit_spots(width, height):
+    #spots come brightest first by total signal: the wide spot before the one with the highest peak
+    truth = [(0.7 * width, 0.6 * height, 20, 150), (0.25 * width, 0.3 * height, 12, 200), (0.4 * width, 0.8 * height, 8, 100)]
+    img = spots_frame(width, height, truth)
+    spots = detect_spots(img)
+    assert len(spots) == 3
+    for spot, (cx, cy, sigma, _) in zip(spots, truth):
+        assert (spot["Center X"], spot["Center Y"]) == pytest.approx((cx, cy), abs=0.5)
+        assert spot["Sigma X"] == pytest.approx(sigma, rel=0.05)
+    fits = Spot_Fitter().fit(img.astype(float), spots)
+    for (accepted, results), (cx, cy, sigma, _) in zip(fits, truth):
+        assert accepted
+        assert (results["Center X"], results["Center Y"]) == pytest.approx((cx, cy), abs=0.2)
+        assert results["Sigma X"] == pytest.approx(sigma, rel=0.02)
+        assert results["Sigma Y"] == pytest.approx(sigma, rel=0.02)
+
+
+def test_detect_spots_empty_frame():
+    assert detect_spots(spots_frame(640, 480, [])) == []
+
+
+def test_pool_fitter_restarts_broken_pool():
+    import os, signal, threading
+    from fitting import Fit_Pool, Pool_Fitter
+
+    source = synthetic_frames(160, 120, frames=1, trajectory="static", noise=0)
+    img = source.getFrame(0).astype(float)
+    fitter = Pool_Fitter("test", img.shape, max_workers=1)
+    try:
+        results = []
+        done = threading.Event()
+
+        def callback(accepted, values):
+            results.append((accepted, values))
+            done.set()
+
+        def fit():
+            done.clear()
+            assert fitter.submit(img, "2D Fit", beam_moments(img), callback)
+            assert done.wait(60)
+
+        fit()
+        assert results[-1][0]
+        broken = fitter.pool
+        for process in list(broken.executor._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+        #fits submitted before the pool notices the dead worker fail and come back rejected, the first submit
+        #after that restarts the pool
+        done.clear()
+        while fitter.submit(img, "2D Fit", beam_moments(img), callback):
+            assert done.wait(60)
+            done.clear()
+            assert not results[-1][0]
+        assert fitter.pool is not broken
+        assert Fit_Pool.get() is fitter.pool
+        fit()
+        assert results[-1][0]
+    finally:
+        fitter.close()
+        Fit_Pool.shutdown()
+
+
+def test_pool_fitter_close_waits_for_fits(caplog):
+    from fitting import Fit_Pool, Pool_Fitter
+
+    source = synthetic_frames(160, 120, frames=1, trajectory="static", noise=0)
+    img = source.getFrame(0).astype(float)
+    fitter = Pool_Fitter("test", img.shape, max_workers=1)
+    results = []
+    try:
+        assert fitter.submit(img, "2D Fit", beam_moments(img), lambda accepted, values: results.append(accepted))
+    finally:
+        fitter.close()
+        Fit_Pool.shutdown()
+    #the fit either finished before the slot was unlinked or was cancelled, it never lost its frame
+    assert results in ([], [True])
+    assert "Error fitting" not in caplog.text
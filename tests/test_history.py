@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from history import Ring_Buffer, Frame_History, Double_Buffered_History, Drift_History
+
+
+def test_ring_buffer_append_and_wrap():
+    buffer = Ring_Buffer(4)
+    for v in range(3):
+        buffer.append(v)
+    assert len(buffer) == 3
+    assert list(buffer.values()) == [0, 1, 2]
+    for v in range(3, 7):
+        buffer.append(v)
+    assert len(buffer) == 4
+    assert list(buffer.values()) == [3, 4, 5, 6]
+    assert sorted(buffer.valid()) == [3, 4, 5, 6]
+    buffer.clear()
+    assert len(buffer) == 0
+    assert len(buffer.values()) == 0
+
+
+@pytest.mark.parametrize("chunks", [[3], [2, 3], [3, 4, 1], [10], [5, 9, 2]])
+def test_ring_buffer_extend(chunks):
+    buffer = Ring_Buffer(6)
+    appended = Ring_Buffer(6)
+    start = 0
+    for n in chunks:
+        values = np.arange(start, start + n, dtype=float)
+        buffer.extend(values)
+        for v in values:
+            appended.append(v)
+        start += n
+    assert buffer.count == appended.count == start
+    assert list(buffer.values()) == list(appended.values()) == list(range(max(0, start - 6), start))
+
+
+def test_ring_buffer_rows():
+    buffer = Ring_Buffer(2, width=2)
+    buffer.append((1, 2))
+    buffer.append((3, 4))
+    buffer.append((5, 6))
+    assert buffer.values().tolist() == [[3, 4], [5, 6]]
+
+
+def test_frame_history_add():
+    history = Frame_History((4, 5), capacity=8)
+    history.setTrackNoise(True)
+    frames = [np.full((4, 5), v, dtype=np.uint8) for v in (10, 20, 255)]
+    frames[1][0, 0] = 0
+    for i, img in enumerate(frames):
+        history.add(img, timestamp=i * 0.1, centroid=(i, 2 * i))
+    assert history.frame_count == 3
+    np.testing.assert_array_equal(history.sums, np.sum(frames, axis=0))
+    np.testing.assert_array_equal(history.sumsq, np.sum(np.square(frames, dtype=np.uint64), axis=0))
+    assert list(history.minimum.values()) == [10, 0, 255]
+    assert list(history.maximum.values()) == [10, 20, 255]
+    assert history.timestamps.values() == pytest.approx([0, 0.1, 0.2])
+    assert history.centroids.values().tolist() == [[0, 0], [1, 2], [2, 4]]
+    history.reset()
+    assert history.frame_count == 0
+    assert not history.sums.any() and not history.sumsq.any()
+    assert len(history.minimum) == len(history.timestamps) == len(history.centroids) == 0
+
+
+def test_double_buffered_swap():
+    history = Double_Buffered_History((3, 3), capacity=4)
+    img = np.ones((3, 3), dtype=np.uint8)
+    assert history.add(img, timestamp=0.0, centroid=(1, 1))
+    assert history.add(img, timestamp=0.1, centroid=(1, 1))
+    filled = history.swap()
+    assert filled.frame_count == 2
+    np.testing.assert_array_equal(filled.sums, 2 * img)
+    #the next frames go to the other buffer, the filled one stays untouched until the next swap
+    history.add(3 * img, timestamp=0.2)
+    assert filled.frame_count == 2
+    second = history.swap()
+    assert second is not filled
+    assert second.frame_count == 1
+    np.testing.assert_array_equal(second.sums, 3 * img)
+    #the spare buffer is reset when it is swapped back in
+    assert history.swap() is filled
+    assert filled.frame_count == 0
+
+
+def test_double_buffered_discards_size_change():
+    history = Double_Buffered_History((3, 3))
+    assert not history.add(np.ones((4, 3), dtype=np.uint8))
+    assert history.discarded == 1
+    assert history.swap().frame_count == 0
+
+
+def test_drift_history_decimation():
+    drift = Drift_History(fields=("Center X", "Center Y", "Sigma X"), capacity=16)
+    x = np.arange(100, dtype=float)
+    x[37] = 1000
+    for i, v in enumerate(x):
+        #no fit for frames 60-63, and Sigma X is never fitted
+        drift.add(i / 10, {"Center X": v, "Center Y": "" if 60 <= i < 64 else 5.0, "Sigma X": ""})
+    assert drift.count <= drift.capacity
+    assert drift.stride == 8
+    assert drift.count * drift.stride + len(drift.pending) == len(x)
+    n = drift.count
+    assert (np.diff(drift.times[:n]) > 0).all()
+    #the extremes survive every compaction, the means are of the samples in each row
+    assert drift.maximum[:n, 0].max() == 1000
+    assert drift.minimum[:n, 0].min() == 0
+    np.testing.assert_allclose(drift.mean[:n, 0], x[:n * 8].reshape(n, 8).mean(axis=1))
+    np.testing.assert_allclose(drift.mean[:n, 1], 5.0)
+    assert np.isnan(drift.mean[:n, 2]).all()
+    times, values = drift.display("Center X", points=4)
+    assert len(times) == len(values) == 8
+    assert values.max() == 1000 and values.min() == 0
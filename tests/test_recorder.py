@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from recorder import Frame_Recorder, RECORD_FORMATS
+from sources import Replay_Source
+
+
+@pytest.mark.parametrize("fmt", RECORD_FORMATS)
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_record_and_replay(tmp_path, fmt, dtype):
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, np.iinfo(dtype).max, (5, 48, 64), dtype=dtype)
+    stamps = 100 + np.arange(5) / 30
+    recorder = Frame_Recorder(0, (48, 64), dtype, tmp_path, fmt, fps=30)
+    for img, stamp in zip(frames, stamps):
+        assert recorder.push(img, stamp)
+    recorder.stop(wait=True)
+    assert recorder.written == 5
+
+    source = Replay_Source(recorder.folder, realtime=False, loop=False)
+    source.open()
+    assert source.frame_count == 5
+    assert source.timestamps == pytest.approx(stamps, abs=1e-6)
+    if fmt != "video":      #video frames are decoded to 8-bit BGR
+        assert source.dtype == dtype
+        for i, img in enumerate(frames):
+            ret, frame = source.read()
+            assert ret
+            np.testing.assert_array_equal(frame, img)
+
+
+def test_push_drops_other_formats(tmp_path, caplog):
+    recorder = Frame_Recorder(0, (48, 64), np.uint8, tmp_path, "npy")
+    assert not recorder.push(np.full((48, 64), 1000, dtype=np.uint16), 0.0)
+    assert not recorder.push(np.zeros((32, 64), dtype=np.uint8), 0.0)
+    assert recorder.push(np.zeros((48, 64), dtype=np.uint8), 0.0)
+    recorder.stop(wait=True)
+    assert recorder.dropped == 2
+    assert recorder.written == 1
+    assert "dropping them" in caplog.text
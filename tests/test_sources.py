@@ -0,0 +1,105 @@
+import re
+
+import cv2
+import numpy as np
+import pytest
+
+from sources import Replay_Source, Synthetic_Source, open_source, is_virtual, TRAJECTORIES
+
+
+def synthetic_help_options():
+    # Option names listed in the --synthetic help text of the viewer
+    from main import create_parser
+    action = next(a for a in create_parser()._actions if "--synthetic" in a.option_strings)
+    listed = re.search(r"\(options: (.*)\)", action.help).group(1)
+    return [option.split("=")[0].strip() for option in listed.split(", ")]
+
+
+def test_spec_size_and_rate():
+    source = Synthetic_Source.fromSpec("synthetic:320x240@30")
+    assert source.shape == (240, 320)
+    assert source.fps == 30
+
+
+def test_spec_every_documented_option():
+    values = {"frames": "7", "trajectory": "jitter", "sigma_x": "5", "sigma_y": "6", "angle": "10", "amplitude": "150",
+              "background": "12", "noise": "2", "x0": "0.4", "y0": "0.6", "radius": "0.05", "dx": "0.1", "dy": "0.2", "seed": "3", "bank_mb": "64"}
+    options = synthetic_help_options()
+    assert set(options) == set(values)
+    source = Synthetic_Source.fromSpec("synthetic:64x48@10," + ",".join(f"{k}={values[k]}" for k in options), realtime=False)
+    assert source.frames == 7 and isinstance(source.frames, int)
+    assert source.seed == 3 and isinstance(source.seed, int)
+    assert source.trajectory == "jitter"
+    assert source.sigma_y == 6.0
+    assert source.open()
+    assert source.bank.shape == (7, 48, 64)
+
+
+
+def test_bank_limited_by_size():
+    from fitting import beam_moments
+    frame_mb = 320 * 240 / 2 ** 20
+    source = Synthetic_Source(320, 240, frames=16, trajectory="circle", noise=0, bank_mb=4.5 * frame_mb, realtime=False)
+    source.open()
+    assert source.bank.shape == (4, 240, 320)
+    assert source.frame_count == 16
+    #the circle still takes 16 frames, each bank frame is shown for 4 of them
+    frames = [source.read()[1] for _ in range(16)]
+    for i, frame in enumerate(frames):
+        assert np.shares_memory(frame, source.bank[i // 4])
+        moments = beam_moments(frame)
+        assert (moments["Center X"], moments["Center Y"]) == pytest.approx(tuple(source.centers[i]), abs=0.05)
+    assert len({tuple(c) for c in source.centers}) == 4
+
+
+@pytest.mark.parametrize("trajectory", TRAJECTORIES)
+def test_trajectories_stay_in_frame(trajectory):
+    source = Synthetic_Source.fromSpec(f"synthetic:160x120,trajectory={trajectory},frames=16,noise=0", realtime=False)
+    source.open()
+    assert np.all((source.centers >= 0) & (source.centers < [160, 120]))
+    ret, frame = source.read()
+    assert ret and frame.shape == (120, 160) and frame.dtype == np.uint8
+
+
+def test_invalid_specs():
+    with pytest.raises(ValueError):
+        Synthetic_Source.fromSpec("synthetic:320by240")
+    with pytest.raises(ValueError):
+        Synthetic_Source.fromSpec("synthetic,trajectory=spiral")
+    with pytest.raises(ValueError):
+        Synthetic_Source.fromSpec("synthetic,seed=1.5")
+
+
+def test_open_source():
+    assert is_virtual("synthetic")
+    assert not is_virtual(0)
+    assert isinstance(open_source("synthetic:64x48", realtime=False), Synthetic_Source)
+
+
+def test_replay_timestamps(tmp_path):
+    frames = np.arange(6 * 4 * 4, dtype=np.uint16).reshape(6, 4, 4)
+    stamps = 50 + np.array([0, 0.1, 0.2, 0.4, 0.45, 0.5])
+    np.save(tmp_path / "frames_0000.npy", frames)
+    np.save(tmp_path / "timestamps_0000.npy", stamps)
+    source = Replay_Source(str(tmp_path), realtime=False, loop=False)
+    assert source.open()
+    assert source.dtype == np.uint16
+    #paced by the recorded timestamps, the rate is their mean
+    assert source.fps == pytest.approx(10)
+    assert source.frameTime(3) == pytest.approx(0.4)
+    for i in range(4):
+        ret, frame = source.read()
+        np.testing.assert_array_equal(frame, frames[i])
+    assert source.get(cv2.CAP_PROP_POS_FRAMES) == 4
+    assert source.get(cv2.CAP_PROP_POS_MSEC) == pytest.approx(400)
+
+
+def test_replay_mismatched_timestamps(tmp_path):
+    np.save(tmp_path / "frames_0000.npy", np.zeros((6, 4, 4), dtype=np.uint8))
+    np.save(tmp_path / "timestamps_0000.npy", np.arange(5) / 10)
+    source = Replay_Source(str(tmp_path), realtime=False, loop=False, fps=25)
+    assert source.open()
+    #timestamps that don't match the frames are ignored, the given rate is used
+    assert source.timestamps is None
+    assert source.fps == 25
+    assert source.frameTime(5) == pytest.approx(0.2)
@@ -0,0 +1,17 @@
+from time import perf_counter_ns
+
+from util import Stage_Timer
+
+
+def test_stage_timer_max_covers_percentile_windows():
+    timer = Stage_Timer(["grab"], window=0)
+    timer.record("grab", perf_counter_ns() - 5_000_000)
+    timer.summary()
+    #the slow sample is in the previous window, so it still sets both p95 and max
+    timer.record("grab", perf_counter_ns() - 1_000)
+    p50, p95, maximum = (float(v) for v in timer.summary()["grab"].split(" / "))
+    assert p95 <= maximum
+    assert maximum >= 5000
+    #both windows rolled over, only the fast sample is left
+    p50, p95, maximum = (float(v) for v in timer.summary()["grab"].split(" / "))
+    assert p95 <= maximum < 100
@@ -1,5 +1,6 @@
 #System Imports
 import logging, traceback
+from time import perf_counter_ns
 
 #Qt Imports
 from PyQt6 import QtCore
@@ -71,6 +72,68 @@ class RunningThreads(QtCore.QObject):
             else:
                 self.countChange.emit(len(self.active_threads)) 
                         
+class Stage_Timer():                            #Always-on per-stage timing histograms for the hot paths
+    # Durations (ns) are counted in log2 bins split into 4 sub-bins (~20% resolution), recording a sample is
+    # a subtraction, a bit_length and a list increment. Summaries cover the current and the previous window,
+    # so they follow changes within a couple of windows without having to store any samples.
+    BINS = 64 * 4
+
+    def __init__(self, stages, window=5.0):
+        self.stages = list(stages)
+        self.window = int(window * 1e9)
+        self.counts = {s: [0] * self.BINS for s in self.stages}
+        self.previous = {s: [0] * self.BINS for s in self.stages}
+        self.maximum = {s: 0 for s in self.stages}
+        self.previous_maximum = {s: 0 for s in self.stages}
+        self.window_start = perf_counter_ns()
+
+    def record(self, stage, start):
+        #duration since start (perf_counter_ns), returns the current time to chain stages
+        now = perf_counter_ns()
+        d = now - start
+        n = d.bit_length()
+        self.counts[stage][(n << 2) | ((d >> (n - 3)) & 3) if n > 3 else n] += 1
+        if d > self.maximum[stage]:
+            self.maximum[stage] = d
+        return now
+
+    @staticmethod
+    def binValue(i):
+        #midpoint of a bin in ns
+        n = i >> 2
+        if n <= 3:
+            return float(i)
+        low = (1 << (n - 1)) + (i & 3) * (1 << (n - 3))
+        return low + (1 << (n - 4))
+
+    def percentile(self, counts, total, q):
+        target = q * total
+        running = 0
+        for i, c in enumerate(counts):
+            running += c
+            if running >= target:
+                return self.binValue(i)
+        return 0.0
+
+    def summary(self):
+        # {stage: "p50 / p95 / max"} in us, then starts a new window if the current one is done
+        result = {}
+        for s in self.stages:
+            counts = [a + b for a, b in zip(self.counts[s], self.previous[s])]
+            total = sum(counts)
+            if total > 0:
+                #max over the same two windows as the percentiles, so p95 never exceeds it
+                maximum = max(self.maximum[s], self.previous_maximum[s])
+                p50 = min(self.percentile(counts, total, 0.5), maximum)
+                p95 = min(self.percentile(counts, total, 0.95), maximum)
+                result[s] = f"{p50 / 1e3:.0f} / {p95 / 1e3:.0f} / {maximum / 1e3:.0f}"
+        if perf_counter_ns() - self.window_start > self.window:
+            self.previous, self.counts = self.counts, {s: [0] * self.BINS for s in self.stages}
+            self.previous_maximum, self.maximum = self.maximum, {s: 0 for s in self.stages}
+            self.window_start = perf_counter_ns()
+        return result
+
+
 class SBlock:
     def __init__(self, obj):
         self.target = obj